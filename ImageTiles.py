@@ -1,175 +1,234 @@
-from PIL import Image
-import os
-import json
-import xmltodict
-from pascal_voc_writer import Writer
-
-
-class image_cropper:
-    # This class provides the ability to separate the images into tiles of height x width size
-    # The leftover edges are dropped and it returns a dictionary of crop_boxes[image_tile_name] = (bounds for section of image)
-    # This box is given so that it can be used to separate the bounding boxes of corresponding VOC files (or other labeled training data)
-    def __crop(self,infile,height,width):
-        '''Internal class that crops a specific image into tiles. 
-        Parameters
-        ----------
-        infile : str
-            the file path and name of an image 
-        height : int
-            the desired tile height
-        width : int
-            the desired tile width
-        Returns
-        -------
-        The image tiles via generator
-        '''
-        with Image.open(infile) as im:
-            imgwidth, imgheight = im.size
-            for i in range(imgheight//height):
-                for j in range(imgwidth//width):
-                    box = (j*width, i*height, (j+1)*width, (i+1)*height)
-                    yield (box, im.crop(box))
-
-    def crop(self,infile,outfolder,height,width,start_num):
-        '''Wrapper for the internal crop function that handles the 
-             management of file names as well as saving the new images. 
-        Parameters
-        ----------
-        infile : str
-            the file path and name of an image 
-        outfolder : str
-            the folder that the tile png's should be written to 
-        height : int
-            the desired tile height
-        width : int
-            the desired tile width
-        start_num : int
-            the number that will be used to start file numbering
-        Returns
-        -------
-        Dictionary of crop_boxes[image_tile_name] = (bounds for section of image)
-        '''
-        crop_boxes = dict()
-        for k,(box,piece) in enumerate(self.__crop(infile,height,width),start_num):
-            img=Image.new('RGB', (height,width), 255)
-            img.paste(piece)
-            img_name = infile.split("\\")[-1]
-            img_name = "%s-%s.png" % (img_name, k)
-            path=os.path.join(outfolder,img_name)
-            img.save(path)
-            crop_boxes[path] = box
-        return crop_boxes
-
-class voc_tiler: 
-    # This class takes a given VOC/Pascal annotated file and divides itself and associated image up into corresponding tiles
-    # e.g. a 1920 x 1080 image broken could be broken into a 3 by 2 grid of 512 x 512 images (The leftover area is discarded) 
-    def __init__(self):
-        ''' json_body will store the incoming voc file for easy parsing
-            image_tile_boxes is a dictionary of image_tile_name => (bounds for section of image)
-            image_data_points is a dictionary of image_tile_name and the associated bounding boxes found in
-              the original data set
-            new_voc_files is a dictionary of voc_file_name -> voc data to be written to file
-        '''
-        self.json_body = None
-        #self.image_tile_boxes[<image>] = <box encompased>
-        self.image_tile_boxes = dict()
-        self.image_data_points = dict()
-        self.new_voc_files = dict()
-
-    def __crop_image(self,infile,outfolder,height,width,start_number):
-        '''Wrapper for the image_cropper crop function
-            See image_cropper.crop() for parameter details
-        '''
-        ic = image_cropper()
-        box_dict = ic.crop(infile,outfolder,height,width,start_num)
-        return box_dict
-
-    def __parse_voc_file(self,infile):
-        '''Reads a voc file into the json body for easy parsing
-        '''
-        with open(infile) as xml_file:
-            data_dict = xmltodict.parse(xml_file.read())
-            self.json_body = json.dumps(data_dict)
-
-    def split_voc_and_images(self,xmlfile,outfolder,height,width,start_num):
-        '''Overall logic funtion
-          1. Parses Voc file into json body
-          2. crop image to given measurements and retrieve dictionary of image name / bounding boxes
-          3. loop through bounding boxes and find associated data points 
-            3b. If bounding box overlaps tiles, shorten the box to fit in its corresponding tile
-          4. Create the object list that represents each bounding box for a given image
-          5. Create object that represents a single one of the VOC tiles and place it in self.new_voc_files
-
-        '''
-        self.__parse_voc_file(xmlfile)
-        self.image_tile_boxes = self.__crop_image(self.json_body["annotation"]["path"],outfolder,height,width,start_num)
-        min_points = 0
-        #TODO Doesn't handle incrementing files (just does bounding boxes vs points, not conversion to 
-        # new points -> subtract minimum of bounding box)
-        for index, image_file in enumerate(self.image_tile_boxes.keys()):
-            bounding_box = self.image_tile_boxes[image_file]
-            self.image_data_points[image_file]["object"] = []
-            for data_point in self.json_body["annotation"]["object"]:
-                x_min = data_point["bndbox"]["xmin"]
-                x_max = data_point["bndbox"]["xmax"]
-                y_min = data_point["bndbox"]["ymin"]
-                y_max = data_point["bndbox"]["ymax"]
-                
-                x_in_bounds = x_min >= bounding_box[0] or x_max >= bounding_box[2]
-                y_in_bounds = y_min >= bounding_box[3] or y_max >= bounding_box[1]
-                if x_in_bounds and y_in_bounds:
-                    if x_min < bounding_box[0]:
-                        x_min = bounding_box[0]
-                    x_min = x_min - bounding_box[0]
-                    if x_max > bounding_box[2]:
-                        x_max = bounding_box[2]
-                    x_max = x_max - bounding_box[2]
-                    if y_min < bounding_box[3]:
-                        y_min = bounding_box[3]
-                    y_min = y_min - bounding_box[3]
-                    if y_max > bounding_box[1]:
-                        y_max = bounding_box[1]
-                    y_max = y_max - bounding_box[1]
-
-                    data_object = {"name":data_point["name"], "pose":data_point["pose"], 
-                        "truncated":data_point["truncated"], "difficult":data_point["difficult"], 
-                        "bndbox":{"xmin":x_min, "ymin":y_min, "xmax":x_max, "ymax":y_max}}
-                    self.image_data_points[image_file]["object"].append(data_object)
-                    min_points += 1
-
-            #Check if there's at least 1 bounding box in the tile before creating a new file
-            if min_points:
-                folder = outfolder
-                filename = image_file.split("\\")[-1]
-                path = image_file
-                source = self.json_body["annotation"]["source"]
-                size = {"size":{"width":width,"height":height,"depth":3}}
-                segmented = self.json_body["annotation"]["segmented"]
-                #data_object
-                xml_filename = xmlfile.split("\\")[-1].split(".")[-1] + str(index) + ".xml"
-                self.new_voc_files[xml_filename] = {"folder":folder, "filename":filename, 
-                    "path":path, "source":source, "size":size, "segmented":segmented,
-                    "object":self.image_data_points[image_file]["object"]}
-
-    def write_new_vocs(self):
-        # This is where the objects listed in self.new_voc_files actually get written to their 
-        # corresponding XML files
-        for new_file in self.new_voc_files.keys():
-            with open(new_file, "w") as out_file: 
-                print("Write a voc file")
-                print(self.new_voc_files[new_file])
-                #TODO Actually write the file 
-                #self.json_body has all the common voc info and newfile has the list of "Objects"
-
-
-
-if __name__=='__main__':
-    #TODO Loop through xmls
-    infile="<something.xml>"
-    outfolder = "<some output folder>"
-    height=512
-    width=512
-    start_num=0
-    ic = image_cropper()
-    ic.crop(infile,outfolder,height,width,start_num)
-    
+from PIL import Image
+import os
+import numpy as np
+import rasterio
+from concurrent.futures import ThreadPoolExecutor
+from rasterio.windows import Window
+
+from box_store import boxStore
+
+
+class image_cropper:
+    # This class provides the ability to separate the images into tiles of height x width size
+    # Tiles are read from the source in windows so the full image is never held in memory, and
+    # tiles step by (size - overlap) pixels. Leftover edges are dropped unless pad is set, in
+    # which case edge tiles are filled out with the fill value.
+    # It returns a dictionary of crop_boxes[image_tile_name] = (bounds for section of image)
+    # This box is given so that it can be used to separate the bounding boxes of corresponding VOC files (or other labeled training data)
+    def __init__(self, workers=4):
+        ''' workers is the number of threads used to encode tiles
+        '''
+        self.workers = workers
+
+    @staticmethod
+    def tile_boxes(imgwidth, imgheight, height, width, overlap=0, pad=False):
+        '''Lays out the tile grid for an image.
+        Parameters
+        ----------
+        imgwidth, imgheight : int
+            the size of the source image
+        height, width : int
+            the desired tile size
+        overlap : int
+            the number of pixels neighbouring tiles share
+        pad : bool
+            keep the partial tiles at the right and bottom edges
+        Returns
+        -------
+        List of (left, upper, right, lower) tile boxes in row order
+        '''
+        step_y = height - overlap
+        step_x = width - overlap
+        if step_x <= 0 or step_y <= 0:
+            raise ValueError('overlap must be smaller than the tile size')
+        if pad:
+            rows = max(-(-(imgheight - overlap) // step_y), 1)
+            cols = max(-(-(imgwidth - overlap) // step_x), 1)
+        else:
+            rows = max((imgheight - overlap) // step_y, 0)
+            cols = max((imgwidth - overlap) // step_x, 0)
+        return [(j*step_x, i*step_y, j*step_x + width, i*step_y + height)
+                for i in range(rows) for j in range(cols)]
+
+    def __crop(self,infile,height,width,overlap=0,pad=False,fill=0):
+        '''Internal class that crops a specific image into tiles. 
+        Parameters
+        ----------
+        infile : str
+            the file path and name of an image 
+        height : int
+            the desired tile height
+        width : int
+            the desired tile width
+        overlap, pad, fill
+            see crop()
+        Returns
+        -------
+        The image tiles as (box, (height, width, bands) array) via generator
+        '''
+        with rasterio.open(infile) as src:
+            for box in self.tile_boxes(src.width, src.height, height, width,
+                                       overlap=overlap, pad=pad):
+                window = Window(box[0], box[1], width, height)
+                # boundless reads fill whatever runs past the image edge
+                edge = box[2] > src.width or box[3] > src.height
+                tile = src.read(window=window, boundless=edge, fill_value=fill)
+                yield (box, np.moveaxis(tile, 0, -1))
+
+    @staticmethod
+    def save_tile(tile, path):
+        '''Encode a (height, width, bands) array as a png'''
+        if tile.shape[2] == 1:
+            tile = tile[:, :, 0]
+        Image.fromarray(tile).save(path)
+        return path
+
+    def crop(self,infile,outfolder,height,width,start_num,overlap=0,pad=False,fill=0):
+        '''Wrapper for the internal crop function that handles the 
+             management of file names as well as saving the new images. 
+             Tiles are encoded on a thread pool while the next ones are read.
+        Parameters
+        ----------
+        infile : str
+            the file path and name of an image 
+        outfolder : str
+            the folder that the tile png's should be written to 
+        height : int
+            the desired tile height
+        width : int
+            the desired tile width
+        start_num : int
+            the number that will be used to start file numbering
+        overlap : int
+            the number of pixels neighbouring tiles share
+        pad : bool
+            keep the partial tiles at the right and bottom edges, padded
+            out to the full tile size with the fill value
+        fill : int
+            the pixel value used for padding
+        Returns
+        -------
+        Dictionary of crop_boxes[image_tile_name] = (bounds for section of image)
+        '''
+        crop_boxes = dict()
+        img_name = os.path.basename(infile)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = []
+            for k,(box,piece) in enumerate(self.__crop(infile,height,width,overlap,pad,fill),start_num):
+                path=os.path.join(outfolder,"%s-%s.png" % (img_name, k))
+                pending.append(pool.submit(self.save_tile, piece, path))
+                crop_boxes[path] = box
+                # bound the tiles waiting to be encoded so memory stays flat
+                if len(pending) >= 2 * self.workers:
+                    pending.pop(0).result()
+            for future in pending:
+                future.result()
+        return crop_boxes
+
+class voc_tiler: 
+    # This class takes a given VOC/Pascal annotated file and divides itself and associated image up into corresponding tiles
+    # e.g. a 1920 x 1080 image broken could be broken into a 3 by 2 grid of 512 x 512 images (The leftover area is discarded) 
+    # Boxes are bucketed into the tiles they overlap with numpy interval math on the tile grid, so the
+    # cost is O(objects + tiles) rather than testing every object against every tile
+    def __init__(self):
+        ''' image_tile_boxes is a dictionary of image_tile_name => (bounds for section of image)
+            new_voc_files is a list of (output folder, boxStore of the tile boxes) to be written to file
+        '''
+        #self.image_tile_boxes[<image>] = <box encompased>
+        self.image_tile_boxes = dict()
+        self.new_voc_files = []
+
+    def __crop_image(self,infile,outfolder,height,width,start_num,overlap,pad):
+        '''Wrapper for the image_cropper crop function
+            See image_cropper.crop() for parameter details
+        '''
+        ic = image_cropper()
+        box_dict = ic.crop(infile,outfolder,height,width,start_num,overlap=overlap,pad=pad)
+        return box_dict
+
+    @staticmethod
+    def assign_boxes(boxes,imgwidth,imgheight,height,width,overlap=0,pad=False):
+        '''Finds every (tile, box) pair where the box overlaps the tile
+        Parameters
+        ----------
+        boxes : np.ndarray
+            (n, 4) array of [xmin, ymin, xmax, ymax] boxes
+        imgwidth, imgheight, height, width, overlap, pad
+            see image_cropper.tile_boxes()
+        Returns
+        -------
+        tile_index : np.ndarray
+            the row order index of the tile of each pair
+        box_index : np.ndarray
+            the index into boxes of each pair
+        '''
+        tiles = image_cropper.tile_boxes(imgwidth,imgheight,height,width,overlap,pad)
+        if not tiles or not len(boxes):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        step_x = width - overlap
+        step_y = height - overlap
+        cols = tiles[-1][0] // step_x + 1
+        rows = tiles[-1][1] // step_y + 1
+        # tile j spans [j*step, j*step + size) so a box overlaps tiles
+        # (min - size) / step < j < max / step
+        c0 = np.maximum(np.floor((boxes[:, 0] - width) / step_x).astype(int) + 1, 0)
+        c1 = np.minimum(np.ceil(boxes[:, 2] / step_x).astype(int) - 1, cols - 1)
+        r0 = np.maximum(np.floor((boxes[:, 1] - height) / step_y).astype(int) + 1, 0)
+        r1 = np.minimum(np.ceil(boxes[:, 3] / step_y).astype(int) - 1, rows - 1)
+        n_cols = np.maximum(c1 - c0 + 1, 0)
+        n_rows = np.maximum(r1 - r0 + 1, 0)
+        counts = n_cols * n_rows
+        # expand every box into one pair per tile it overlaps
+        box_index = np.repeat(np.arange(len(boxes)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        n_cols = np.maximum(n_cols[box_index], 1)
+        col = c0[box_index] + offset % n_cols
+        row = r0[box_index] + offset // n_cols
+        return row * cols + col, box_index
+
+    def split_voc_and_images(self,xmlfile,outfolder,height,width,start_num,overlap=0,pad=False):
+        '''Overall logic funtion
+          1. Reads the Voc file into a boxStore
+          2. crop image to given measurements and retrieve dictionary of image name / bounding boxes
+          3. bucket the bounding boxes into the tiles they overlap
+            3b. If bounding box overlaps tiles, shorten the box to fit in its corresponding tile
+          4. Queue the boxes of the tiles in self.new_voc_files, as one boxStore with an image per tile
+
+        '''
+        voc = boxStore.read_voc(xmlfile)
+        image_file = voc.images[0]
+        imgwidth, imgheight, depth = voc.sizes[0].tolist()
+        self.image_tile_boxes = self.__crop_image(image_file,outfolder,height,width,start_num,overlap,pad)
+        tile_files = list(self.image_tile_boxes.keys())
+        tile_index, box_index = self.assign_boxes(voc.boxes,imgwidth,imgheight,height,width,overlap,pad)
+
+        origin = np.array([self.image_tile_boxes[f][:2] for f in tile_files], dtype=float).reshape(-1, 2)
+        tiles = voc[box_index].regroup(tile_index, [os.path.abspath(f) for f in tile_files],
+                                       [(width, height, depth)] * len(tile_files),
+                                       databases=voc.databases * len(tile_files),
+                                       segmented=voc.segmented[0])
+        tiles = tiles.translate(-origin[tile_index, 0], -origin[tile_index, 1]).clip(0, 0, width, height)
+        self.new_voc_files.append((outfolder, tiles))
+        return tiles
+
+    def write_new_vocs(self):
+        # This is where the boxes listed in self.new_voc_files actually get written to the
+        # XML files of their tiles, tiles without a bounding box get no file
+        written = []
+        for outfolder, tiles in self.new_voc_files:
+            written.extend(tiles.write_voc(outfolder, skip_empty=True))
+        self.new_voc_files = []
+        return written
+
+
+if __name__=='__main__':
+    #TODO Loop through xmls
+    infile="<something.xml>"
+    outfolder = "<some output folder>"
+    height=512
+    width=512
+    start_num=0
+    vt = voc_tiler()
+    vt.split_voc_and_images(infile,outfolder,height,width,start_num)
+    vt.write_new_vocs()
+    
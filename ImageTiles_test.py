@@ -0,0 +1,132 @@
+from ImageTiles import image_cropper, voc_tiler
+from box_store import boxStore
+from PIL import Image
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class TestImageCropper(unittest.TestCase):
+    """
+    Testing image_cropper tiles against slices of the full image
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(0)
+        self.image = rng.integers(0, 255, (300, 500, 3), dtype=np.uint8)
+        self.image_file = os.path.join(self.temp_dir.name, 'plot.png')
+        Image.fromarray(self.image).save(self.image_file)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_tile_boxes(self):
+        self.assertEqual(image_cropper.tile_boxes(500, 300, 128, 256),
+                         [(0, 0, 256, 128), (0, 128, 256, 256)])
+        self.assertEqual(len(image_cropper.tile_boxes(500, 300, 128, 256, pad=True)), 6)
+        # with an overlap tiles step by the size less the overlap
+        self.assertEqual(image_cropper.tile_boxes(500, 300, 200, 300, overlap=100),
+                         [(0, 0, 300, 200), (200, 0, 500, 200),
+                          (0, 100, 300, 300), (200, 100, 500, 300)])
+        self.assertEqual(image_cropper.tile_boxes(100, 100, 128, 128), [])
+        self.assertEqual(image_cropper.tile_boxes(100, 100, 128, 128, pad=True), [(0, 0, 128, 128)])
+        with self.assertRaises(ValueError):
+            image_cropper.tile_boxes(500, 300, 128, 128, overlap=128)
+
+    def test_crop(self):
+        for overlap, pad in ((0, False), (0, True), (32, True)):
+            folder = os.path.join(self.temp_dir.name, f'{overlap}_{pad}')
+            os.makedirs(folder)
+            crop_boxes = image_cropper(workers=2).crop(self.image_file, folder, 128, 160, 5,
+                                                       overlap=overlap, pad=pad, fill=7)
+            boxes = image_cropper.tile_boxes(500, 300, 128, 160, overlap, pad)
+            self.assertEqual(list(crop_boxes.values()), boxes)
+            self.assertEqual(os.path.basename(next(iter(crop_boxes))), 'plot.png-5.png')
+
+            # the image padded out with the fill value on the right and bottom
+            padded = np.full((300 + 128, 500 + 160, 3), 7, dtype=np.uint8)
+            padded[:300, :500] = self.image
+            for tile_file, (x0, y0, x1, y1) in crop_boxes.items():
+                np.testing.assert_array_equal(np.asarray(Image.open(tile_file)),
+                                              padded[y0:y1, x0:x1])
+
+    def test_crop_single_band(self):
+        gray_file = os.path.join(self.temp_dir.name, 'gray.png')
+        Image.fromarray(self.image[:, :, 0]).save(gray_file)
+        crop_boxes = image_cropper().crop(gray_file, self.temp_dir.name, 100, 100, 0)
+        self.assertEqual(len(crop_boxes), 15)
+        for tile_file, (x0, y0, x1, y1) in crop_boxes.items():
+            np.testing.assert_array_equal(np.asarray(Image.open(tile_file)),
+                                          self.image[y0:y1, x0:x1, 0])
+
+
+class TestVocTiler(unittest.TestCase):
+    """
+    Testing voc_tiler box assignment and tile labels
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def brute_force(self, boxes, tiles):
+        # every (tile, box) pair where they share some area or a degenerate
+        # box lies inside the tile
+        return sorted((t, b) for t, (x0, y0, x1, y1) in enumerate(tiles)
+                      for b, box in enumerate(boxes)
+                      if box[0] < x1 and box[2] > x0 and box[1] < y1 and box[3] > y0)
+
+    def test_assign_boxes(self):
+        rng = np.random.default_rng(1)
+        # snap the corners to a 16 pixel grid so many land right on tile edges
+        corners = rng.integers(0, 40, (500, 2)) * 16
+        boxes = np.hstack([corners, corners + rng.integers(0, 20, (500, 2)) * 16]).astype(float)
+        boxes[:50] += 0.5
+        for overlap, pad in ((0, False), (0, True), (64, False), (64, True), (100, True)):
+            tiles = image_cropper.tile_boxes(600, 500, 128, 192, overlap, pad)
+            tile_index, box_index = voc_tiler.assign_boxes(boxes, 600, 500, 128, 192, overlap, pad)
+            self.assertEqual(sorted(zip(tile_index.tolist(), box_index.tolist())),
+                             self.brute_force(boxes, tiles))
+
+        # a box on a tile edge only belongs to the tile it lies in
+        tile_index, box_index = voc_tiler.assign_boxes(np.array([[100, 10, 128, 20],
+                                                                 [128, 10, 130, 20],
+                                                                 [120, 10, 130, 20]]),
+                                                       256, 128, 128, 128)
+        self.assertEqual(list(zip(tile_index, box_index)), [(0, 0), (1, 1), (0, 2), (1, 2)])
+        self.assertEqual(len(voc_tiler.assign_boxes(np.zeros((0, 4)), 256, 128, 128, 128)[0]), 0)
+        self.assertEqual(len(voc_tiler.assign_boxes(boxes, 100, 100, 128, 128)[0]), 0)
+
+    def test_split_voc_and_images(self):
+        image_file = os.path.join(self.temp_dir.name, 'plot.png')
+        Image.new('RGB', (256, 256)).save(image_file)
+        # one box in the first tile, one on the corner of all four
+        store = boxStore([[10, 20, 50, 60], [100, 110, 150, 140]], heights=[15, 25],
+                         classes=['tree'], images=[image_file], sizes=[(256, 256, 3)])
+        voc_file, = store.write_voc(self.temp_dir.name)
+        folder = os.path.join(self.temp_dir.name, 'tiles')
+        os.makedirs(folder)
+
+        vt = voc_tiler()
+        tiles = vt.split_voc_and_images(voc_file, folder, 128, 128, 0)
+        self.assertEqual(len(tiles.images), 4)
+        self.assertEqual(tiles.sizes.tolist(), [[128, 128, 3]] * 4)
+        groups = [tiles[index] for index in tiles.groups()]
+        self.assertEqual(groups[0].boxes.tolist(), [[10, 20, 50, 60], [100, 110, 128, 128]])
+        self.assertEqual(groups[0].truncated.tolist(), [False, True])
+        self.assertEqual(groups[1].boxes.tolist(), [[0, 110, 22, 128]])
+        self.assertEqual(groups[2].boxes.tolist(), [[100, 0, 128, 12]])
+        self.assertEqual(groups[3].boxes.tolist(), [[0, 0, 22, 12]])
+
+        written = vt.write_new_vocs()
+        self.assertEqual(len(written), 4)
+        self.assertEqual(vt.new_voc_files, [])
+        tile_voc = boxStore.read_voc(written[3])
+        self.assertEqual(tile_voc.boxes.tolist(), [[0, 0, 22, 12]])
+        self.assertTrue(os.path.exists(tile_voc.images[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
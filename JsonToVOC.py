@@ -1,87 +1,103 @@
-import json
-import cv2
-import os
-import JsonToXML
-import xml.etree.cElementTree as ET
-import xml.dom.minidom
-
-def json_to_pascal_voc(file_name, output_dir, image_dir):
-    json_object_list = dict()
-    with open(file_name, 'r') as my_file:
-        print(my_file)
-        json_text = my_file.read()
-        json_text = json.loads(json_text)
-        folder = image_dir.split("/")[-1]
-        json_object_list["folder"] = folder
-
-        # img_name = json_text['annotation']['path'].replace("E:\Widow CV Data\\", cwd)
-        img_name = json_text['content'].split("\\")[-1] + ".png"
-        json_object_list["filename"] = img_name
-
-        path = image_dir + img_name
-        json_object_list["path"] = path
-
-        json_object_list["source"] = {"database":"Unknown"}
-
-        im = cv2.imread(path)
-        width, height, depth = im.shape
-        size = {"width":width, "height":height, "depth":depth}
-        json_object_list["size"] = size
-
-        segmented = {"segmented":"0"}
-        json_object_list["segmented"] = "0"
-
-        json_object_list["object"] = []
-        for bounding_box in json_text["annotation"]:
-            #name = bounding_box["label"]
-            name = "tree"
-            pose = "Unspecified"
-            trunkated = "0"
-            difficult = "0"
-            xmin = bounding_box["x_min"]
-            ymin = bounding_box["y_min"]
-            xmax = bounding_box["x_max"]
-            ymax = bounding_box["y_max"]
-            bndbox = {"bndbox":{"xmin":xmin,"ymin":ymin,"xmax":xmax,"ymax":ymax}}
-            my_object = {"name":name, "pose":pose, "trunkated":trunkated, "difficult":difficult, "bndbox":bndbox}
-            json_object_list["object"].append(my_object)
-
-
-        return json.dumps(json_object_list)
-
-
-# %%
-
-#{"content": "maps\\CubComplex2009_401377N_12146256W", "annotation": [{"max_h": 37.92, "x_min": 188.41919438590773, "x_max": 182.49735873408764,
-# "y_min": 2.290860966074602, "y_max": 7.265202913603464},
-
-#
-# def xml_list_to_json_file(xml_list, output_filename):
-#     output_filename = output_filename
-#     with open(output_filename, "w+") as output_file:
-#         for xml_file in xml_list:
-#             json = pascal_voc_to_json(xml_file)
-#             output_file.write(str(json).replace("'", '"') + "\n")
-#     return output_filename
-
-
-img_folder = "/home/zac/ShadeMyRun/sample-20200916T181117Z-001/sample/maps/"
-data_path = "/home/zac/ShadeMyRun/sample-20200916T181117Z-001/sample/labels/"
-output_dir = "/home/zac/ShadeMyRun/VocFiles/"
-
-filelist = []
-for filename in os.listdir(data_path):
-    print(filename)
-    if filename.endswith("js"):
-        filelist.append(data_path + filename)
-
-for file in filelist:
-    root = JsonToXML.fromText(json_to_pascal_voc(file, output_dir, img_folder), rootName="annotation")  # convert the file to XML and return the root node
-    xmlData = ET.tostring(root, encoding='utf8', method='xml').decode()  # convert the XML data to string
-    dom = xml.dom.minidom.parseString(xmlData)
-    prettyXmlData = dom.toprettyxml()  # properly format the string of XML data
-    print(prettyXmlData)  # print the formatted XML data
-# print(len(filelist))
-# print(xml_list_to_json_file(filelist, json_data_file))
-
+# converts labels between the json label format, Pascal VOC xml and the
+# RetinaNet csv format. Label files are read into boxStores on a thread pool
+# and joined into one store the output is written from, so a whole tree of
+# labels converts in seconds
 
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from box_store import boxStore
+
+logger = logging.getLogger(__name__)
+
+JSON_EXTS = ('.json', '.js')
+
+
+def _read(f_name, image_dir, label):
+    ext = os.path.splitext(f_name)[1].lower()
+    if ext == '.xml':
+        return boxStore.read_voc(f_name, image_dir)
+    return boxStore.read_json(f_name, image_dir, label)
+
+
+def convert_tree(src, dst, image_dir=None, label='tree', workers=8, classes_file=None):
+    '''Convert every label file under src to the format of dst.
+
+    Parameters
+    ----------
+    src : str
+        a folder searched recursively for .xml and .json/.js label files,
+        or a single label file (a .csv is read as RetinaNet annotations)
+    dst : str
+        a .csv file for RetinaNet annotations, a .json file for json labels
+        (one per line) or else a folder for VOC xml files
+    image_dir : str
+        the folder of the images when it is not the folder of the labels
+    label : str
+        the class of json boxes without a label
+    workers : int
+        the number of threads reading label files
+    classes_file : str
+        where to write the RetinaNet class mapping, classes.csv next to
+        the csv by default
+
+    Returns
+    ----------
+    dict
+        counts of the label files read, the images and boxes written and
+        the files that failed
+    '''
+    stores, failed = [], 0
+    if os.path.isfile(src) and src.lower().endswith('.csv'):
+        stores = [boxStore.read_csv(src, workers)]
+        files = [src]
+    else:
+        if os.path.isfile(src):
+            files = [src]
+        else:
+            files = sorted(os.path.join(root, f) for root, _, names in os.walk(src)
+                           for f in names if f.lower().endswith(('.xml',) + JSON_EXTS)
+                           and not f.lower().endswith('.aux.xml'))
+        with ThreadPoolExecutor(workers) as pool:
+            futures = [pool.submit(_read, f, image_dir, label) for f in files]
+            for f, future in zip(files, futures):
+                try:
+                    stores.append(future.result())
+                except Exception as e:
+                    failed += 1
+                    logger.warning(f'{f} failed: {e!r}')
+    # one store for the whole tree, every format is written from its arrays
+    boxes = boxStore.concat(stores)
+
+    lower = dst.lower()
+    if lower.endswith(('.csv',) + JSON_EXTS):
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+    if lower.endswith('.csv'):
+        boxes.write_csv(dst, classes_file=classes_file)
+    elif lower.endswith(JSON_EXTS):
+        boxes.write_json(dst)
+    else:
+        os.makedirs(dst, exist_ok=True)
+        boxes.write_voc(dst)
+
+    summary = {'files': len(files), 'images': len(boxes.images),
+               'boxes': len(boxes), 'failed': failed}
+    logger.info(f'\n{src} -> {dst}: {summary}')
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert labels between json, VOC xml and RetinaNet csv')
+    parser.add_argument('src', help='a label file or a folder of label files')
+    parser.add_argument('dst', help='a .csv, a .json or a folder for VOC xml files')
+    parser.add_argument('--image-dir', default=None)
+    parser.add_argument('--label', default='tree')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--classes', default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    print(convert_tree(args.src, args.dst, image_dir=args.image_dir, label=args.label,
+                       workers=args.workers, classes_file=args.classes))
@@ -0,0 +1,87 @@
+from JsonToVOC import convert_tree
+from box_store import boxStore, image_name
+from PIL import Image
+import unittest
+import tempfile
+import json
+import csv
+import os
+
+
+class TestJsonToVOC(unittest.TestCase):
+    """
+    Testing label conversion between json, VOC xml and RetinaNet csv
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.maps = os.path.join(self.temp_dir.name, 'maps')
+        self.labels = os.path.join(self.temp_dir.name, 'labels')
+        os.makedirs(self.maps)
+        os.makedirs(self.labels)
+        # not square, so a swapped width and height shows
+        Image.new('RGB', (300, 200)).save(os.path.join(self.maps, 'Plot_A.png'))
+        Image.new('RGB', (100, 50)).save(os.path.join(self.maps, 'Plot_B.png'))
+        with open(os.path.join(self.labels, 'Plot_A.js'), 'w') as f:
+            json.dump({'content': 'maps\\Plot_A',
+                       'annotation': [{'max_h': 37.9, 'x_min': 188.4, 'x_max': 182.5,
+                                       'y_min': 2.3, 'y_max': 7.3},
+                                      {'max_h': 20.0, 'x_min': '10', 'x_max': '20',
+                                       'y_min': '30', 'y_max': '40'}]}, f)
+        with open(os.path.join(self.labels, 'Plot_B.json'), 'w') as f:
+            f.write(json.dumps({'content': 'maps\\Plot_B', 'annotation': []}) + '\n')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_image_name(self):
+        self.assertEqual(image_name('maps\\Plot_A'), 'Plot_A.png')
+        self.assertEqual(image_name('/home/zac/shots/shot.jpg'), 'shot.jpg')
+
+    def test_round_trip(self):
+        voc_dir = os.path.join(self.temp_dir.name, 'voc')
+        summary = convert_tree(self.labels, voc_dir, image_dir=self.maps, workers=2)
+        self.assertEqual(summary, {'files': 2, 'images': 2, 'boxes': 2, 'failed': 0})
+
+        voc = boxStore.read_voc(os.path.join(voc_dir, 'Plot_A.xml'), image_dir=self.maps)
+        self.assertEqual(voc.sizes.tolist(), [[300, 200, 3]])
+        self.assertEqual(voc.boxes.tolist(), [[182.5, 2.3, 188.4, 7.3], [10, 30, 20, 40]])
+        self.assertEqual(voc.classes, ['tree'])
+
+        csv_file = os.path.join(self.temp_dir.name, 'annotations.csv')
+        convert_tree(voc_dir, csv_file, image_dir=self.maps)
+        with open(csv_file) as f:
+            rows = list(csv.reader(f))
+        plot_a = os.path.join(self.maps, 'Plot_A.png')
+        self.assertEqual(rows, [[plot_a, '182', '2', '189', '8', 'tree'],
+                                [plot_a, '10', '30', '20', '40', 'tree'],
+                                [os.path.join(self.maps, 'Plot_B.png'), '', '', '', '', '']])
+        with open(os.path.join(self.temp_dir.name, 'classes.csv')) as f:
+            self.assertEqual(f.read(), 'tree,0\n')
+
+        json_file = os.path.join(self.temp_dir.name, 'labels.json')
+        summary = convert_tree(csv_file, json_file)
+        self.assertEqual(summary['images'], 2)
+        with open(json_file) as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual(records[0]['content'], plot_a)
+        self.assertEqual(records[0]['annotation'][1],
+                         {'label': 'tree', 'x_min': 10, 'y_min': 30, 'x_max': 20, 'y_max': 40})
+        self.assertEqual(records[1]['annotation'], [])
+
+    def test_missing_image(self):
+        os.remove(os.path.join(self.maps, 'Plot_B.png'))
+        summary = convert_tree(self.labels, os.path.join(self.temp_dir.name, 'voc'),
+                               image_dir=self.maps)
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['images'], 1)
+
+    def test_empty_tree(self):
+        empty_dir = os.path.join(self.temp_dir.name, 'empty')
+        os.makedirs(empty_dir)
+        for dst in ('out.csv', 'out.json', 'voc'):
+            summary = convert_tree(empty_dir, os.path.join(self.temp_dir.name, dst))
+            self.assertEqual(summary, {'files': 0, 'images': 0, 'boxes': 0, 'failed': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
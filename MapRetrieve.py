@@ -1,52 +1,84 @@
 # retrieves map images from arcgis server given a zipped shape file
 
 # import packages
+# numpy, rasterio, pyproj and the rest are imported in the methods that use
+# them, so a pool worker or a short cli job starts without loading them and
+# only png_print ever loads matplotlib
 
 import json
 import logging
 import os
 import re
 import subprocess
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor
 
-import matplotlib.pyplot as plt
-import numpy as np
-import pycrs
-import rasterio
-import requests
-import shapefile as shp
-from pascal_voc_writer import Writer
-from PIL import Image
-from pyproj import Proj
-from lxml import html
+from build_manifest import fingerprint, source_fingerprint, zip_fingerprint
+from epsg_resolver import epsgResolver
+from metrics import pipelineMetrics, stage
+from tile_cache import tileCache
+
+# log through this module's logger, the root logger is left to the caller
+logger = logging.getLogger(__name__)
+
+# the default imagery source, an arcgis server
+SRC_FILE = 'http://server.arcgisonline.com/arcgis/'\
+           'rest/services/ESRI_Imagery_World_2D/'\
+           'MapServer?f=json&pretty=true'
 
 
 class mapRetrieve():
     def __init__(self, in_folder='data',
-                 out_folder='maps', label_folder='labels', log=False):
+                 out_folder='maps', label_folder='labels', log=False,
+                 epsg_cache=None, src_file=None, cache_dir=None,
+                 cache_bytes=2*1024**3, metrics=None,
+                 max_pixels=8192*8192, chunk=4096, fetch_workers=8,
+                 fetch_rate=20):
         # folder of zipped shapes
         self.in_folder = in_folder
         # folder for output shapes
         self.out_folder = out_folder
         # make output folder if none exists
-        if not os.path.isdir(self.out_folder):
-            os.mkdir(self.out_folder)
+        os.makedirs(self.out_folder, exist_ok=True)
         # folder for json labels
         self.label_folder = label_folder
         # make label folder if none exists
-        if not os.path.isdir(self.label_folder):
-            os.mkdir(self.label_folder)
-
-
-        # source data hosted on arcgis server
-        self.src_file = 'http://server.arcgisonline.com/arcgis/'\
-                        'rest/services/ESRI_Imagery_World_2D/'\
-                        'MapServer?f=json&pretty=true'
-        # a temp file to hold transformations
-        self.temp_map = os.path.join(self.out_folder,'temp.tif')
-
-        # enable or disable logging
-        logger = logging.getLogger()
+        os.makedirs(self.label_folder, exist_ok=True)
+
+
+        # source data hosted on arcgis server, any GDAL readable source
+        # (ex. a local stand-in server) can be passed instead
+        self.src_file = src_file or SRC_FILE
+
+        # an arcgis MapServer source is read straight from its tile grid,
+        # fetch_workers tiles at a time and at most fetch_rate requests a
+        # second to the host from this process, see tile_fetch.py
+        self.fetch_workers = fetch_workers
+        self.fetch_rate = fetch_rate
+        self.fetcher = None
+
+        # clipped source imagery is cached on disk keyed by source and
+        # extents, a cache_bytes of 0 turns the cache off
+        if cache_dir is None:
+            cache_dir = os.path.join(self.out_folder, 'tile_cache')
+        self.tile_cache = None
+        if cache_bytes:
+            self.tile_cache = tileCache(cache_dir, max_bytes=cache_bytes)
+
+        # resolves .prj files to EPSG codes, memoized on disk between runs
+        if epsg_cache is None:
+            epsg_cache = os.path.join(self.out_folder, 'epsg_cache.json')
+        self.epsg_resolver = epsgResolver(cache_file=epsg_cache)
+
+        # maps larger than max_pixels are warped chunk by chunk straight
+        # into a tiled GeoTIFF so memory stays flat for any survey size
+        self.max_pixels = max_pixels
+        self.chunk = chunk
+
+        # stage timings and counters, pass a pipelineMetrics to share
+        # them between several mapRetrieve objects
+        self.metrics = metrics or pipelineMetrics()
+
+        # enable or disable logging from this module
         if log:
             # turn on logging to get output from methods
             logger.setLevel(logging.INFO) 
@@ -55,6 +87,7 @@ class mapRetrieve():
 
 
 
+    @stage('load_shape')
     def load_shape(self, f_name: str):
         '''Get shape object and projection from a zip file. 
 
@@ -65,44 +98,45 @@ class mapRetrieve():
 
         Returns
         -------
-        shp.Shape
-            a Shape object from the shapefile module
+        shapeStream
+            a lazy reader of the shapes, see shape_stream.py, its reader()
+            method gives a full shp.Reader when the geometry is needed
         str
             a string with the proj4 projection defintion of the shape
+        str
+            the EPSG code of the shape projection (ex. 'EPSG:26910')
         '''
-        # open the zip file
-        zipshape = ZipFile(f_name)
-        shape_name = re.split(r'/|\\+', f_name)[-1]
-        shape_name = shape_name.split('.')[0]
-        # print(shape_name)
-        shape = shp.Reader(shp=zipshape.open(shape_name+'.shp'),
-                           shx=zipshape.open(shape_name+'.shx'),
-                           dbf=zipshape.open(shape_name+'.dbf'))
-
-        # read the projection file
-        prj = str(zipshape.open(shape_name+'.prj').readlines())[3:-1]
-        url = 'https://spatialreference.org/ref/epsg/' + \
-                prj.split('"')[1].replace('_','-').replace('-19','').lower() + '/'
-        logging.info(f'\nGetting epsg from {url}')
-        page = requests.get(url)
-        tree = html.fromstring(page.content)
-        epsg = tree.xpath('//h1/text()')[0]
-        logging.info(f'Got {epsg}')
+        import pycrs
+        from shape_stream import shapeStream
+
+        # open the zip file, only the headers and shape index are read
+        shape = shapeStream(f_name)
+
+        # read the projection file and resolve its EPSG code locally
+        prj = shape.zipshape.read(shape.shape_name+'.prj').decode().strip()
+        with self.metrics.span('epsg_lookup'):
+            epsg = self.epsg_resolver.resolve(prj)
+        logger.info(f'Got {epsg}')
         # convert the prj format to proj4
         crs = pycrs.parse.from_esri_wkt(prj)
         proj4 = crs.to_proj4()
-        logging.info(f'\nProj4 string decoded:\n {proj4}')
+        logger.info(f'\nProj4 string decoded:\n {proj4}')
         return shape, proj4, epsg
 
-    def get_bounds(self, shape, proj4):
+    @stage('get_bounds')
+    def get_bounds(self, shape, proj4, epsg=None):
         '''Get the bound of a shape object and project them into geocoordinates. 
 
         Parameters
         ----------
-        shape : shp.Shape
-            A Shape object from the shapefile module
+        shape : shapeStream
+            the shapes from load_shape
         proj4 : str
             a string with the proj4 projection defintion of the shape
+        epsg : str
+            the EPSG code of the shape projection, used instead of proj4
+            when given (newer PROJ versions reject the zone-less utm
+            strings pycrs writes)
 
         Returns
         ----------
@@ -111,22 +145,29 @@ class mapRetrieve():
                 [upper left x, upper left y, lower right x, lower right y]
 
         '''
+        from pyproj import Proj, Transformer
+
         # get bounding box
         utm_extents = shape.bbox
         # print(utm_extents)
 
-        # define projection object
-        myProj = Proj(proj4)
-
         # project UTM to geocoordinates
-        llx, lly = myProj(utm_extents[0], utm_extents[1], inverse=True)
-        upx, upy = myProj(utm_extents[2], utm_extents[3], inverse=True)
+        if epsg is not None:
+            to_lnglat = Transformer.from_crs(epsg, 'EPSG:4326', always_xy=True)
+            llx, lly = to_lnglat.transform(utm_extents[0], utm_extents[1])
+            upx, upy = to_lnglat.transform(utm_extents[2], utm_extents[3])
+        else:
+            # define projection object
+            myProj = Proj(proj4)
+            llx, lly = myProj(utm_extents[0], utm_extents[1], inverse=True)
+            upx, upy = myProj(utm_extents[2], utm_extents[3], inverse=True)
 
         # note we have to do a conversion to get the bb in the right order for gdal
         extents = [llx, upy, upx, lly]
-        logging.info(f'\nProjected extents:\n {extents}')
+        logger.info(f'\nProjected extents:\n {extents}')
         return extents, utm_extents
 
+    @stage('get_map')
     def get_map(self, extents, dst_file):
         '''Retrieve a map from given extents and save it.  
 
@@ -152,37 +193,39 @@ class mapRetrieve():
         #                    f'-co ZLEVEL=1 ' \
         #                    f'"{self.src_file}" ' \
         #                    f'{dst_file}'
-        # build option string for GDAL translate command
-        translate_option = f'-projwin {" ".join(map(str, extents))} ' \
-                           f'-ot Byte ' \
-                           f'-of GTiff ' \
-                           f'-co COMPRESS=NONE ' \
-                           f'-co BIGTIFF=IF_NEEDED ' \
-                           f'"{self.src_file}" ' \
-                           f'{dst_file}'
+        # build argument list for GDAL translate command
+        translate_option = ['-projwin', *map(str, extents),
+                            '-ot', 'Byte',
+                            '-of', 'GTiff',
+                            '-co', 'COMPRESS=NONE',
+                            '-co', 'BIGTIFF=IF_NEEDED',
+                            self.src_file,
+                            dst_file]
 
         # print(translate_option)
 
         # run command command as system process
-        p_out = subprocess.run('gdal_translate ' + translate_option,
-                               shell=True,
+        p_out = subprocess.run(['gdal_translate'] + translate_option,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
                                text=True)
 
         # display process outputs
         stdout = p_out.stdout
-        logging.info(f'\nstdout:\n {stdout}')  # stdout = normal output
+        logger.debug(f'\nstdout:\n {stdout}')  # stdout = normal output
         stderr = p_out.stderr  # stderr = error output
         if stderr:
-            logging.warning(f'\nsterr:\n {stderr}')
+            logger.warning(f'\nsterr:\n {stderr}')
 
         # simply return return code for test function later
         rc = p_out.returncode
-        logging.info(f'\nThe process returned with code: {rc}')
+        logger.info(f'\nThe process returned with code: {rc}')
+        if rc == 0:
+            self.metrics.count('bytes_fetched', os.path.getsize(dst_file))
         
-        return 
+        return rc
     
+    @stage('warp_map')
     def warp_map(self, src_file, dst_file, epsg):
         '''warps a tiff map in EPSPG:4326 to epsg specified. note that
            that the src_file is deleted before return.  
@@ -197,38 +240,42 @@ class mapRetrieve():
             the epsg code of the desired re-projection (ex. 'EPSG:2610')
         '''
 
-        # build option string for GDAL warp command
-        warp_option = f'-s_srs EPSG:4326 '\
-                      f'-t_srs {epsg} '\
-                      f'-r near '\
-                      f'-of GTiff '\
-                      f'-overwrite '\
-                      f'{src_file} '\
-                      f'{dst_file}'
+        # build argument list for GDAL warp command
+        warp_option = ['-s_srs', 'EPSG:4326',
+                       '-t_srs', epsg,
+                       '-r', 'near',
+                       '-of', 'GTiff',
+                       '-overwrite',
+                       src_file,
+                       dst_file]
 
         # run command command as system process
-        p_out = subprocess.run('gdalwarp ' + warp_option,
-                               shell=True,
+        p_out = subprocess.run(['gdalwarp'] + warp_option,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
                                text=True)
 
         # display process outputs
         stdout = p_out.stdout
-        logging.info(f'\nstdout:\n {stdout}')  # stdout = normal output
+        logger.debug(f'\nstdout:\n {stdout}')  # stdout = normal output
         stderr = p_out.stderr  # stderr = error output
         if stderr:
-            logging.warning(f'\nsterr:\n {stderr}')
+            logger.warning(f'\nsterr:\n {stderr}')
 
         # delete temp_map
         os.remove(src_file)
 
         # simply return return code for test function later
         rc = p_out.returncode
-        logging.info(f'\nThe process returned with code: {rc}')
+        logger.info(f'\nThe process returned with code: {rc}')
+        if rc == 0:
+            import rasterio
+            with rasterio.open(dst_file) as dst:
+                self.metrics.count('pixels_warped', dst.width * dst.height)
         
-        return
+        return rc
     
+    @stage('png_map')
     def png_map(self, src_file, dst_file):
         '''convert a tiff map to a png map. note that that src_file is
            deleted before return.  
@@ -241,42 +288,321 @@ class mapRetrieve():
             the file location of the destination map
         '''
 
-        # build option string for GDAL translate command
-        translate_option = f'-of PNG ' \
-                           f'-co ZLEVEL=1 ' \
-                           f'"{src_file}" ' \
-                           f'{dst_file}'
+        # build argument list for GDAL translate command
+        translate_option = ['-of', 'PNG',
+                            '-co', 'ZLEVEL=1',
+                            src_file,
+                            dst_file]
 
         # print(translate_option)
 
         # run command command as system process
-        p_out = subprocess.run('gdal_translate ' + translate_option,
-                               shell=True,
+        p_out = subprocess.run(['gdal_translate'] + translate_option,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE,
                                text=True)
 
         # display process outputs
         stdout = p_out.stdout
-        logging.info(f'\nstdout:\n {stdout}')  # stdout = normal output
+        logger.debug(f'\nstdout:\n {stdout}')  # stdout = normal output
         stderr = p_out.stderr  # stderr = error output
         if stderr:
-            logging.warning(f'\nsterr:\n {stderr}')
+            logger.warning(f'\nsterr:\n {stderr}')
 
         # delete temp_map
         os.remove(src_file)
 
         # simply return return code for test function later
         rc = p_out.returncode
-        logging.info(f'\nThe process returned with code: {rc}')
+        logger.info(f'\nThe process returned with code: {rc}')
         
-        return 
+        return rc 
+
+    def open_source(self):
+        '''Open the imagery source for reading, as a context manager. A
+           MapServer is opened as a tileFetcher, kept between calls, and
+           anything else with rasterio.
+        '''
+        import rasterio
+        from tile_fetch import service_url, tileFetcher
+
+        if service_url(self.src_file) is None:
+            return rasterio.open(self.src_file)
+        if self.fetcher is None:
+            self.fetcher = tileFetcher(self.src_file, workers=self.fetch_workers,
+                                       rate=self.fetch_rate,
+                                       tile_cache=self.tile_cache)
+        return self.fetcher
+
+    @stage('fetch')
+    def read_source(self, extents):
+        '''Clip the source map to the extents, same as gdal_translate
+           -projwin. Clips are served from the tile cache when the same
+           source and extents were read before.
+
+        Parameters
+        ----------
+        extents : list
+            a list with the bounding box coordinates in the format, 
+                [upper left x, upper left y, lower right x, lower right y]
+
+        Returns
+        ----------
+        np.ndarray
+            the clip as a (bands, rows, cols) array of bytes
+        affine.Affine
+            the transform from pixel to source coordinates of the clip
+        rasterio.crs.CRS
+            the projection of the source
+        '''
+        import rasterio
+        from rasterio import windows
+        from rasterio.io import MemoryFile
+
+        key = ('extents', self.src_file, *(round(e, 9) for e in extents))
+        cached = self.tile_cache.get(*key) if self.tile_cache else None
+        if cached is not None:
+            logger.info(f'\nsource clip served from tile cache')
+            self.metrics.count('cache_hits')
+            with MemoryFile(cached) as mem, mem.open() as src:
+                return src.read(), src.transform, src.crs
+
+        ulx, uly, lrx, lry = extents
+        with self.open_source() as src:
+            # a MapServer fetcher counts the bytes that went over the wire
+            downloaded = getattr(src, 'bytes_downloaded', None)
+            window = windows.from_bounds(ulx, lry, lrx, uly,
+                                         transform=src.transform)
+            window = window.round_offsets().round_lengths()
+            # extents running off the source are read up to its edge
+            window = window.intersection(windows.Window(0, 0, src.width, src.height))
+            src_array = src.read(window=window, out_dtype='uint8')
+            src_transform = src.window_transform(window)
+            src_crs = src.crs or rasterio.crs.CRS.from_epsg(4326)
+            if downloaded is not None:
+                downloaded = src.bytes_downloaded - downloaded
+        logger.info(f'\nclipped source shape: {src_array.shape}')
+        self.metrics.count('bytes_decoded', src_array.nbytes)
+        # GDAL does not report what went over the wire, for its sources the
+        # decoded bytes stand in
+        self.metrics.count('bytes_fetched',
+                           src_array.nbytes if downloaded is None else downloaded)
+
+        if self.tile_cache:
+            bands, height, width = src_array.shape
+            with MemoryFile() as mem:
+                with mem.open(driver='GTiff', width=width, height=height,
+                              count=bands, dtype='uint8', crs=src_crs,
+                              transform=src_transform,
+                              COMPRESS='DEFLATE') as dst:
+                    dst.write(src_array)
+                self.tile_cache.put(mem.read(), *key)
+        return src_array, src_transform, src_crs
+
+    @stage('warp')
+    def render_map(self, extents, epsg):
+        '''Clip the source map to the extents and reproject it to epsg in
+           memory. This does the work of get_map and warp_map in one pass
+           without writing any intermediate files.
+
+        Parameters
+        ----------
+        extents : list
+            a list with the bounding box coordinates in the format, 
+                [upper left x, upper left y, lower right x, lower right y]
+        epsg : str
+            the epsg code of the desired re-projection (ex. 'EPSG:2610')
+
+        Returns
+        ----------
+        np.ndarray
+            the map as a (bands, rows, cols) array of bytes
+        affine.Affine
+            the transform from pixel to epsg coordinates of the map
+        '''
+        import numpy as np
+        from rasterio.transform import array_bounds
+        from rasterio.warp import Resampling, calculate_default_transform, reproject
+
+        src_array, src_transform, src_crs = self.read_source(extents)
+        bands, src_height, src_width = src_array.shape
+        src_bounds = array_bounds(src_height, src_width, src_transform)
+
+        # same grid gdalwarp would pick for the re-projection
+        dst_transform, width, height = calculate_default_transform(
+            src_crs, epsg, src_width, src_height, *src_bounds)
+        dst_array = np.zeros((bands, height, width), dtype=np.uint8)
+        reproject(src_array, dst_array,
+                  src_transform=src_transform, src_crs=src_crs,
+                  dst_transform=dst_transform, dst_crs=epsg,
+                  resampling=Resampling.nearest)
+        logger.info(f'\nwarped map shape: {dst_array.shape}')
+        self.metrics.count('pixels_warped', width * height)
+        return dst_array, dst_transform
+
+    def map_grid(self, extents, epsg):
+        '''Work out the grid render_map would warp the extents to, without
+           reading any pixels.
+
+        Parameters
+        ----------
+        extents : list
+            a list with the bounding box coordinates in the format, 
+                [upper left x, upper left y, lower right x, lower right y]
+        epsg : str
+            the epsg code of the desired re-projection (ex. 'EPSG:2610')
+
+        Returns
+        ----------
+        tuple
+            the (transform, height, width, crs, bands) of the source clip
+        tuple
+            the (transform, height, width) of the warped map
+        '''
+        import rasterio
+        from rasterio import windows
+        from rasterio.transform import array_bounds
+        from rasterio.warp import calculate_default_transform
+
+        ulx, uly, lrx, lry = extents
+        with self.open_source() as src:
+            window = windows.from_bounds(ulx, lry, lrx, uly,
+                                         transform=src.transform)
+            window = window.round_offsets().round_lengths()
+            window = window.intersection(windows.Window(0, 0, src.width, src.height))
+            src_transform = src.window_transform(window)
+            src_crs = src.crs or rasterio.crs.CRS.from_epsg(4326)
+            bands = src.count
+        src_height, src_width = int(window.height), int(window.width)
+        src_bounds = array_bounds(src_height, src_width, src_transform)
+        dst_transform, width, height = calculate_default_transform(
+            src_crs, epsg, src_width, src_height, *src_bounds)
+        return ((src_transform, src_height, src_width, src_crs, bands),
+                (dst_transform, height, width))
+
+    @stage('warp_chunked')
+    def render_map_chunked(self, extents, epsg, dst_file, chunk=None):
+        '''Same map as render_map, but warped one chunk at a time straight
+           into a tiled GeoTIFF. Each chunk fetches only the source pixels
+           it needs, so memory is bounded by the chunk size.
+
+        Parameters
+        ----------
+        extents : list
+            a list with the bounding box coordinates in the format, 
+                [upper left x, upper left y, lower right x, lower right y]
+        epsg : str
+            the epsg code of the desired re-projection (ex. 'EPSG:2610')
+        dst_file : str
+            the file location of the GeoTIFF to write
+        chunk : int
+            the side in pixels of the chunks, defaults to self.chunk
+
+        Returns
+        ----------
+        affine.Affine
+            the transform from pixel to epsg coordinates of the map
+        tuple
+            the (height, width, bands) of the map
+        '''
+        import rasterio
+        from rasterio import windows
+
+        chunk = chunk or self.chunk
+        grid = self.map_grid(extents, epsg)
+        (_, _, _, _, bands), (dst_transform, height, width) = grid
+        with rasterio.open(dst_file, 'w', driver='GTiff', width=width,
+                           height=height, count=bands, dtype='uint8',
+                           crs=epsg, transform=dst_transform, tiled=True,
+                           blockxsize=512, blockysize=512, compress='DEFLATE',
+                           ZLEVEL=1, BIGTIFF='IF_SAFER') as dst:
+            for row in range(0, height, chunk):
+                for col in range(0, width, chunk):
+                    window = windows.Window(col, row, min(chunk, width - col),
+                                            min(chunk, height - row))
+                    dst.write(self.warp_window(window, grid, epsg), window=window)
+        logger.info(f'\nchunked map shape: {(bands, height, width)}')
+        return dst_transform, (height, width, bands)
+
+    def warp_window(self, window, grid, epsg):
+        '''Warp one window of the map, fetching only the source pixels under
+           it, so a map of any size can be warped a piece at a time.
+
+        Parameters
+        ----------
+        window : rasterio.windows.Window
+            the pixel window of the map to warp, inside the map
+        grid : tuple
+            the source clip and map grid, see map_grid
+        epsg : str
+            the epsg code of the map projection (ex. 'EPSG:2610')
+
+        Returns
+        ----------
+        np.ndarray
+            the window as a (bands, rows, cols) array of bytes
+        '''
+        import numpy as np
+        from rasterio import windows
+        from rasterio.warp import Resampling, reproject, transform_bounds
+
+        (clip_transform, clip_height, clip_width, src_crs, bands), (dst_transform, _, _) = grid
+        # source pixels under the window, one wider so edge pixels have
+        # their nearest neighbour, kept to the clip
+        left, bottom, right, top = transform_bounds(
+            epsg, src_crs, *windows.bounds(window, dst_transform), densify_pts=21)
+        src_window = windows.from_bounds(left, bottom, right, top,
+                                         transform=clip_transform)
+        col0 = max(int(np.floor(src_window.col_off)) - 1, 0)
+        row0 = max(int(np.floor(src_window.row_off)) - 1, 0)
+        col1 = min(int(np.ceil(src_window.col_off + src_window.width)) + 1, clip_width)
+        row1 = min(int(np.ceil(src_window.row_off + src_window.height)) + 1, clip_height)
+        # shifted a quarter pixel so read_source rounds to exactly these
+        # pixels whatever the float error
+        ulx, uly = clip_transform * (col0 + 0.25, row0 + 0.25)
+        lrx, lry = clip_transform * (col1 + 0.25, row1 + 0.25)
+        src_array, src_transform, _ = self.read_source([ulx, uly, lrx, lry])
+        dst_array = np.zeros((bands, int(window.height), int(window.width)), dtype=np.uint8)
+        reproject(src_array, dst_array,
+                  src_transform=src_transform, src_crs=src_crs,
+                  dst_transform=windows.transform(window, dst_transform),
+                  dst_crs=epsg, resampling=Resampling.nearest)
+        self.metrics.count('pixels_warped', dst_array.shape[1] * dst_array.shape[2])
+        return dst_array
+
+    @stage('png_encode')
+    def write_png(self, array, transform, epsg, dst_file):
+        '''Encode a map array as a png, the georeference is written to a
+           .aux.xml sidecar file next to it.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            the map as a (bands, rows, cols) array of bytes
+        transform : affine.Affine
+            the transform from pixel to epsg coordinates of the map
+        epsg : str
+            the epsg code of the map projection (ex. 'EPSG:2610')
+        dst_file : str
+            the file location of the destination map
+        '''
+        import rasterio
+
+        bands, height, width = array.shape
+        with rasterio.open(dst_file, 'w', driver='PNG',
+                           width=width, height=height, count=bands,
+                           dtype='uint8', crs=epsg, transform=transform,
+                           ZLEVEL=1) as dst:
+            dst.write(array)
+        return
 
     def get_png_size(self, f_name):
-        with Image.open(f_name) as img:
-            im = np.array(img)
-            logging.info(f'\nimage shape: {im.shape}')
-        return im.shape
+        '''Get the (height, width, bands) of an image from its header.'''
+        from raster_meta import read_meta
+
+        shape = read_meta(f_name).shape
+        logger.info(f'\nimage shape: {shape}')
+        return shape
 
     def png_print(self, png_dst_file,label_file):
         ''' display a png file with labels
@@ -288,6 +614,10 @@ class mapRetrieve():
         label_file : str
             a file location of the associated label file
         '''
+        # the only place matplotlib is needed
+        import matplotlib.pyplot as plt
+        from PIL import Image
+
         with open(label_file) as json_file:
             labels = json.load(json_file)
 
@@ -316,80 +646,120 @@ class mapRetrieve():
         return
 
 
-    def shape_to_voc(self, png_dst_file, shapes, transform, f_name, verbose=False):
-        '''
+    @stage('shape_to_voc')
+    def shape_to_voc(self, png_dst_file, shapes, transform, f_name,
+                     verbose=False, min_height=10, border=50, img_size=None):
+        '''Write a VOC label file with a box for every tree polygon taller
+           than min_height that lies inside the map away from its border.
+
         Parameters
         ----------
-        shape : shapefile.Shape
-            a shape object containing polygons 
+        png_dst_file : str
+            the file location of the map png the labels belong to
+        shapes : shapeStream
+            a shape reader containing tree polygons with a max_h field
+        transform : affine.Affine
+            the transform from pixel to shape coordinates of the map
+        f_name : str
+            the file location to save the VOC xml to
+        verbose : bool
+            print a summary of how many boxes were kept and dropped
+        min_height : float
+            only trees taller than this are labeled
+        border : int
+            boxes within this many pixels of the map edge are dropped
+        img_size : tuple
+            the (height, width, bands) of the map, read from the png
+            header when not given
 
+        Returns
+        ----------
+        boxStore
+            the pixel boxes written and the height of their trees
         '''
-        img_size = self.get_png_size(png_dst_file)
-        img_width = img_size[1]
-        img_height = img_size[0]
-        writer = Writer(png_dst_file, img_width, img_height)
-
-        x_offset = 0
-        y_offset = 0
-        x_scale = 1
-        y_scale = 1
-        if not isinstance(transform, str):
-            x_scale = transform.a
-            y_scale = transform.e
-            x_offset = transform.c
-            y_offset = transform.f
-        else:
-            print("SOMETHING WENT WRONG WITH TRANSFORM OBJECT")
+        if img_size is None:
+            img_size = self.get_png_size(png_dst_file)
+        boxes, counts = self.shape_boxes(shapes, transform, img_size,
+                                         min_height=min_height, border=border)
+        boxes.images = [os.path.abspath(png_dst_file)]
+        with open(f_name, 'w') as f:
+            f.write(boxes.voc_text())
+
+        summary = f'\n{f_name}: {counts["shapes"]} shapes, ' \
+                  f'{counts["short"]} under {min_height}, ' \
+                  f'{counts["border"]} on the border, ' \
+                  f'{len(boxes)} labels written'
+        if verbose:
             print(transform)
-            exit()
-        json_file = {'content': f_name, 'annotation': []}
-        for shape in shapes.shapeRecords():
-            minx, maxy, maxx, miny = shape.shape.bbox
-            height = shape.record.max_h
-            # only get bboxses for trees greater than 30 ft(?) -> Trying 10ft
-            # also added crop to the data points so that we don't get those on the black boarder
-            if verbose:
-                print(transform)
-                print("X offset")
-                print(x_offset)
-                print("y offset")
-                print(y_offset)
-                print("X scale")
-                print(x_scale)
-                print("Y scale")
-                print(y_scale)
-                print("Shape bounds")
-                print("Raw X")
-                print(minx)
-                print(maxx)
-                print("Raw Y")
-                print(miny)
-                print(maxy)
-            if height and height > 10:
-                x_min = int((minx - x_offset) / x_scale)
-                x_max = int((maxx - x_offset) / x_scale)
-                y_min = int((miny - y_offset) / y_scale)
-                y_max = int((maxy - y_offset) / y_scale)
-                # ::addObject(name, xmin, ymin, xmax, ymax)
-                if verbose:
-                    print("Image Data:")
-                    print(img_height)
-                    print(img_width)
-                    print("X data")
-                    print(x_min)
-                    print(x_max)
-                    print("Y data")
-                    print(y_min)
-                    print(y_max)
-                if x_min > 50 and y_min > 50 and x_max < (img_width - 50) and y_max < (img_height - 50):
-                    writer.addObject('tree', x_max, y_min, x_min, y_max)
-
-            # ::save(path)
-        writer.save(f_name)
-        return
+            print(summary)
+        logger.info(summary)
+        self.metrics.count('labels_emitted', len(boxes))
+        return boxes
+
+    def shape_boxes(self, shapes, transform, img_size, min_height=10, border=50):
+        '''Get the pixel boxes of every tree polygon taller than min_height
+           that lies inside the map away from its border. All records are
+           transformed and filtered at once with numpy.
 
+        Parameters
+        ----------
+        shapes : shapeStream
+            a shape reader containing tree polygons with a max_h field,
+            a shp.Reader also works but reads every shape
+        transform : affine.Affine
+            the transform from pixel to shape coordinates of the map
+        img_size : tuple
+            the (height, width, bands) of the map
+        min_height, border
+            see shape_to_voc
 
-    def save_map(self, zf, validate=False):
+        Returns
+        ----------
+        boxStore
+            the pixel boxes as [x_min, y_min, x_max, y_max], truncated to
+            whole pixels, and the height of their trees
+        dict
+            the number of shapes read and dropped as short or on the border
+        '''
+        import numpy as np
+        from box_store import boxStore
+        from shape_stream import shapeStream
+
+        if isinstance(transform, str):
+            raise TypeError(f'Expected an affine transform, got {transform}')
+
+        if isinstance(shapes, shapeStream):
+            # heights come from the dbf alone, only the bboxes of trees
+            # tall enough are read from the shp
+            heights = shapes.field('max_h')
+            tall_index = np.flatnonzero(heights > min_height)
+            bboxes = shapes.bboxes(tall_index)
+        else:
+            # pull every bbox and height into arrays, null heights become nan
+            heights = np.array([record[0] for record in
+                                shapes.iterRecords(fields=['max_h'])],
+                               dtype=float)
+            tall_index = np.flatnonzero(heights > min_height)
+            bboxes = np.array([shape.bbox for shape in shapes.iterShapes()],
+                              dtype=float).reshape(-1, 4)[tall_index]
+        # null shapes have no bbox and are dropped like short trees
+        valid = ~np.isnan(bboxes).any(axis=1)
+        tall = boxStore(bboxes[valid], heights=heights[tall_index[valid]],
+                        images=[''], sizes=[(img_size[1], img_size[0], img_size[2])])
+
+        # shape bboxes are [minx, miny, maxx, maxy] in map coordinates, the
+        # y axis flips in pixel space and the store keeps min and max in order.
+        # only get bboxses for trees greater than 30 ft(?) -> Trying 10ft
+        # also crop to the data points so that we don't get those on the black boarder
+        boxes = tall.transform(transform, inverse=True).trunc().filter(border=border)
+        counts = {'shapes': len(heights),
+                  'short': len(heights) - len(tall),
+                  'border': len(tall) - len(boxes)}
+        return boxes, counts
+
+    @stage('save_map')
+    def save_map(self, zf, validate=False, min_height=10, border=50,
+                 previous=None):
         '''From a given shape file, retrieve a hig-res map from a server
         source with same extents of the and save it locally to ./maps/   
 
@@ -397,28 +767,241 @@ class mapRetrieve():
         ----------
         zf : zipfile.ZipFile
             a zip file containing an ESRI shape object
+        min_height, border
+            the label filters, see shape_to_voc
+        previous : dict
+            the build returned by the last save_map of this zip. The map is
+            only fetched again when its extents or source changed, and the
+            labels only written again when the shapes, the map or the label
+            filters changed
+
+        Maps over max_pixels are written as a tiled .tif instead of a png,
+        see render_map_chunked.
 
         Returns
         ----------
-        rc
-            the return code from the subprocess call
-
+        dict
+            the build, the fingerprints of the map and labels and the files
+            written, to be passed back as previous on the next run
         '''
 
+        from affine import Affine
+
         # shape_name = zf.split('/')[-1].split('.')[0]
         shape_name = re.split(r'/|\\+', zf)[-1].split('.')[0]
+        previous = previous or {}
         shape, proj4, epsg = self.load_shape(zf)
-        extents, _ = self.get_bounds(shape, proj4)
+        extents, _ = self.get_bounds(shape, proj4, epsg)
         dst_file = os.path.join(self.out_folder,f'{shape_name}')
-        self.get_map(extents, dst_file=self.temp_map)
-        self.warp_map(src_file=self.temp_map, dst_file=dst_file+'temp.tif', epsg=epsg)
-        self.png_map(src_file=dst_file+'temp.tif', dst_file=dst_file+'.png')
-
-        src = rasterio.open(dst_file+'.png')
         label_file = os.path.join(self.label_folder,f'{shape_name}.xml')
-        self.shape_to_voc(dst_file+'.png', shape, src.transform, label_file)
+
+        # the map depends on where it is and where it comes from, the labels
+        # on the shapes, the map grid and the filters
+        map_fp = fingerprint(source_fingerprint(self.src_file), epsg, extents,
+                             self.max_pixels)
+        label_fp = fingerprint(zip_fingerprint(zf), map_fp, min_height, border)
+        build = {'map': map_fp, 'labels': label_fp, 'label_file': label_file,
+                 'rebuilt': []}
+
+        if previous.get('map') == map_fp and os.path.exists(previous.get('map_file', '')):
+            logger.info(f'\n{shape_name} map is up to date')
+            self.metrics.count('maps_reused')
+            map_file = previous['map_file']
+            transform = Affine.from_gdal(*previous['transform'])
+            img_size = tuple(previous['img_size'])
+        else:
+            _, (_, height, width) = self.map_grid(extents, epsg)
+            if height * width > self.max_pixels:
+                # too big to hold, warp chunk by chunk into a tiled GeoTIFF
+                map_file = dst_file + '.tif'
+                transform, img_size = self.render_map_chunked(extents, epsg, map_file)
+            else:
+                # clip, warp and encode in process, nothing but the png hits disk
+                map_file = dst_file + '.png'
+                array, transform = self.render_map(extents, epsg)
+                self.write_png(array, transform, epsg, map_file)
+                bands, height, width = array.shape
+                img_size = (height, width, bands)
+            build['rebuilt'].append('map')
+        build.update(map_file=map_file, transform=list(transform.to_gdal()),
+                     img_size=list(img_size))
+
+        if previous.get('labels') == label_fp and os.path.exists(label_file):
+            logger.info(f'\n{shape_name} labels are up to date')
+            self.metrics.count('labels_reused')
+        else:
+            self.shape_to_voc(map_file, shape, transform, label_file,
+                              min_height=min_height, border=border,
+                              img_size=img_size)
+            build['rebuilt'].append('labels')
 
         if validate:
             self.png_print(png_dst_file=dst_file+'.png', 
                            label_file=os.path.join(self.label_folder,shape_name+'.js'))
-        return
+        return build
+
+    @stage('save_labels')
+    def save_labels(self, zf, min_height=10, border=50):
+        '''Write the labels of a shape file again against its map already
+        saved in out_folder by save_map, without fetching any imagery.
+
+        Parameters
+        ----------
+        zf : zipfile.ZipFile
+            a zip file containing an ESRI shape object
+        min_height, border
+            the label filters, see shape_to_voc
+
+        Returns
+        ----------
+        boxStore
+            the pixel boxes written, see shape_to_voc
+        '''
+        import rasterio
+
+        shape_name = re.split(r'/|\\+', zf)[-1].split('.')[0]
+        map_file = os.path.join(self.out_folder, f'{shape_name}.png')
+        if not os.path.exists(map_file):
+            # large maps are saved as a tiled GeoTIFF
+            map_file = os.path.join(self.out_folder, f'{shape_name}.tif')
+        # the png georeference is in its .aux.xml sidecar
+        with rasterio.open(map_file) as src:
+            transform = src.transform
+            img_size = (src.height, src.width, src.count)
+        shape, _, _ = self.load_shape(zf)
+        label_file = os.path.join(self.label_folder, f'{shape_name}.xml')
+        return self.shape_to_voc(map_file, shape, transform, label_file,
+                                 min_height=min_height, border=border,
+                                 img_size=img_size)
+
+    @stage('save_tiles')
+    def save_tiles(self, zf, height=512, width=512, overlap=0, pad=False,
+                   min_height=10, border=50, workers=4):
+        '''From a given shape file, retrieve a hig-res map and write it
+        straight out as training tiles with one VOC label file per tile.
+        The full size map only lives in memory, it is never written as a
+        png and decoded again by ImageTiles. Maps over max_pixels are never
+        held at all, each tile is warped from the source on its own, see
+        warp_window.
+
+        Parameters
+        ----------
+        zf : zipfile.ZipFile
+            a zip file containing an ESRI shape object
+        height, width, overlap, pad
+            the tile layout, see image_cropper.crop
+        min_height, border
+            the label filters, see shape_to_voc
+        workers : int
+            the number of threads encoding tiles
+
+        Returns
+        ----------
+        dict
+            the bounds in the full map of every tile png written
+        '''
+        from rasterio.windows import Window
+
+        shape_name = re.split(r'/|\\+', zf)[-1].split('.')[0]
+        shape, proj4, epsg = self.load_shape(zf)
+        extents, _ = self.get_bounds(shape, proj4, epsg)
+        grid = self.map_grid(extents, epsg)
+        (_, _, _, _, bands), (transform, img_height, img_width) = grid
+        if img_height * img_width <= self.max_pixels:
+            array, transform = self.render_map(extents, epsg)
+            bands, img_height, img_width = array.shape
+            boxes, _ = self.shape_boxes(shape, transform,
+                                        (img_height, img_width, bands),
+                                        min_height=min_height, border=border)
+            return self.write_tiles(array, boxes, shape_name, height=height,
+                                    width=width, overlap=overlap, pad=pad,
+                                    workers=workers)
+
+        # too big to hold, every tile is warped on its own straight from
+        # the source, no full size mosaic is ever written or read back
+        img_size = (img_height, img_width, bands)
+        boxes, _ = self.shape_boxes(shape, transform, img_size,
+                                    min_height=min_height, border=border)
+
+        def warp_piece(x0, y0, x1, y1):
+            return self.warp_window(Window(x0, y0, x1 - x0, y1 - y0), grid, epsg)
+        return self.write_tiles(warp_piece, boxes, shape_name, height=height,
+                                width=width, overlap=overlap, pad=pad,
+                                workers=workers, img_size=img_size)
+
+    @stage('write_tiles')
+    def write_tiles(self, array, boxes, shape_name, height=512, width=512,
+                    overlap=0, pad=False, workers=4, img_size=None):
+        '''Cut a map array into tile pngs in out_folder and write a VOC
+        label file to label_folder for every tile holding a box. Tiles are
+        copied out one at a time and at most 2 * workers wait to be
+        encoded, as in image_cropper.crop, so memory stays flat.
+
+        Parameters
+        ----------
+        array : np.ndarray
+            the map as a (bands, rows, cols) array of bytes, or a function
+            giving the (x0, y0, x1, y1) pixel window of the map as one
+        boxes : boxStore
+            the pixel boxes of the map, see shape_boxes
+        shape_name : str
+            the name tile files are numbered after
+        height, width, overlap, pad, workers
+            see save_tiles
+        img_size : tuple
+            the (height, width, bands) of the map when array is a function
+
+        Returns
+        ----------
+        dict
+            the bounds in the full map of every tile png written
+        '''
+        import numpy as np
+        from ImageTiles import image_cropper, voc_tiler
+
+        if callable(array):
+            img_height, img_width, bands = img_size
+
+            def read_piece(x0, y0, x1, y1):
+                # padded tiles run off the map
+                return array(x0, y0, min(x1, img_width), min(y1, img_height))
+        else:
+            bands, img_height, img_width = array.shape
+
+            def read_piece(x0, y0, x1, y1):
+                return array[:, y0:y1, x0:x1]
+        tiles = image_cropper.tile_boxes(img_width, img_height, height, width,
+                                         overlap=overlap, pad=pad)
+        tile_index, box_index = voc_tiler.assign_boxes(
+            boxes.boxes, img_width, img_height, height, width, overlap, pad)
+        origin = np.array([tile[:2] for tile in tiles],
+                          dtype=float).reshape(-1, 2)
+        png_files = [os.path.join(self.out_folder, f'{shape_name}-{k}.png')
+                     for k in range(len(tiles))]
+        # every (tile, box) pair becomes a box of the tile, clipped to it
+        tile_boxes = boxes[box_index].regroup(
+            tile_index, [os.path.abspath(f) for f in png_files],
+            [(width, height, bands)] * len(tiles))
+        tile_boxes = tile_boxes.translate(-origin[tile_index, 0], -origin[tile_index, 1])
+        tile_boxes = tile_boxes.clip(0, 0, width, height)
+
+        crop_boxes = dict()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pending = []
+            for png_file, (x0, y0, x1, y1) in zip(png_files, tiles):
+                # copy the tile out so edge tiles can be padded with black
+                tile = np.zeros((height, width, bands), dtype=np.uint8)
+                piece = read_piece(x0, y0, x1, y1)
+                tile[:piece.shape[1], :piece.shape[2]] = np.moveaxis(piece, 0, -1)
+                pending.append(pool.submit(image_cropper.save_tile, tile, png_file))
+                crop_boxes[png_file] = (x0, y0, x1, y1)
+                # bound the tiles waiting to be encoded so memory stays flat
+                if len(pending) >= 2 * workers:
+                    pending.pop(0).result()
+            tile_boxes.write_voc(self.label_folder, skip_empty=True)
+            for future in pending:
+                future.result()
+        logger.info(f'\n{len(tiles)} tiles written for {shape_name}')
+        self.metrics.count('tiles_written', len(tiles))
+        self.metrics.count('labels_emitted', len(tile_boxes))
+        return crop_boxes
@@ -0,0 +1,262 @@
+# runs mapRetrieve.save_map over many zipped shapes on a process pool and
+# keeps a ledger of finished zips so an interrupted batch can be resumed.
+# The ledger also records what every map was built from, so a rerun only
+# rebuilds the zips whose inputs changed
+
+import json
+import logging
+import os
+import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from zipfile import BadZipFile
+
+from build_manifest import inputs_fingerprint
+from MapRetrieve import SRC_FILE, mapRetrieve
+from metrics import pipelineMetrics
+
+
+class jobLedger():
+    '''An append-only json lines file recording the status of every zip.
+
+    Each status change is appended as one line, the last line for a zip
+    wins when the ledger is read back. Done zips carry the build returned by
+    save_map, with the fingerprint of its inputs.
+    '''
+
+    DONE = 'done'
+    FAILED = 'failed'
+    IN_PROGRESS = 'in_progress'
+
+    def __init__(self, ledger_file):
+        self.ledger_file = ledger_file
+        self.jobs = dict()
+        if os.path.exists(self.ledger_file):
+            with open(self.ledger_file) as f:
+                for line in f:
+                    # a crash mid-write can leave a partial last line
+                    try:
+                        job = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.jobs[self.key(job['zip'])] = job
+
+    @staticmethod
+    def key(zf):
+        # zips are keyed by absolute path, zips of the same name in
+        # different folders are different jobs
+        return os.path.abspath(zf)
+
+    def status(self, zf):
+        '''Return the recorded status of a zip or None if it was never run.'''
+        job = self.jobs.get(self.key(zf))
+        return job['status'] if job else None
+
+    def build(self, zf):
+        '''Return the last build of a zip, or None unless it is done.'''
+        job = self.jobs.get(self.key(zf))
+        return job.get('build') if job and job['status'] == self.DONE else None
+
+    def mark(self, zf, status, error=None, build=None):
+        '''Record the status of a zip and append it to the ledger file.'''
+        # the absolute path so the ledger reads back the same from any folder
+        job = {'zip': self.key(zf), 'status': status, 'error': error}
+        if build is not None:
+            job['build'] = build
+        self.jobs[self.key(zf)] = job
+        with open(self.ledger_file, 'a') as f:
+            f.write(json.dumps(job) + '\n')
+
+    def pending(self, zip_files, retry_failed=True, inputs=None):
+        '''Filter zip_files down to those that still need to be run.
+
+        Zips left in progress by a crashed run are always run again. When
+        inputs maps zips to their inputs fingerprint, done zips whose
+        inputs changed since their build are run again too.
+        '''
+        skip = {self.DONE} if retry_failed else {self.DONE, self.FAILED}
+        todo = []
+        for zf in zip_files:
+            status = self.status(zf)
+            if status == self.DONE and inputs is not None:
+                build = self.build(zf) or {}
+                if build.get('inputs') is None or build['inputs'] != inputs.get(zf):
+                    status = None
+            if status not in skip:
+                todo.append(zf)
+        return todo
+
+    def summary(self):
+        counts = {self.DONE: 0, self.FAILED: 0, self.IN_PROGRESS: 0}
+        for job in self.jobs.values():
+            counts[job['status']] += 1
+        return counts
+
+
+# every worker process builds its own mapRetrieve once and reuses it
+_worker_mr = None
+
+
+def _init_worker(mr_kwargs):
+    global _worker_mr
+    _worker_mr = mapRetrieve(**mr_kwargs)
+
+
+def _run_job(zf, params, previous):
+    # the metrics of each job go back with its result and are reset, so
+    # the parent adds every job exactly once
+    try:
+        build = _worker_mr.save_map(zf, previous=previous, **params)
+        error = None
+    except Exception:
+        build, error = None, traceback.format_exc()
+    snapshot = _worker_mr.metrics.snapshot()
+    _worker_mr.metrics.reset()
+    return zf, error, snapshot, build
+
+
+def _output_name(zf):
+    # save_map names the map and labels after the zip file alone
+    return re.split(r'/|\\+', zf)[-1].split('.')[0]
+
+
+def _inputs(zf, src_file, max_pixels, params):
+    # an unreadable zip has no fingerprint, it is run and fails in a worker
+    try:
+        return inputs_fingerprint(zf, src_file, max_pixels, params)
+    except (OSError, BadZipFile):
+        return None
+
+
+class batchRetrieve():
+    def __init__(self, in_folder='data', out_folder='maps',
+                 label_folder='labels', workers=None, ledger_file=None,
+                 log=False, metrics_file=None, src_file=None,
+                 max_pixels=8192*8192, min_height=10, border=50,
+                 fetch_workers=8, fetch_rate=20):
+        '''Run save_map for many zip files in parallel. A zip is only run
+        again when it, the imagery source or the label parameters changed,
+        and then only the map or labels that depend on the change are
+        rebuilt.
+
+        Parameters
+        ----------
+        in_folder, out_folder, label_folder, log, src_file, max_pixels
+            passed on to the mapRetrieve object of each worker
+        workers : int
+            the number of worker processes, defaults to the cpu count
+        ledger_file : str
+            the json lines file tracking per-zip status, defaults to
+            ledger.jsonl inside out_folder
+        metrics_file : str
+            where the stage timings and counters of all workers are
+            exported, rewritten after every zip when it ends in .prom
+            (a Prometheus textfile), appended once per run otherwise
+        min_height, border
+            the label filters, see mapRetrieve.shape_to_voc
+        fetch_workers : int
+            the tiles each worker downloads at a time from a MapServer source
+        fetch_rate : float
+            the most requests per second sent to a MapServer host by the
+            whole batch, None for no limit. Rate limits only hold within a
+            process, so every worker gets an even share of it
+        '''
+        self.workers = workers or os.cpu_count()
+        self.mr_kwargs = dict(in_folder=in_folder, out_folder=out_folder,
+                              label_folder=label_folder, log=log,
+                              src_file=src_file or SRC_FILE, max_pixels=max_pixels,
+                              fetch_workers=fetch_workers,
+                              fetch_rate=fetch_rate / self.workers if fetch_rate else None)
+        self.params = dict(min_height=min_height, border=border)
+        os.makedirs(out_folder, exist_ok=True)
+        os.makedirs(label_folder, exist_ok=True)
+        if ledger_file is None:
+            ledger_file = os.path.join(out_folder, 'ledger.jsonl')
+        self.ledger = jobLedger(ledger_file)
+        self.metrics = pipelineMetrics()
+        self.metrics_file = metrics_file
+
+    def refuse_clashes(self, zip_files):
+        '''Maps and labels are named after the zip file alone, so zips of
+        the same name in different folders would overwrite each other.
+        The first zip to claim a name keeps it, a zip already in the ledger
+        first (unless it failed or no longer exists), and every other zip
+        of that name is marked failed without being run.
+
+        Returns
+        ----------
+        list
+            the zip files left to run
+        '''
+        owners = dict()
+        for job in self.ledger.jobs.values():
+            if job['status'] != jobLedger.FAILED and os.path.exists(job['zip']):
+                owners.setdefault(_output_name(job['zip']), job['zip'])
+        keep = []
+        for zf in zip_files:
+            name = _output_name(zf)
+            owner = owners.setdefault(name, jobLedger.key(zf))
+            if owner == jobLedger.key(zf):
+                keep.append(zf)
+                continue
+            error = f'{name} is already written by {owner}'
+            logging.warning(f'\n{zf} skipped: {error}')
+            self.ledger.mark(zf, jobLedger.FAILED, error=error)
+            self.metrics.count('zips_failed')
+        return keep
+
+    def run(self, zip_files, retry_failed=True):
+        '''Run save_map over every zip not yet marked done in the ledger,
+        or done but with inputs that changed since. Zips whose output name
+        another zip already holds are not run, see refuse_clashes.
+
+        Parameters
+        ----------
+        zip_files : list
+            the zip files to process
+        retry_failed : bool
+            whether zips that failed in an earlier run are tried again
+
+        Returns
+        ----------
+        dict
+            the number of zips done, failed and still in progress
+        '''
+        zip_files = self.refuse_clashes(zip_files)
+        # only the central directory of each zip is read to fingerprint it
+        inputs = {zf: _inputs(zf, self.mr_kwargs['src_file'],
+                              self.mr_kwargs['max_pixels'], self.params)
+                  for zf in zip_files}
+        todo = self.ledger.pending(zip_files, retry_failed=retry_failed,
+                                   inputs=inputs)
+        logging.info(f'\n{len(todo)} of {len(zip_files)} zips to process')
+        self.metrics.count('zips_skipped', len(zip_files) - len(todo))
+        if not todo:
+            return self.ledger.summary()
+
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=_init_worker,
+                                 initargs=(self.mr_kwargs,)) as pool:
+            futures = []
+            for zf in todo:
+                # read the last build before it is marked in progress
+                previous = self.ledger.build(zf)
+                self.ledger.mark(zf, jobLedger.IN_PROGRESS)
+                futures.append(pool.submit(_run_job, zf, self.params, previous))
+            for future in as_completed(futures):
+                zf, error, snapshot, build = future.result()
+                self.metrics.merge(snapshot)
+                if error:
+                    logging.warning(f'\n{zf} failed:\n {error}')
+                    self.ledger.mark(zf, jobLedger.FAILED, error=error)
+                    self.metrics.count('zips_failed')
+                else:
+                    logging.info(f'\n{zf} done, rebuilt {build["rebuilt"]}')
+                    build['inputs'] = inputs[zf]
+                    self.ledger.mark(zf, jobLedger.DONE, build=build)
+                    self.metrics.count('zips_done')
+                if self.metrics_file and self.metrics_file.endswith('.prom'):
+                    self.metrics.export(self.metrics_file)
+        if self.metrics_file and not self.metrics_file.endswith('.prom'):
+            self.metrics.export(self.metrics_file)
+        return self.ledger.summary()
@@ -0,0 +1,136 @@
+from batch_retrieve import batchRetrieve, jobLedger
+from benchmark import make_sample, SAMPLE_NAME
+from zipfile import ZipFile
+import unittest
+import tempfile
+import json
+import os
+
+
+class TestIncrementalBatch(unittest.TestCase):
+    """
+    Testing batchRetrieve only rebuilds the zips, maps and labels whose
+    inputs changed
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.in_folder = os.path.join(self.temp_dir.name, 'data')
+        self.zip_file, self.src_file = make_sample(self.in_folder, n_shapes=200, src_pixels=512)
+        self.kwargs = dict(in_folder=self.in_folder,
+                           out_folder=os.path.join(self.temp_dir.name, 'maps'),
+                           label_folder=os.path.join(self.temp_dir.name, 'labels'),
+                           workers=1, src_file=self.src_file)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def run_batch(self, **kwargs):
+        br = batchRetrieve(**self.kwargs, **kwargs)
+        br.run([self.zip_file])
+        return br.ledger.build(self.zip_file), br.metrics.snapshot()['counters']
+
+    def test_rebuilds(self):
+        build, counters = self.run_batch()
+        self.assertEqual(build['rebuilt'], ['map', 'labels'])
+        self.assertTrue(os.path.exists(build['map_file']))
+        label_file = build['label_file']
+        with open(label_file) as f:
+            labels = f.read()
+
+        # nothing changed, the zip is not even run
+        rerun, counters = self.run_batch()
+        self.assertEqual(counters['zips_skipped'], 1)
+        self.assertEqual(rerun, build)
+
+        # new thresholds only rewrite the labels
+        rerun, _ = self.run_batch(min_height=40)
+        self.assertEqual(rerun['rebuilt'], ['labels'])
+        self.assertEqual(rerun['map'], build['map'])
+        with open(label_file) as f:
+            self.assertLess(f.read().count('<object>'), labels.count('<object>'))
+
+        # an updated zip with the same extents keeps its map
+        with ZipFile(self.zip_file, 'a') as zf:
+            zf.writestr('notes.txt', 'resurveyed')
+        rerun, counters = self.run_batch(min_height=40)
+        self.assertEqual(rerun['rebuilt'], ['labels'])
+        self.assertEqual(counters['maps_reused'], 1)
+
+        # new imagery refetches the map
+        stat = os.stat(self.src_file)
+        os.utime(self.src_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        rerun, _ = self.run_batch(min_height=40)
+        self.assertEqual(rerun['rebuilt'], ['map', 'labels'])
+
+        # the ledger reads the builds back
+        with open(os.path.join(self.kwargs['out_folder'], 'ledger.jsonl')) as f:
+            jobs = [json.loads(line) for line in f]
+        self.assertEqual(jobs[-1]['build'], rerun)
+        self.assertEqual(os.path.basename(rerun['map_file']), SAMPLE_NAME + '.png')
+
+    def test_same_name_zips(self):
+        # a second survey of the same name in another folder
+        other_zip, _ = make_sample(os.path.join(self.temp_dir.name, 'resurvey'),
+                                   n_shapes=50, src_pixels=64, seed=1)
+        br = batchRetrieve(**dict(self.kwargs, workers=2))
+        summary = br.run([self.zip_file, other_zip])
+        self.assertEqual(summary, {'done': 1, 'failed': 1, 'in_progress': 0})
+        self.assertIsNotNone(br.ledger.build(self.zip_file))
+        self.assertIn(SAMPLE_NAME, br.ledger.jobs[os.path.abspath(other_zip)]['error'])
+        with open(br.ledger.build(self.zip_file)['label_file']) as f:
+            self.assertEqual(f.read().count('<object>'),
+                             br.metrics.snapshot()['counters']['labels_emitted'])
+
+        # the name stays with the zip that wrote it, in any order
+        br = batchRetrieve(**dict(self.kwargs, workers=2))
+        summary = br.run([other_zip, self.zip_file])
+        self.assertEqual(summary, {'done': 1, 'failed': 1, 'in_progress': 0})
+        self.assertEqual(br.metrics.snapshot()['counters']['zips_skipped'], 1)
+
+        # once the first zip is gone the other can take its name
+        os.remove(self.zip_file)
+        br = batchRetrieve(**dict(self.kwargs, workers=2))
+        br.run([other_zip])
+        self.assertEqual(br.ledger.status(other_zip), 'done')
+
+    def test_fetch_rate(self):
+        from MapRetrieve import mapRetrieve
+
+        # the host rate is shared out between the worker processes
+        br = batchRetrieve(**dict(self.kwargs, workers=4), fetch_rate=20, fetch_workers=2)
+        mr = mapRetrieve(**br.mr_kwargs)
+        self.assertEqual((mr.fetch_rate, mr.fetch_workers), (5, 2))
+        br = batchRetrieve(**self.kwargs, fetch_rate=None)
+        self.assertIsNone(br.mr_kwargs['fetch_rate'])
+
+
+class TestJobLedger(unittest.TestCase):
+    """
+    Testing the ledger keeps zips of the same name apart
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.ledger_file = os.path.join(self.temp_dir.name, 'ledger.jsonl')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_same_name(self):
+        north = os.path.join(self.temp_dir.name, 'north', 'plot.zip')
+        south = os.path.join(self.temp_dir.name, 'south', 'plot.zip')
+        ledger = jobLedger(self.ledger_file)
+        ledger.mark(north, jobLedger.DONE, build={'map': 'a'})
+        ledger.mark(south, jobLedger.FAILED, error='bad zip')
+        self.assertEqual(ledger.pending([north, south]), [south])
+
+        # read back, relative paths find the same jobs
+        ledger = jobLedger(self.ledger_file)
+        self.assertEqual(ledger.summary(), {'done': 1, 'failed': 1, 'in_progress': 0})
+        self.assertEqual(ledger.build(os.path.relpath(north)), {'map': 'a'})
+        self.assertIsNone(ledger.build(south))
+        self.assertEqual(ledger.status(os.path.relpath(south)), jobLedger.FAILED)
+        self.assertEqual(ledger.pending([north, south], retry_failed=False), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
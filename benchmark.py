@@ -0,0 +1,382 @@
+# times every stage of the map to dataset pipeline against a synthetic
+# sample zip and a local stand-in imagery server, results are appended to
+# a json lines file so slow downs show up between runs
+
+import argparse
+import functools
+import io
+import json
+import multiprocessing
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile
+
+import numpy as np
+import rasterio
+import shapefile as shp
+from pyproj import Transformer
+
+from MapRetrieve import mapRetrieve
+
+SAMPLE_NAME = 'Sample2013_3992854N_12308761W'
+SAMPLE_EPSG = 'EPSG:26910'
+SAMPLE_PRJ = 'PROJCS["NAD_1983_UTM_Zone_10N",GEOGCS["GCS_North_American_1983",'\
+             'DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],'\
+             'PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],'\
+             'PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",500000.0],'\
+             'PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-123.0],'\
+             'PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],'\
+             'UNIT["Meter",1.0]]'
+# lower left corner of the sample plot in SAMPLE_EPSG meters
+SAMPLE_ORIGIN = (493000.0, 4420000.0)
+# stages of save_map, each maps to the mapRetrieve metrics span timed
+# for it, the time of a span excludes the spans nested in it
+STAGES = {'shape_load': 'load_shape',
+          'epsg_lookup': 'epsg_lookup',
+          'bounds': 'get_bounds',
+          'imagery_fetch': 'fetch',
+          'warp': 'warp',
+          'warp_chunked': 'warp_chunked',
+          'png_encode': 'png_encode',
+          'label_write': 'shape_to_voc'}
+
+
+def make_sample(folder, n_shapes=2000, size=1000.0, src_pixels=2048, seed=0):
+    '''Write a sample zip shaped like the CMS LiDAR tree shapes and a
+    source GeoTIFF of its area, both deterministic for a given seed.
+
+    Parameters
+    ----------
+    folder : str
+        the folder to write the zip and source to
+    n_shapes : int
+        the number of square tree polygons with a random max_h
+    size : float
+        the side of the plot in meters
+    src_pixels : int
+        the side in pixels of the source imagery, which covers the plot
+        with a margin of half its size on each side
+    seed : int
+        the random seed
+
+    Returns
+    ----------
+    str
+        the zip file
+    str
+        the source GeoTIFF
+    '''
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    x0, y0 = SAMPLE_ORIGIN
+    x = x0 + rng.uniform(0, size, n_shapes)
+    y = y0 + rng.uniform(0, size, n_shapes)
+    r = rng.uniform(1, 4, n_shapes)
+    heights = rng.uniform(0, 40, n_shapes)
+
+    shp_file, shx_file, dbf_file = io.BytesIO(), io.BytesIO(), io.BytesIO()
+    writer = shp.Writer(shp=shp_file, shx=shx_file, dbf=dbf_file, shapeType=shp.POLYGON)
+    writer.field('max_h', 'N', decimal=2)
+    for xi, yi, ri, hi in zip(x, y, r, heights):
+        writer.poly([[(xi - ri, yi - ri), (xi - ri, yi + ri), (xi + ri, yi + ri),
+                      (xi + ri, yi - ri), (xi - ri, yi - ri)]])
+        writer.record(round(float(hi), 2))
+    writer.close()
+    zip_file = os.path.join(folder, SAMPLE_NAME + '.zip')
+    with ZipFile(zip_file, 'w') as zf:
+        for ext, data in (('shp', shp_file), ('shx', shx_file), ('dbf', dbf_file)):
+            zf.writestr(f'{SAMPLE_NAME}.{ext}', data.getvalue())
+        zf.writestr(f'{SAMPLE_NAME}.prj', SAMPLE_PRJ)
+
+    to_lnglat = Transformer.from_crs(SAMPLE_EPSG, 'EPSG:4326', always_xy=True)
+    lng, lat = to_lnglat.transform([x0 - size / 2, x0 + size * 1.5],
+                                   [y0 - size / 2, y0 + size * 1.5])
+    transform = rasterio.transform.from_bounds(min(lng), min(lat), max(lng), max(lat),
+                                               src_pixels, src_pixels)
+    # coarse noise scaled up, so the source compresses like real imagery
+    coarse = rng.integers(0, 255, (3, src_pixels // 16, src_pixels // 16), dtype=np.uint8)
+    image = coarse.repeat(16, axis=1).repeat(16, axis=2)
+    src_file = os.path.join(folder, 'source.tif')
+    with rasterio.open(src_file, 'w', driver='GTiff', width=src_pixels, height=src_pixels,
+                       count=3, dtype='uint8', crs='EPSG:4326', transform=transform,
+                       tiled=True, blockxsize=256, blockysize=256,
+                       compress='deflate') as dst:
+        dst.write(image)
+    return zip_file, src_file
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler that answers byte range requests the way a map
+    server does, GDAL's /vsicurl/ reads only the blocks it needs
+    """
+    def do_GET(self):
+        byte_range = self.headers.get('Range')
+        if not byte_range or not byte_range.startswith('bytes='):
+            return super().do_GET()
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+        size = os.path.getsize(path)
+        start, _, end = byte_range[6:].split(',')[0].partition('-')
+        start = int(start) if start else max(size - int(end), 0)
+        end = min(int(end), size - 1) if end and start <= int(end) else size - 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.bytes_served.get_lock():
+            self.server.bytes_served.value += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(folder, ready, bytes_served):
+    handler = functools.partial(RangeRequestHandler, directory=folder)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.bytes_served = bytes_served
+    ready.send(server.server_port)
+    server.serve_forever()
+
+
+class imageryServer():
+    def __init__(self, folder):
+        '''Serve a folder over http on a free local port, a stand-in for
+        the ArcGIS imagery server. Use as a context manager.
+
+        The server runs in its own process, so it neither competes with
+        the pipeline for the GIL nor skews the stage timings.
+
+        Parameters
+        ----------
+        folder : str
+            the folder holding the source imagery
+        '''
+        self.folder = folder
+        self._bytes_served = multiprocessing.Value('q', 0)
+        self.process = None
+        self.port = None
+
+    def __enter__(self):
+        receive, send = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_serve, args=(self.folder, send, self._bytes_served), daemon=True)
+        self.process.start()
+        self.port = receive.recv()
+        return self
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        self.process.join()
+
+    @property
+    def bytes_served(self):
+        return self._bytes_served.value
+
+    def url(self, f_name):
+        '''The GDAL path of a file in the served folder.'''
+        return f'/vsicurl/http://127.0.0.1:{self.port}/{f_name}'
+
+
+def peak_rss_mb():
+    '''The peak resident memory of this process in MB, None off unix.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    # linux reports kilobytes, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if platform.system() == 'Darwin' else rss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(runs=3, n_shapes=2000, src_pixels=2048, tiles=True, cache=False,
+                  work_dir=None, max_pixels=8192*8192):
+    '''Run save_map (and save_tiles) on the sample through the local
+    imagery server several times and take the median of every timing.
+
+    Parameters
+    ----------
+    runs : int
+        the number of timed runs, each with fresh output folders
+    n_shapes, src_pixels
+        the sample size, see make_sample
+    tiles : bool
+        also time save_tiles for the tile throughput
+    cache : bool
+        keep the tile cache between runs, off by default so every run
+        times the imagery fetch
+    work_dir : str
+        where the sample and outputs go, a temporary folder by default
+    max_pixels : int
+        maps over this size take the chunked path, see mapRetrieve. Only the
+        stages of the path taken are recorded
+
+    Returns
+    ----------
+    dict
+        the benchmark record, see save_results
+    '''
+    params = {'runs': runs, 'n_shapes': n_shapes, 'src_pixels': src_pixels,
+              'tiles': tiles, 'cache': cache}
+    if max_pixels != 8192*8192:
+        # only when set, so earlier records still compare
+        params['max_pixels'] = max_pixels
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = work_dir or temp_dir
+        zip_file, src_file = make_sample(os.path.join(work_dir, 'data'),
+                                         n_shapes=n_shapes, src_pixels=src_pixels)
+        stages, totals, tile_times = defaultdict(list), [], []
+        labels = n_tiles = 0
+        # GDAL keeps fetched blocks in memory per url unless told otherwise,
+        # the option only holds inside the rasterio.Env
+        with imageryServer(os.path.dirname(src_file)) as server, \
+                rasterio.Env(**({} if cache else {'CPL_VSIL_CURL_NON_CACHED': server.url('')})):
+            for run in range(runs):
+                out = os.path.join(work_dir, f'run{run}')
+                mr = mapRetrieve(in_folder=os.path.dirname(zip_file),
+                                 out_folder=os.path.join(out, 'maps'),
+                                 label_folder=os.path.join(out, 'labels'),
+                                 epsg_cache=os.path.join(out, 'epsg_cache.json'),
+                                 src_file=server.url(os.path.basename(src_file)),
+                                 cache_dir=os.path.join(work_dir, 'tile_cache'),
+                                 cache_bytes=2*1024**3 if cache else 0,
+                                 max_pixels=max_pixels)
+                start = time.perf_counter()
+                mr.save_map(zip_file)
+                totals.append(time.perf_counter() - start)
+                snapshot = mr.metrics.snapshot()
+                for stage, span in STAGES.items():
+                    # maps over max_pixels skip warp and png_encode
+                    if span in snapshot['stages']:
+                        stages[stage].append(snapshot['stages'][span]['self_seconds'])
+                labels = snapshot['counters']['labels_emitted']
+
+                if tiles:
+                    mr.out_folder = os.path.join(out, 'tiles')
+                    mr.label_folder = os.path.join(out, 'tile_labels')
+                    os.makedirs(mr.out_folder, exist_ok=True)
+                    os.makedirs(mr.label_folder, exist_ok=True)
+                    start = time.perf_counter()
+                    n_tiles = len(mr.save_tiles(zip_file))
+                    tile_times.append(time.perf_counter() - start)
+            bytes_served = server.bytes_served
+
+    total = statistics.median(totals)
+    record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'python': platform.python_version(),
+              'machine': platform.machine(),
+              'params': params,
+              'stages': {stage: statistics.median(t) for stage, t in stages.items()},
+              'total': total,
+              'labels': labels,
+              'labels_per_s': labels / total if total else None,
+              'peak_rss_mb': peak_rss_mb(),
+              'bytes_served': bytes_served}
+    if tiles:
+        tile_time = statistics.median(tile_times)
+        record.update({'tiles': n_tiles, 'tile_time': tile_time,
+                       'tiles_per_min': 60 * n_tiles / tile_time if tile_time else None})
+    return record
+
+
+def save_results(record, results_file='benchmarks.jsonl'):
+    '''Append a benchmark record to the results file.'''
+    with open(results_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def load_results(results_file='benchmarks.jsonl'):
+    if not os.path.exists(results_file):
+        return []
+    with open(results_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, previous, threshold=0.2):
+    '''Compare a record against an earlier one with the same parameters.
+
+    Parameters
+    ----------
+    record, previous : dict
+        benchmark records from run_benchmark
+    threshold : float
+        a stage is a regression when it is this fraction slower
+
+    Returns
+    ----------
+    dict
+        the new to old time ratio of every stage and the total
+    list
+        the stages that regressed
+    '''
+    ratios = {}
+    for stage, seconds in [*record['stages'].items(), ('total', record['total']),
+                           ('tile_time', record.get('tile_time'))]:
+        old = previous['stages'].get(stage) if stage in previous['stages'] else previous.get(stage)
+        if seconds is not None and old:
+            ratios[stage] = seconds / old
+    regressions = [stage for stage, ratio in ratios.items() if ratio > 1 + threshold]
+    return ratios, regressions
+
+
+def report(record, ratios=None):
+    '''Format a record (and its comparison) as a table.'''
+    ratios = ratios or {}
+    lines = [f'{"stage":<16}{"seconds":>10}{"vs last":>10}']
+    for stage, seconds in [*record['stages'].items(), ('total', record['total'])]:
+        change = f'{ratios[stage]:>9.2f}x' if stage in ratios else f'{"":>10}'
+        lines.append(f'{stage:<16}{seconds:>10.4f}{change}')
+    lines.append(f'labels/s {record["labels_per_s"]:.0f} ({record["labels"]} labels)')
+    if 'tiles' in record:
+        lines.append(f'tiles/min {record["tiles_per_min"]:.0f} ({record["tiles"]} tiles)')
+    if record['peak_rss_mb'] is not None:
+        lines.append(f'peak rss {record["peak_rss_mb"]:.0f} MB')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the map to dataset pipeline')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--shapes', type=int, default=2000)
+    parser.add_argument('--src-pixels', type=int, default=2048)
+    parser.add_argument('--no-tiles', action='store_true')
+    parser.add_argument('--cache', action='store_true')
+    parser.add_argument('--max-pixels', type=int, default=8192*8192)
+    parser.add_argument('--results', default='benchmarks.jsonl')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    record = run_benchmark(runs=args.runs, n_shapes=args.shapes, src_pixels=args.src_pixels,
+                           tiles=not args.no_tiles, cache=args.cache,
+                           max_pixels=args.max_pixels)
+    previous = [r for r in load_results(args.results) if r['params'] == record['params']]
+    ratios, regressions = compare(record, previous[-1], args.threshold) if previous else ({}, [])
+    save_results(record, args.results)
+    print(report(record, ratios))
+    if regressions:
+        print(f'regressed more than {args.threshold:.0%}: {", ".join(regressions)}')
+        if args.fail_on_regression:
+            raise SystemExit(1)
@@ -0,0 +1,37 @@
+from benchmark import run_benchmark, compare
+import unittest
+import tempfile
+import os
+
+
+class TestBenchmark(unittest.TestCase):
+    """
+    Testing benchmark records on the in memory and chunked map paths
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_paths(self):
+        kwargs = dict(runs=1, n_shapes=50, src_pixels=256, work_dir=self.temp_dir.name)
+        memory = run_benchmark(**kwargs)
+        self.assertIn('png_encode', memory['stages'])
+        self.assertNotIn('warp_chunked', memory['stages'])
+        self.assertNotIn('max_pixels', memory['params'])
+
+        # a map over max_pixels has no warp or png_encode spans
+        chunked = run_benchmark(**kwargs, max_pixels=100*100)
+        self.assertIn('warp_chunked', chunked['stages'])
+        self.assertNotIn('png_encode', chunked['stages'])
+        self.assertEqual(chunked['tiles'], memory['tiles'])
+        ratios, _ = compare(chunked, memory)
+        self.assertIn('total', ratios)
+
+        # the GDAL option does not outlive the run
+        self.assertNotIn('CPL_VSIL_CURL_NON_CACHED', os.environ)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,496 @@
+# a columnar container for labeled boxes, numpy arrays of coordinates,
+# class ids, tree heights and image ids, so millions of boxes fit in tens
+# of MB and are filtered, clipped and transformed without python loops.
+# VOC xml, json labels and RetinaNet csv are read and written around it
+
+import csv
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+BOX_KEYS = ('xmin', 'ymin', 'xmax', 'ymax')
+
+VOC_OBJECT = """    <object>
+        <name>{name}</name>
+        <pose>{pose}</pose>
+        <truncated>{truncated}</truncated>
+        <difficult>{difficult}</difficult>
+        <bndbox>
+            <xmin>{xmin}</xmin>
+            <ymin>{ymin}</ymin>
+            <xmax>{xmax}</xmax>
+            <ymax>{ymax}</ymax>
+        </bndbox>
+    </object>
+"""
+
+VOC_ANNOTATION = """<annotation>
+    <folder>{folder}</folder>
+    <filename>{filename}</filename>
+    <path>{path}</path>
+    <source>
+        <database>{database}</database>
+    </source>
+    <size>
+        <width>{width}</width>
+        <height>{height}</height>
+        <depth>{depth}</depth>
+    </size>
+    <segmented>{segmented}</segmented>
+{objects}</annotation>
+"""
+
+
+def image_name(content):
+    '''Get the image file name from the content of a json label, which is a
+    windows or posix path to the image, with or without its extension
+    (ex. 'maps\\CubComplex2009_401377N_12146256W' -> 'CubComplex2009_401377N_12146256W.png')'''
+    name = re.split(r'/|\\+', content)[-1]
+    return name if os.path.splitext(name)[1] else name + '.png'
+
+
+def _text(values):
+    # whole numbers are written without a decimal point
+    return np.char.mod('%.15g', values)
+
+
+def image_size(image_file):
+    '''The (width, height, depth) of an image, read from its header.'''
+    from raster_meta import read_meta
+    meta = read_meta(image_file)
+    return meta.width, meta.height, meta.bands
+
+
+class boxStore():
+    def __init__(self, boxes=None, class_ids=None, image_ids=None, heights=None,
+                 truncated=None, difficult=None, pose_ids=None, classes=None,
+                 images=None, sizes=None, poses=None, databases=None, segmented=None):
+        '''Boxes as columns, the i-th box is boxes[i], class_ids[i] and so
+        on. Swapped min and max coordinates are put back in order.
+
+        Parameters
+        ----------
+        boxes : np.ndarray
+            (n, 4) boxes as [xmin, ymin, xmax, ymax]
+        class_ids : np.ndarray
+            the index into classes of every box, 0 by default
+        image_ids : np.ndarray
+            the index into images of every box, 0 by default
+        heights : np.ndarray
+            the tree height of every box, nan where unknown
+        truncated, difficult : np.ndarray
+            the VOC flags of every box
+        pose_ids : np.ndarray
+            the index into poses of every box, 0 by default
+        classes : list
+            the class names, ['tree'] by default
+        images : list
+            the image files the boxes belong to, images without boxes are
+            kept too
+        sizes : np.ndarray
+            (len(images), 3) sizes as (width, height, depth)
+        poses : list
+            the VOC pose names, ['Unspecified'] by default
+        databases, segmented
+            the VOC source database and segmented flag of every image,
+            'Unknown' and 0 by default
+        '''
+        boxes = np.asarray(boxes if boxes is not None else np.zeros((0, 4)),
+                           dtype=float).reshape(-1, 4)
+        self.boxes = np.concatenate([np.minimum(boxes[:, :2], boxes[:, 2:]),
+                                     np.maximum(boxes[:, :2], boxes[:, 2:])], axis=1)
+        n = len(self.boxes)
+
+        def column(values, dtype, fill):
+            if values is None:
+                return np.full(n, fill, dtype=dtype)
+            return np.broadcast_to(np.asarray(values, dtype=dtype), (n,)).copy()
+
+        self.class_ids = column(class_ids, np.int16, 0)
+        self.image_ids = column(image_ids, np.int32, 0)
+        self.heights = column(heights, np.float32, np.nan)
+        self.truncated = column(truncated, bool, False)
+        self.difficult = column(difficult, bool, False)
+        self.pose_ids = column(pose_ids, np.int8, 0)
+        self.classes = list(classes) if classes is not None else ['tree']
+        self.poses = list(poses) if poses is not None else ['Unspecified']
+        self._set_images(images if images is not None else [], sizes, databases, segmented)
+
+    COLUMNS = ('boxes', 'class_ids', 'image_ids', 'heights', 'truncated', 'difficult',
+               'pose_ids')
+
+    def _set_images(self, images, sizes, databases=None, segmented=None):
+        self.images = list(images)
+        m = len(self.images)
+        self.sizes = np.asarray(sizes if sizes is not None else np.zeros((0, 3)),
+                                dtype=np.int64).reshape(-1, 3)
+        self.databases = list(databases) if databases is not None else ['Unknown'] * m
+        self.segmented = np.broadcast_to(np.asarray(segmented if segmented is not None else 0,
+                                                    dtype=np.int8), (m,)).copy()
+
+    def __len__(self):
+        return len(self.boxes)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, k).nbytes for k in self.COLUMNS)
+
+    def _replace(self, **columns):
+        # a new store sharing the classes and images
+        values = {k: columns.get(k, getattr(self, k)) for k in self.COLUMNS}
+        return boxStore(**values, classes=self.classes, images=self.images,
+                        sizes=self.sizes, poses=self.poses, databases=self.databases,
+                        segmented=self.segmented)
+
+    def __getitem__(self, index):
+        '''Select boxes with a mask or an index array (ex. to repeat boxes).'''
+        return self._replace(**{k: getattr(self, k)[index] for k in self.COLUMNS})
+
+    def regroup(self, image_ids, images, sizes, databases=None, segmented=None):
+        '''The same boxes assigned to other images (ex. tiles).'''
+        store = self._replace()
+        store.image_ids = np.asarray(image_ids, dtype=np.int32)
+        store._set_images(images, sizes, databases, segmented)
+        return store
+
+    @classmethod
+    def concat(cls, stores):
+        '''Join stores, their classes are merged by name and their images
+        appended.'''
+        if not stores:
+            return cls()
+        classes = list(OrderedDict((name, None) for s in stores for name in s.classes))
+        poses = list(OrderedDict((name, None) for s in stores for name in s.poses))
+        class_lookup = {name: i for i, name in enumerate(classes)}
+        pose_lookup = {name: i for i, name in enumerate(poses)}
+        columns = {k: [] for k in cls.COLUMNS}
+        images, sizes, databases, segmented, offset = [], [], [], [], 0
+        for s in stores:
+            class_remap = np.array([class_lookup[name] for name in s.classes], dtype=np.int16)
+            pose_remap = np.array([pose_lookup[name] for name in s.poses], dtype=np.int8)
+            for k in cls.COLUMNS:
+                columns[k].append(getattr(s, k))
+            columns['class_ids'][-1] = class_remap[s.class_ids]
+            columns['pose_ids'][-1] = pose_remap[s.pose_ids]
+            columns['image_ids'][-1] = s.image_ids + offset
+            images.extend(s.images)
+            sizes.append(s.sizes)
+            databases.extend(s.databases)
+            segmented.append(s.segmented)
+            offset += len(s.images)
+        return cls(**{k: np.concatenate(v) for k, v in columns.items()}, classes=classes,
+                   images=images, sizes=np.concatenate(sizes), poses=poses,
+                   databases=databases, segmented=np.concatenate(segmented))
+
+    def filter(self, min_height=None, border=None, classes=None):
+        '''Keep the boxes of trees taller than min_height (unknown heights
+        are dropped), more than border pixels inside their image and of the
+        given class names.'''
+        keep = np.ones(len(self), dtype=bool)
+        if min_height is not None:
+            keep &= self.heights > min_height
+        if border is not None:
+            width, height = self.sizes[self.image_ids, 0], self.sizes[self.image_ids, 1]
+            keep &= (self.boxes[:, 0] > border) & (self.boxes[:, 1] > border) & \
+                    (self.boxes[:, 2] < width - border) & (self.boxes[:, 3] < height - border)
+        if classes is not None:
+            ids = [i for i, name in enumerate(self.classes) if name in classes]
+            keep &= np.isin(self.class_ids, ids)
+        return self[keep]
+
+    def transform(self, transform, inverse=False):
+        '''Map the boxes through a north up affine transform, from pixel to
+        map coordinates, or from map to pixel coordinates when inverse.'''
+        t = transform
+        if t.b or t.d:
+            raise ValueError('only transforms without rotation are supported')
+        x, y = self.boxes[:, [0, 2]], self.boxes[:, [1, 3]]
+        if inverse:
+            x, y = (x - t.c) / t.a, (y - t.f) / t.e
+        else:
+            x, y = t.c + t.a * x, t.f + t.e * y
+        return self._replace(boxes=np.stack([x[:, 0], y[:, 0], x[:, 1], y[:, 1]], axis=1))
+
+    def translate(self, dx, dy):
+        '''Shift the boxes, dx and dy can be per box arrays.'''
+        offset = np.stack(np.broadcast_arrays(dx, dy, dx, dy), axis=-1)
+        return self._replace(boxes=self.boxes + offset)
+
+    def trunc(self):
+        '''Truncate the coordinates towards zero, as int() does.'''
+        return self._replace(boxes=np.trunc(self.boxes))
+
+    def round_out(self):
+        '''Grow the boxes out to whole pixels.'''
+        return self._replace(boxes=np.concatenate([np.floor(self.boxes[:, :2]),
+                                                   np.ceil(self.boxes[:, 2:])], axis=1))
+
+    def clip(self, xmin, ymin, xmax, ymax):
+        '''Clip the boxes to bounds (scalars or per box arrays), marking
+        the clipped boxes truncated and dropping the slivers left with no
+        area.'''
+        bounds_min = np.stack(np.broadcast_arrays(xmin, ymin), axis=-1)
+        bounds_max = np.stack(np.broadcast_arrays(xmax, ymax), axis=-1)
+        clipped = np.concatenate([np.clip(self.boxes[:, :2], bounds_min, bounds_max),
+                                  np.clip(self.boxes[:, 2:], bounds_min, bounds_max)], axis=1)
+        truncated = self.truncated | (clipped != self.boxes).any(axis=1)
+        keep = (clipped[:, 2] > clipped[:, 0]) & (clipped[:, 3] > clipped[:, 1])
+        return self._replace(boxes=clipped, truncated=truncated)[keep]
+
+    def groups(self):
+        '''The index of the boxes of every image, in image order.'''
+        if not self.images:
+            return []
+        order = np.argsort(self.image_ids, kind='stable')
+        ends = np.searchsorted(self.image_ids[order], np.arange(len(self.images)), side='right')
+        return np.split(order, ends[:-1])
+
+    # VOC xml
+
+    @classmethod
+    def read_voc(cls, f_name, image_dir=None):
+        '''Read a VOC xml file. The size is taken from the xml, the image is
+        only opened when the size is missing.
+
+        Parameters
+        ----------
+        f_name : str
+            the VOC xml file
+        image_dir : str
+            the folder of the image. By default the xml path is used when it
+            exists (it is often from another machine) and the folder of the
+            xml file otherwise
+        '''
+        root = ET.parse(f_name).getroot()
+        image_file = root.findtext('path')
+        if image_dir is not None or not image_file or not os.path.exists(image_file):
+            image_file = os.path.join(image_dir or os.path.dirname(f_name), root.findtext('filename'))
+        size = tuple(root.findtext(f'size/{k}') for k in ('width', 'height', 'depth'))
+        size = tuple(map(int, size)) if all(size) else image_size(image_file)
+        objects = root.findall('object')
+        names = [obj.findtext('name') for obj in objects]
+        classes = list(OrderedDict.fromkeys(names)) or ['tree']
+        lookup = {name: i for i, name in enumerate(classes)}
+        pose_names = [obj.findtext('pose') or 'Unspecified' for obj in objects]
+        poses = list(OrderedDict.fromkeys(pose_names)) or ['Unspecified']
+        pose_lookup = {name: i for i, name in enumerate(poses)}
+        values = np.array([[obj.findtext(f'bndbox/{k}') for k in BOX_KEYS] +
+                           [obj.findtext('truncated') or 0, obj.findtext('difficult') or 0]
+                           for obj in objects], dtype=float).reshape(-1, 6)
+        return cls(values[:, :4], class_ids=[lookup[name] for name in names],
+                   truncated=values[:, 4], difficult=values[:, 5],
+                   pose_ids=[pose_lookup[name] for name in pose_names], classes=classes,
+                   images=[image_file], sizes=[size], poses=poses,
+                   databases=[root.findtext('source/database') or 'Unknown'],
+                   segmented=[int(root.findtext('segmented') or 0)])
+
+    def voc_text(self, image_id=0, index=None):
+        '''The VOC xml text of one image.'''
+        if index is None:
+            index = np.flatnonzero(self.image_ids == image_id)
+        image_file = self.images[image_id]
+        coords = _text(self.boxes[index])
+        names = [escape(name) for name in self.classes]
+        poses = [escape(name) for name in self.poses]
+        objects = ''.join(VOC_OBJECT.format(name=names[c], pose=poses[p],
+                                            truncated=int(t), difficult=int(d),
+                                            xmin=x0, ymin=y0, xmax=x1, ymax=y1)
+                          for c, p, t, d, (x0, y0, x1, y1) in
+                          zip(self.class_ids[index].tolist(), self.pose_ids[index].tolist(),
+                              self.truncated[index].tolist(), self.difficult[index].tolist(),
+                              coords.tolist()))
+        width, height, depth = self.sizes[image_id].tolist()
+        return VOC_ANNOTATION.format(
+            folder=escape(os.path.basename(os.path.dirname(os.path.abspath(image_file)))),
+            filename=escape(os.path.basename(image_file)), path=escape(image_file),
+            database=escape(self.databases[image_id]), width=width, height=height,
+            depth=depth, segmented=int(self.segmented[image_id]), objects=objects)
+
+    def write_voc(self, out_dir, skip_empty=False):
+        '''Write a VOC xml file per image to <out_dir>/<image name>.xml.
+
+        Returns
+        ----------
+        list
+            the xml files written
+        '''
+        written = []
+        for image_id, index in enumerate(self.groups()):
+            if skip_empty and not len(index):
+                continue
+            stem = os.path.splitext(os.path.basename(self.images[image_id]))[0]
+            f_name = os.path.join(out_dir, stem + '.xml')
+            with open(f_name, 'w') as f:
+                f.write(self.voc_text(image_id, index))
+            written.append(f_name)
+        return written
+
+    # json labels
+
+    @classmethod
+    def read_json(cls, f_name, image_dir=None, label='tree'):
+        '''Read a json label file, either one label object or one per line
+        ({"content": <image>, "annotation": [{"x_min", "y_min", "x_max", "y_max", ...}]}).
+        Image sizes are read from the image headers.
+
+        Parameters
+        ----------
+        f_name : str
+            the json label file
+        image_dir : str
+            the folder of the images, by default the content path is used
+            when it exists and the folder of the json file otherwise
+        label : str
+            the class of boxes without a label (ex. the max_h labels of save_map)
+        '''
+        with open(f_name) as f:
+            text = f.read().strip()
+        try:
+            records = [json.loads(text)]
+        except json.JSONDecodeError:
+            records = [json.loads(line) for line in text.splitlines() if line.strip()]
+        images, rows = [], []
+        for i, record in enumerate(records):
+            content = record['content']
+            if image_dir is None and os.path.exists(content):
+                images.append(content)
+            else:
+                images.append(os.path.join(image_dir or os.path.dirname(f_name),
+                                           image_name(content)))
+            rows.extend((i, box.get('label', label), box.get('max_h', np.nan),
+                         box['x_min'], box['y_min'], box['x_max'], box['y_max'])
+                        for box in record.get('annotation') or [])
+        names = [row[1] for row in rows]
+        classes = list(OrderedDict.fromkeys(names)) or [label]
+        lookup = {name: i for i, name in enumerate(classes)}
+        values = np.array([row[2:] for row in rows], dtype=float).reshape(-1, 5)
+        return cls(values[:, 1:], class_ids=[lookup[name] for name in names],
+                   image_ids=[row[0] for row in rows], heights=values[:, 0],
+                   classes=classes, images=images,
+                   sizes=[image_size(image) for image in images])
+
+    def json_lines(self):
+        '''A json label line per image.'''
+        lines = []
+        # whole numbers are written as ints
+        coords = [[int(v) if v.is_integer() else v for v in box] for box in self.boxes.tolist()]
+        heights = self.heights.tolist()
+        for image_id, index in enumerate(self.groups()):
+            annotation = []
+            for i in index.tolist():
+                box = {'label': self.classes[self.class_ids[i]],
+                       **dict(zip(('x_min', 'y_min', 'x_max', 'y_max'), coords[i]))}
+                if heights[i] == heights[i]:
+                    box['max_h'] = heights[i]
+                annotation.append(box)
+            lines.append(json.dumps({'content': self.images[image_id], 'annotation': annotation}))
+        return lines
+
+    def write_json(self, f_name):
+        with open(f_name, 'w') as f:
+            f.writelines(line + '\n' for line in self.json_lines())
+
+    # RetinaNet csv
+
+    @classmethod
+    def read_csv(cls, f_name, workers=8):
+        '''Read a RetinaNet csv (path,x1,y1,x2,y2,class per box, and
+        path,,,,, for images without boxes). Relative paths are relative to
+        the csv.
+
+        Parameters
+        ----------
+        f_name : str
+            the csv annotation file
+        workers : int
+            the number of threads reading image headers
+        '''
+        from concurrent.futures import ThreadPoolExecutor
+
+        images, rows = OrderedDict(), []
+        with open(f_name, newline='') as f:
+            for row in csv.reader(f):
+                if not row:
+                    continue
+                path = os.path.join(os.path.dirname(f_name), row[0])
+                image_id = images.setdefault(path, len(images))
+                if any(row[1:6]):
+                    rows.append((image_id, row[5], *row[1:5]))
+        names = [row[1] for row in rows]
+        classes = list(OrderedDict.fromkeys(names)) or ['tree']
+        lookup = {name: i for i, name in enumerate(classes)}
+        values = np.array([row[2:] for row in rows], dtype=float).reshape(-1, 4)
+        with ThreadPoolExecutor(workers) as pool:
+            sizes = list(pool.map(image_size, images))
+        return cls(values, class_ids=[lookup[name] for name in names],
+                   image_ids=[row[0] for row in rows], classes=classes,
+                   images=list(images), sizes=sizes)
+
+    def write_csv(self, f_name, classes_file=None, base_dir=None):
+        '''Write RetinaNet csv annotations. Boxes are grown out to whole
+        pixels and boxes without any area are dropped, as RetinaNet refuses
+        them. The class mapping is written to classes_file, classes.csv
+        next to the csv by default.
+
+        Parameters
+        ----------
+        f_name : str
+            the csv file to write
+        classes_file : str
+            the class mapping (name,id) to write, ids already in the file
+            are kept and new names are added after them
+        base_dir : str
+            write image paths relative to this folder, absolute by default
+        '''
+        store = self.round_out()
+        boxes = store.boxes
+        store = store[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+        paths = [os.path.abspath(image) for image in self.images]
+        if base_dir is not None:
+            paths = [os.path.relpath(path, base_dir) for path in paths]
+        coords = store.boxes.astype(np.int64).tolist()
+        names = self.classes
+        with open(f_name, 'w', newline='') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            for image_id, index in enumerate(store.groups()):
+                if not len(index):
+                    writer.writerow([paths[image_id], '', '', '', '', ''])
+                    continue
+                writer.writerows([paths[image_id], *coords[i], names[store.class_ids[i]]]
+                                 for i in index.tolist())
+
+        if classes_file is None:
+            classes_file = os.path.join(os.path.dirname(os.path.abspath(f_name)), 'classes.csv')
+        classes = OrderedDict()
+        if os.path.exists(classes_file):
+            with open(classes_file, newline='') as f:
+                classes.update((name, int(i)) for name, i in csv.reader(f))
+        for name in np.array(self.classes)[np.unique(self.class_ids)].tolist():
+            classes.setdefault(name, len(classes))
+        with open(classes_file, 'w', newline='') as f:
+            csv.writer(f, lineterminator='\n').writerows(classes.items())
+        return classes
+
+    # compact binary
+
+    def save(self, f_name):
+        '''Save the store as a compressed .npz.'''
+        np.savez_compressed(f_name, **{k: getattr(self, k) for k in self.COLUMNS},
+                            classes=np.array(self.classes, dtype=str),
+                            images=np.array(self.images, dtype=str), sizes=self.sizes,
+                            poses=np.array(self.poses, dtype=str),
+                            databases=np.array(self.databases, dtype=str),
+                            segmented=self.segmented)
+
+    @classmethod
+    def load(cls, f_name):
+        with np.load(f_name) as data:
+            return cls(**{k: data[k] for k in cls.COLUMNS},
+                       classes=data['classes'].tolist(), images=data['images'].tolist(),
+                       sizes=data['sizes'], poses=data['poses'].tolist(),
+                       databases=data['databases'].tolist(), segmented=data['segmented'])
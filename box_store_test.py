@@ -0,0 +1,135 @@
+from box_store import boxStore
+from affine import Affine
+from PIL import Image
+import numpy as np
+import unittest
+import tempfile
+import json
+import csv
+import os
+
+
+class TestBoxStore(unittest.TestCase):
+    """
+    Testing the columnar box store and its VOC, csv and json formats
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.temp_dir.name, 'Plot_A.png')
+        Image.new('RGB', (300, 200)).save(self.image)
+        # the first box has min and max swapped, the last has no height
+        self.store = boxStore([[188.4, 7.3, 182.5, 2.3], [10, 30, 20, 40], [250, 150, 299, 199]],
+                              class_ids=[0, 1, 0], heights=[37.9, 20.0, np.nan],
+                              classes=['tree', 'shrub'], images=[self.image],
+                              sizes=[(300, 200, 3)])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_million_boxes(self):
+        n = 1_000_000
+        rng = np.random.default_rng(0)
+        corners = rng.uniform(0, 1e4, (n, 2))
+        store = boxStore(np.hstack([corners, corners + 5]), heights=rng.uniform(0, 40, n),
+                         image_ids=rng.integers(0, 100, n), images=[''] * 100,
+                         sizes=[(1e4, 1e4, 3)] * 100)
+        self.assertLess(store.nbytes, 50e6)
+        tall = store.filter(min_height=20, border=50)
+        self.assertTrue((tall.heights > 20).all())
+        self.assertEqual(len(tall.groups()), 100)
+        self.assertEqual(sum(map(len, tall.groups())), len(tall))
+
+    def test_filter_clip_transform(self):
+        self.assertEqual(self.store.boxes[0].tolist(), [182.5, 2.3, 188.4, 7.3])
+        self.assertEqual(len(self.store.filter(min_height=10)), 2)
+        self.assertEqual(self.store.filter(border=5).boxes.tolist(), [[10, 30, 20, 40]])
+        self.assertEqual(self.store.filter(classes=['shrub']).heights.tolist(), [20.0])
+
+        # the shrub falls off the left edge and the last box is cut
+        clipped = self.store.translate(-180, 0).clip(0, 0, 100, 160)
+        np.testing.assert_allclose(clipped.boxes, [[2.5, 2.3, 8.4, 7.3], [70, 150, 100, 160]])
+        self.assertEqual(clipped.truncated.tolist(), [False, True])
+
+        # pixel -> map -> pixel, the y axis flips and min and max stay in order
+        t = Affine(0.5, 0, 500000, 0, -0.5, 4400000)
+        mapped = self.store.transform(t)
+        self.assertTrue((mapped.boxes[:, 3] > mapped.boxes[:, 1]).all())
+        np.testing.assert_allclose(mapped.transform(t, inverse=True).boxes, self.store.boxes)
+
+    def test_concat(self):
+        other = boxStore([[1, 1, 2, 2]], classes=['shrub'], images=['b.png'], sizes=[(4, 4, 3)])
+        joined = boxStore.concat([self.store, other])
+        self.assertEqual(joined.classes, ['tree', 'shrub'])
+        self.assertEqual(joined.class_ids.tolist(), [0, 1, 0, 1])
+        self.assertEqual(joined.image_ids.tolist(), [0, 0, 0, 1])
+        self.assertEqual(joined.sizes.tolist(), [[300, 200, 3], [4, 4, 3]])
+
+    def test_formats(self):
+        voc_file, = self.store.write_voc(self.temp_dir.name)
+        voc = boxStore.read_voc(voc_file)
+        self.assertEqual(voc.images, [self.image])
+        np.testing.assert_array_equal(voc.boxes, self.store.boxes)
+        self.assertEqual([voc.classes[i] for i in voc.class_ids], ['tree', 'shrub', 'tree'])
+
+        json_file = os.path.join(self.temp_dir.name, 'labels.json')
+        self.store.write_json(json_file)
+        with open(json_file) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record['annotation'][1], {'label': 'shrub', 'x_min': 10, 'y_min': 30,
+                                                   'x_max': 20, 'y_max': 40, 'max_h': 20.0})
+        labels = boxStore.read_json(json_file)
+        np.testing.assert_array_equal(labels.heights, self.store.heights)
+        self.assertEqual(labels.sizes.tolist(), [[300, 200, 3]])
+
+        csv_file = os.path.join(self.temp_dir.name, 'annotations.csv')
+        self.store.write_csv(csv_file, base_dir=self.temp_dir.name)
+        with open(csv_file) as f:
+            self.assertEqual(next(csv.reader(f)), ['Plot_A.png', '182', '2', '189', '8', 'tree'])
+        with open(os.path.join(self.temp_dir.name, 'classes.csv')) as f:
+            self.assertEqual(f.read(), 'tree,0\nshrub,1\n')
+        self.assertEqual(len(boxStore.read_csv(csv_file)), 3)
+
+        npz_file = os.path.join(self.temp_dir.name, 'boxes.npz')
+        self.store.save(npz_file)
+        loaded = boxStore.load(npz_file)
+        np.testing.assert_array_equal(loaded.heights, self.store.heights)
+        self.assertEqual(loaded.classes, self.store.classes)
+
+    def test_voc_metadata(self):
+        voc_file = os.path.join(self.temp_dir.name, 'Plot_A.xml')
+        self.store.write_voc(self.temp_dir.name)
+        with open(voc_file) as f:
+            text = f.read()
+        text = text.replace('<database>Unknown', '<database>Survey').replace(
+            '<segmented>0', '<segmented>1').replace('<pose>Unspecified', '<pose>Left', 1)
+        with open(voc_file, 'w') as f:
+            f.write(text)
+        voc = boxStore.read_voc(voc_file)
+        self.assertEqual(voc.databases, ['Survey'])
+        self.assertEqual(voc.segmented.tolist(), [1])
+        self.assertEqual([voc.poses[i] for i in voc.pose_ids], ['Left', 'Unspecified', 'Unspecified'])
+
+        # the fields survive writing the store back out and joining stores
+        os.remove(voc_file)
+        boxStore.concat([boxStore(), voc]).write_voc(self.temp_dir.name)
+        with open(voc_file) as f:
+            self.assertEqual(f.read(), text)
+
+    def test_empty(self):
+        empty = boxStore.concat([])
+        self.assertEqual(empty.groups(), [])
+        self.assertEqual(empty.write_voc(self.temp_dir.name), [])
+        json_file = os.path.join(self.temp_dir.name, 'labels.json')
+        empty.write_json(json_file)
+        csv_file = os.path.join(self.temp_dir.name, 'annotations.csv')
+        empty.write_csv(csv_file)
+        self.assertEqual(os.path.getsize(csv_file), 0)
+        self.assertEqual(len(boxStore.read_csv(csv_file)), 0)
+        npz_file = os.path.join(self.temp_dir.name, 'boxes.npz')
+        empty.save(npz_file)
+        loaded = boxStore.load(npz_file)
+        self.assertEqual((len(loaded), loaded.images), (0, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
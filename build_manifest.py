@@ -0,0 +1,51 @@
+# fingerprints of the inputs of every built map, recorded with the zip in
+# the batch ledger so a rebuild only redoes the maps and labels whose
+# inputs changed
+
+import hashlib
+import json
+import os
+from zipfile import ZipFile
+
+
+def fingerprint(*parts):
+    '''A short hex digest of any json-able parts, stable between runs.'''
+    text = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def zip_fingerprint(zf):
+    '''Fingerprint the content of a zip from the crc and size of every
+    member. Only the central directory at the end of the zip is read, so
+    this is cheap even for a large survey.
+
+    Parameters
+    ----------
+    zf : str
+        the file name of a zip file
+
+    Returns
+    ----------
+    str
+        a hex digest that changes whenever a member changes
+    '''
+    with ZipFile(zf) as z:
+        members = sorted((info.filename, info.CRC, info.file_size) for info in z.infolist())
+    return fingerprint(members)
+
+
+def source_fingerprint(src_file):
+    '''Fingerprint the imagery source. A local file is fingerprinted by its
+    size and modification time, a url by itself.'''
+    if os.path.exists(src_file):
+        stat = os.stat(src_file)
+        return fingerprint(os.path.abspath(src_file), stat.st_size, stat.st_mtime_ns)
+    return fingerprint(src_file)
+
+
+def inputs_fingerprint(zf, src_file, max_pixels, params):
+    '''Fingerprint everything a map and its labels are built from: the zip,
+    the imagery source, the map size limit and the label parameters (ex.
+    {'min_height': 10, 'border': 50}). A zip whose inputs fingerprint
+    matches its last build is up to date.'''
+    return fingerprint(zip_fingerprint(zf), source_fingerprint(src_file), max_pixels, params)
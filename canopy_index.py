@@ -0,0 +1,260 @@
+# rolls tree labels into a regional canopy raster once, offline, so route
+# scoring is a few block reads instead of a detector or polygon run
+
+import os
+
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window
+
+from shade_score import load_voc_boxes
+
+CANOPY_CRS = 'EPSG:4326'
+# value of a fully shaded pixel, overviews average it into a density
+CANOPY_FULL = 255
+
+
+def lnglat_boxes(boxes, crs):
+    '''Re-project (n, 4) boxes to Lng/Lat, returning the envelope of the
+    four re-projected corners of every box.'''
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    x = boxes[:, [0, 2, 2, 0]]
+    y = boxes[:, [1, 1, 3, 3]]
+    lng, lat = Transformer.from_crs(crs, CANOPY_CRS, always_xy=True).transform(x, y)
+    return np.stack([lng.min(axis=1), lat.min(axis=1), lng.max(axis=1), lat.max(axis=1)], axis=1)
+
+
+def _burn(boxes, top, left, res, height, width):
+    # pixel windows covered by every box, a pixel is canopy when its
+    # center is inside a box
+    c0 = np.ceil((boxes[:, 0] - left) / res - 0.5).astype(np.int64).clip(0, width)
+    c1 = np.ceil((boxes[:, 2] - left) / res - 0.5).astype(np.int64).clip(0, width)
+    r0 = np.ceil((top - boxes[:, 3]) / res - 0.5).astype(np.int64).clip(0, height)
+    r1 = np.ceil((top - boxes[:, 1]) / res - 0.5).astype(np.int64).clip(0, height)
+    keep = (c1 > c0) & (r1 > r0)
+    c0, c1, r0, r1 = c0[keep], c1[keep], r0[keep], r1[keep]
+    # every box is four corner increments, two cumulative sums count the
+    # boxes over each pixel without looping over boxes
+    diff = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(diff, (r0, c0), 1)
+    np.add.at(diff, (r0, c1), -1)
+    np.add.at(diff, (r1, c0), -1)
+    np.add.at(diff, (r1, c1), 1)
+    count = diff.cumsum(axis=0).cumsum(axis=1)[:height, :width]
+    return np.where(count > 0, CANOPY_FULL, 0).astype(np.uint8)
+
+
+def write_canopy_index(boxes, out_file, res=1e-5, bounds=None, chunk=4096,
+                       blocksize=512):
+    '''Rasterize Lng/Lat tree boxes into a canopy Cloud Optimized GeoTIFF.
+
+    The full resolution band is 255 under a crown and 0 elsewhere, the
+    overviews are built by averaging so every coarser level holds the
+    canopy density of its pixels. Chunks without trees are never written,
+    so open country costs no space.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        (n, 4) boxes as [min lng, min lat, max lng, max lat]
+    out_file : str
+        the .tif to write
+    res : float
+        the pixel size in degrees, the default is about 1m
+    bounds : tuple
+        (west, south, east, north) of the raster, defaults to the extent
+        of the boxes
+    chunk : int
+        the side in pixels of the chunks rasterized at once, bounds memory
+        use to a few chunk sized arrays
+    blocksize : int
+        the side in pixels of the tiff tiles
+
+    Returns
+    ----------
+    str
+        out_file
+    '''
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    if bounds is None:
+        if not len(boxes):
+            raise ValueError('No boxes and no bounds to build a canopy index from')
+        bounds = (*boxes[:, :2].min(axis=0), *boxes[:, 2:].max(axis=0))
+    # snap the grid to the resolution so indexes of one region line up
+    west = np.floor(bounds[0] / res) * res
+    north = np.ceil(bounds[3] / res) * res
+    width = max(int(np.ceil((bounds[2] - west) / res)), 1)
+    height = max(int(np.ceil((north - bounds[1]) / res)), 1)
+    chunk = max(chunk // blocksize, 1) * blocksize
+
+    tmp_file = out_file + '.tmp.tif'
+    profile = dict(driver='GTiff', width=width, height=height, count=1,
+                   dtype='uint8', nodata=None, crs=CANOPY_CRS,
+                   transform=rasterio.transform.from_origin(west, north, res, res),
+                   tiled=True, blockxsize=blocksize, blockysize=blocksize,
+                   compress='deflate', sparse_ok=True, bigtiff='IF_SAFER')
+    with rasterio.open(tmp_file, 'w', **profile) as dst:
+        for row in range(0, height, chunk):
+            top = north - row * res
+            rows = min(chunk, height - row)
+            in_rows = (boxes[:, 3] > top - rows * res) & (boxes[:, 1] < top)
+            for col in range(0, width, chunk):
+                left = west + col * res
+                cols = min(chunk, width - col)
+                in_chunk = in_rows & (boxes[:, 2] > left) & (boxes[:, 0] < left + cols * res)
+                if not in_chunk.any():
+                    continue
+                dst.write(_burn(boxes[in_chunk], top, left, res, rows, cols),
+                          1, window=Window(col, row, cols, rows))
+
+    # the COG driver writes the overviews first and the tiles in order, so
+    # a reader only ever fetches the blocks it samples
+    rio_copy(tmp_file, out_file, driver='COG', BLOCKSIZE=blocksize,
+             COMPRESS='DEFLATE', OVERVIEW_RESAMPLING='AVERAGE',
+             SPARSE_OK='TRUE', BIGTIFF='IF_SAFER')
+    os.remove(tmp_file)
+    return out_file
+
+
+def build_canopy_index(xml_files, out_file, **kwargs):
+    '''Roll the VOC labels written by mapRetrieve.save_map into one canopy
+    index, see write_canopy_index for the keyword arguments.
+
+    Parameters
+    ----------
+    xml_files : list
+        VOC xml files, each next to its georeferenced map png
+    out_file : str
+        the .tif to write
+    '''
+    boxes = [lnglat_boxes(*load_voc_boxes(xml_file)) for xml_file in xml_files]
+    boxes = np.concatenate(boxes) if boxes else np.zeros((0, 4))
+    return write_canopy_index(boxes, out_file, **kwargs)
+
+
+class canopyIndex():
+    def __init__(self, index_file, overview_level=None):
+        '''Sample a canopy index written by write_canopy_index.
+
+        A dataset handle is not thread safe, open one canopyIndex per
+        worker, the file itself is shared read only.
+
+        Parameters
+        ----------
+        index_file : str
+            the canopy .tif
+        overview_level : int
+            read an overview instead of the full resolution, 0 is the
+            first overview, coarser levels give smoothed densities
+        '''
+        kwargs = {} if overview_level is None else {'overview_level': overview_level}
+        self.src = rasterio.open(index_file, **kwargs)
+        self.block_height, self.block_width = self.src.block_shapes[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.src.close()
+
+    def sample(self, lng, lat):
+        '''Get the canopy density at many points, reading each block the
+        points fall in once.
+
+        Parameters
+        ----------
+        lng, lat : np.ndarray
+            the point coordinates
+
+        Returns
+        ----------
+        np.ndarray
+            the density of every point from 0 to 1, 0 off the raster
+        '''
+        lng = np.asarray(lng, dtype=float).ravel()
+        lat = np.asarray(lat, dtype=float).ravel()
+        inverse = ~self.src.transform
+        col = np.floor(inverse.c + inverse.a * lng + inverse.b * lat).astype(np.int64)
+        row = np.floor(inverse.f + inverse.d * lng + inverse.e * lat).astype(np.int64)
+        values = np.zeros(len(lng))
+        inside = np.flatnonzero((col >= 0) & (col < self.src.width) &
+                                (row >= 0) & (row < self.src.height))
+        if not len(inside):
+            return values
+
+        col, row = col[inside], row[inside]
+        blocks, block_index = np.unique(
+            np.stack([row // self.block_height, col // self.block_width], axis=1),
+            axis=0, return_inverse=True)
+        block_index = block_index.ravel()
+        order = np.argsort(block_index, kind='stable')
+        splits = np.searchsorted(block_index[order], np.arange(1, len(blocks)))
+        for (block_row, block_col), points in zip(blocks, np.split(order, splits)):
+            window = Window(block_col * self.block_width, block_row * self.block_height,
+                            self.block_width, self.block_height)
+            window = window.intersection(Window(0, 0, self.src.width, self.src.height))
+            data = self.src.read(1, window=window)
+            values[inside[points]] = data[row[points] - window.row_off,
+                                          col[points] - window.col_off]
+        return values / CANOPY_FULL
+
+    def score(self, corridor, spacing=2.0, across=3):
+        '''Score one route, see score_routes.'''
+        return self.score_routes([corridor], spacing, across)[0]
+
+    def score_routes(self, corridors, spacing=2.0, across=3):
+        '''Get the shaded fraction of every segment and of the whole route
+        by sampling the index on a grid over each corridor, the same
+        scores as treeIndex.score_routes without any geometry.
+
+        Parameters
+        ----------
+        corridors : list
+            routeCorridor tuples from google_apis.route_corridors
+        spacing : float
+            meters between samples along a segment
+        across : int
+            samples across the corridor
+
+        Returns
+        ----------
+        list
+            per route, an array of the shaded fraction of each segment
+            and the shaded fraction of the route weighted by length
+        '''
+        counts = [len(c.lengths) for c in corridors]
+        if not sum(counts):
+            return [(np.zeros(0), 0.0) for _ in corridors]
+        polygons = np.concatenate([c.polygons_lnglat for c in corridors]).reshape(-1, 4, 2)
+        lengths = np.concatenate([c.lengths for c in corridors])
+
+        # samples at the centers of an along by across grid over every
+        # corridor rectangle, corners run start+, end+, end-, start-
+        n_along = np.maximum(np.ceil(lengths / spacing).astype(np.int64), 1)
+        n_samples = n_along * across
+        seg_index = np.repeat(np.arange(len(lengths)), n_samples)
+        offset = np.arange(n_samples.sum()) - np.repeat(np.cumsum(n_samples) - n_samples, n_samples)
+        u = ((offset // across) + 0.5) / n_along[seg_index]
+        v = ((offset % across) + 0.5) / across
+        corners = polygons[seg_index]
+        points = (corners[:, 0] + u[:, None] * (corners[:, 1] - corners[:, 0]) +
+                  v[:, None] * (corners[:, 3] - corners[:, 0]))
+
+        density = self.sample(points[:, 0], points[:, 1])
+        fractions = np.bincount(seg_index, weights=density, minlength=len(lengths)) / n_samples
+
+        scores = []
+        start = 0
+        for corridor, count in zip(corridors, counts):
+            weights = corridor.lengths
+            total = weights.sum()
+            route_fractions = fractions[start:start + count]
+            scores.append((route_fractions,
+                           float((route_fractions * weights).sum() / total) if total else 0.0))
+            start += count
+        return scores
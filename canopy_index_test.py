@@ -0,0 +1,68 @@
+from canopy_index import build_canopy_index, write_canopy_index, canopyIndex
+from google_apis import route_corridors
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class TestCanopyIndex(unittest.TestCase):
+    """
+    Testing the canopy index build and sampling
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.index_file = os.path.join(cls.temp_dir.name, 'canopy.tif')
+        # one park about 100m on a side and a lone tree to the east
+        boxes = np.array([[-97.1510, 33.2090, -97.1500, 33.2100],
+                          [-97.1450, 33.2095, -97.14497, 33.20953]])
+        write_canopy_index(boxes, cls.index_file, bounds=(-97.16, 33.20, -97.14, 33.22),
+                           chunk=512, blocksize=256)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_sample(self):
+        with canopyIndex(self.index_file) as index:
+            density = index.sample([-97.1505, -97.1480, -97.1449850, -98.0],
+                                   [33.2095, 33.2095, 33.2095150, 33.2095])
+        np.testing.assert_array_equal(density, [1, 0, 1, 0])
+
+    def test_overviews(self):
+        with canopyIndex(self.index_file) as index:
+            self.assertTrue(index.src.overviews(1))
+        with canopyIndex(self.index_file, overview_level=0) as index:
+            density = index.sample([-97.1505], [33.2095])
+        self.assertGreater(density[0], 0)
+
+    def test_score_routes(self):
+        shaded = route_corridors([[33.2093, -97.1508], [33.2097, -97.1502]])
+        open_route = route_corridors([[33.2150, -97.1550], [33.2150, -97.1520]])
+        with canopyIndex(self.index_file) as index:
+            scores = index.score_routes([shaded, open_route])
+        self.assertAlmostEqual(scores[0][1], 1.0)
+        self.assertEqual(scores[1][1], 0.0)
+        self.assertEqual(len(scores[0][0]), 1)
+
+    def test_build_from_geotiff(self):
+        from MapRetrieve import mapRetrieve
+        from benchmark import make_sample, SAMPLE_NAME
+
+        # a map over max_pixels is saved as a GeoTIFF without a sidecar
+        folder = lambda name: os.path.join(self.temp_dir.name, name)
+        zip_file, src_file = make_sample(folder('data'), n_shapes=200, src_pixels=512)
+        mr = mapRetrieve(in_folder=folder('data'), out_folder=folder('maps'),
+                         label_folder=folder('labels'), src_file=src_file,
+                         max_pixels=100*100, chunk=128)
+        build = mr.save_map(zip_file)
+        self.assertTrue(build['map_file'].endswith('.tif'))
+        index_file = folder('geotiff_canopy.tif')
+        build_canopy_index([os.path.join(folder('labels'), SAMPLE_NAME + '.xml')], index_file)
+        with canopyIndex(index_file) as index:
+            self.assertGreater(index.src.read(1).max(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,274 @@
+# packs encoded image tiles and their boxes into a few large shard files
+# with an index, so training reads big sequential files instead of tens
+# of thousands of small png and xml files
+
+import json
+import os
+from io import BytesIO
+
+import numpy as np
+
+from box_store import boxStore
+
+INDEX_FILE = 'index.json'
+
+
+class shardWriter():
+    def __init__(self, out_folder, shard_size=1000, fmt='npz',
+                 classes=('tree',)):
+        '''Write records of (encoded image, boxes, labels) into shards.
+
+        The npz format writes each shard as a .bin file of the encoded
+        images back to back plus a .npz of the boxes and labels. The
+        tfrecord format writes tf.train.Example records in the schema of
+        the TF2 Object Detection API (image size and format, boxes
+        normalized to the image, class text and 1 based class ids), this
+        needs tensorflow.
+
+        Parameters
+        ----------
+        out_folder : str
+            the folder to write the shards and index.json to
+        shard_size : int
+            the number of records per shard
+        fmt : str
+            'npz' or 'tfrecord'
+        classes : tuple
+            class names, a box label is the index of its name
+        '''
+        if fmt not in ('npz', 'tfrecord'):
+            raise ValueError(f'Unknown shard format {fmt}')
+        self.out_folder = out_folder
+        self.shard_size = shard_size
+        self.fmt = fmt
+        self.classes = list(classes)
+        os.makedirs(self.out_folder, exist_ok=True)
+        self.shards = []
+        self.records = {'shard': [], 'offset': [], 'length': [], 'name': []}
+        self._file = None
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_shard(self):
+        shard_name = f'shard-{len(self.shards):05d}'
+        self.shards.append(shard_name)
+        if self.fmt == 'npz':
+            self._file = open(os.path.join(self.out_folder, shard_name + '.bin'), 'wb')
+        else:
+            import tensorflow as tf
+            self._file = tf.io.TFRecordWriter(
+                os.path.join(self.out_folder, shard_name + '.tfrecord'))
+        self._offset = 0
+        self._pending = []
+
+    def _close_shard(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if self.fmt == 'npz':
+            # boxes of all records in the shard are stored back to back
+            counts = [len(boxes) for boxes, _ in self._pending]
+            np.savez(os.path.join(self.out_folder, self.shards[-1] + '.npz'),
+                     boxes=np.concatenate([b for b, _ in self._pending]).astype(np.float32)
+                     if self._pending else np.zeros((0, 4), np.float32),
+                     labels=np.concatenate([l for _, l in self._pending]).astype(np.int32)
+                     if self._pending else np.zeros(0, np.int32),
+                     box_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        self._file = None
+
+    def add(self, image, boxes, labels, name=''):
+        '''Append one record to the current shard.
+
+        Parameters
+        ----------
+        image : bytes
+            the encoded (png or jpg) image
+        boxes : np.ndarray
+            (n, 4) pixel boxes as [xmin, ymin, xmax, ymax]
+        labels : np.ndarray
+            (n,) class index of each box
+        name : str
+            the name of the image, kept in the index
+        '''
+        if self._file is None or len(self._pending) >= self.shard_size:
+            self._close_shard()
+            self._open_shard()
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+        if self.fmt == 'npz':
+            self._file.write(image)
+            length = len(image)
+        else:
+            record = self._example(image, boxes, labels, name)
+            self._file.write(record)
+            # tfrecord framing is a length, its crc, the data and its crc
+            length = 8 + 4 + len(record) + 4
+        self.records['shard'].append(len(self.shards) - 1)
+        self.records['offset'].append(self._offset)
+        self.records['length'].append(length)
+        self.records['name'].append(name)
+        self._offset += length
+        self._pending.append((boxes, labels))
+
+    def _example(self, image, boxes, labels, name):
+        import tensorflow as tf
+        from PIL import Image
+
+        # only the header is read for the size and format
+        with Image.open(BytesIO(image)) as img:
+            (width, height), fmt = img.size, img.format.lower()
+
+        def bytes_feature(values):
+            return tf.train.Feature(bytes_list=tf.train.BytesList(value=values))
+
+        def float_feature(values):
+            return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+        def int64_feature(values):
+            return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+        feature = {
+            'image/height': int64_feature([height]),
+            'image/width': int64_feature([width]),
+            'image/filename': bytes_feature([name.encode()]),
+            'image/source_id': bytes_feature([name.encode()]),
+            'image/encoded': bytes_feature([image]),
+            'image/format': bytes_feature([fmt.encode()]),
+            'image/object/bbox/xmin': float_feature(boxes[:, 0] / width),
+            'image/object/bbox/xmax': float_feature(boxes[:, 2] / width),
+            'image/object/bbox/ymin': float_feature(boxes[:, 1] / height),
+            'image/object/bbox/ymax': float_feature(boxes[:, 3] / height),
+            'image/object/class/text': bytes_feature([self.classes[l].encode() for l in labels]),
+            # label maps start at 1, 0 is the background
+            'image/object/class/label': int64_feature(labels + 1),
+        }
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        return example.SerializeToString()
+
+    def add_voc(self, xml_file, image_file=None):
+        '''Append the image and boxes of a VOC label file.
+
+        Parameters
+        ----------
+        xml_file : str
+            a VOC xml file
+        image_file : str
+            the image of the label, defaults to the path in the VOC when
+            that file exists and to its file name next to the xml file
+            otherwise, see boxStore.read_voc
+        '''
+        voc = boxStore.read_voc(xml_file)
+        if image_file is None:
+            image_file = voc.images[0]
+        # class names used in the VOC and new to the shards are added to
+        # their class list, then the VOC class ids are mapped onto it
+        ids, inverse = np.unique(voc.class_ids, return_inverse=True)
+        for name in (voc.classes[i] for i in ids):
+            if name not in self.classes:
+                self.classes.append(name)
+        lookup = np.array([self.classes.index(voc.classes[i]) for i in ids], dtype=np.int64)
+        with open(image_file, 'rb') as f:
+            self.add(f.read(), voc.boxes, lookup[inverse.ravel()],
+                     name=os.path.basename(image_file))
+
+    def close(self):
+        '''Finish the last shard and write the index.'''
+        self._close_shard()
+        index = {'format': self.fmt, 'classes': self.classes,
+                 'shards': self.shards, 'records': self.records}
+        with open(os.path.join(self.out_folder, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+
+
+class shardReader():
+    def __init__(self, folder):
+        '''Read records back from shards written by shardWriter, either
+        by index or streamed in order.
+
+        Parameters
+        ----------
+        folder : str
+            the folder holding the shards and index.json
+        '''
+        self.folder = folder
+        with open(os.path.join(folder, INDEX_FILE)) as f:
+            index = json.load(f)
+        self.fmt = index['format']
+        self.classes = index['classes']
+        self.shards = index['shards']
+        records = index['records']
+        self.shard = np.array(records['shard'], dtype=np.int64)
+        self.offset = np.array(records['offset'], dtype=np.int64)
+        self.length = np.array(records['length'], dtype=np.int64)
+        self.names = records['name']
+        # position of every record within its shard
+        shard_starts = np.searchsorted(self.shard, np.arange(len(self.shards)))
+        self.position = np.arange(len(self.shard)) - shard_starts[self.shard]
+        self._boxes = dict()
+
+    def __len__(self):
+        return len(self.shard)
+
+    def _shard_file(self, shard):
+        ext = '.bin' if self.fmt == 'npz' else '.tfrecord'
+        return os.path.join(self.folder, self.shards[shard] + ext)
+
+    def _shard_boxes(self, shard):
+        # box arrays are small, keep the last few shards loaded
+        if shard not in self._boxes:
+            if len(self._boxes) > 8:
+                self._boxes.pop(next(iter(self._boxes)))
+            with np.load(os.path.join(self.folder, self.shards[shard] + '.npz')) as npz:
+                self._boxes[shard] = {k: npz[k] for k in npz.files}
+        return self._boxes[shard]
+
+    def _record(self, i, data):
+        if self.fmt == 'tfrecord':
+            return self._parse_example(data[12:-4])
+        shard = self.shard[i]
+        boxes = self._shard_boxes(shard)
+        b0, b1 = boxes['box_offsets'][self.position[i]:self.position[i] + 2]
+        return {'image': data, 'boxes': boxes['boxes'][b0:b1],
+                'labels': boxes['labels'][b0:b1], 'name': self.names[i]}
+
+    def _parse_example(self, record):
+        import tensorflow as tf
+        feature = tf.train.Example.FromString(record).features.feature
+        width = feature['image/width'].int64_list.value[0]
+        height = feature['image/height'].int64_list.value[0]
+        # back to pixel boxes and class indexes, as in the npz format
+        boxes = np.stack([np.array(feature[f'image/object/bbox/{k}'].float_list.value,
+                                   dtype=np.float32) for k in ('xmin', 'ymin', 'xmax', 'ymax')],
+                         axis=1) * np.float32([width, height, width, height])
+        return {'image': feature['image/encoded'].bytes_list.value[0],
+                'boxes': boxes.reshape(-1, 4),
+                'labels': np.array(feature['image/object/class/label'].int64_list.value,
+                                   dtype=np.int32) - 1,
+                'name': feature['image/filename'].bytes_list.value[0].decode()}
+
+    def __getitem__(self, i):
+        '''Read one record with a single seek into its shard.'''
+        with open(self._shard_file(self.shard[i]), 'rb') as f:
+            f.seek(self.offset[i])
+            data = f.read(self.length[i])
+        return self._record(i, data)
+
+    def __iter__(self):
+        '''Stream every record in order, reading each shard front to back.'''
+        for shard in range(len(self.shards)):
+            records = np.flatnonzero(self.shard == shard)
+            with open(self._shard_file(shard), 'rb') as f:
+                for i in records:
+                    yield self._record(i, f.read(self.length[i]))
+
+    def tf_dataset(self):
+        '''A tf.data.TFRecordDataset over the shards (tfrecord format only).'''
+        import tensorflow as tf
+        if self.fmt != 'tfrecord':
+            raise ValueError('tf_dataset needs shards written as tfrecord')
+        return tf.data.TFRecordDataset([self._shard_file(s) for s in range(len(self.shards))])
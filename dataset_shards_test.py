@@ -0,0 +1,139 @@
+from dataset_shards import shardWriter, shardReader
+from box_store import boxStore
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import unittest
+import tempfile
+import struct
+import os
+
+# crc32c (Castagnoli) table for checking the tfrecord framing by hand
+CRC_TABLE = []
+for n in range(256):
+    c = n
+    for _ in range(8):
+        c = (c >> 1) ^ 0x82F63B78 if c & 1 else c >> 1
+    CRC_TABLE.append(c)
+
+
+def masked_crc(data):
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = CRC_TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    crc ^= 0xFFFFFFFF
+    return (((crc >> 15) | (crc << 17)) + 0xA282EAD8) & 0xFFFFFFFF
+
+
+def png(width, height, value):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), (value, value, value)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class TestDatasetShards(unittest.TestCase):
+    """
+    Testing shards written and read back in both formats
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # three records over two shards, the last without any boxes
+        self.records = [(png(64, 32, 10), [[1, 2, 30, 20], [40, 0, 64, 32]], [0, 1], 'a.png'),
+                        (png(16, 16, 20), [[4, 4, 8, 8]], [1], 'b.png'),
+                        (png(8, 8, 30), np.zeros((0, 4)), [], 'c.png')]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, fmt):
+        folder = os.path.join(self.temp_dir.name, fmt)
+        with shardWriter(folder, shard_size=2, fmt=fmt, classes=('tree', 'shrub')) as writer:
+            for image, boxes, labels, name in self.records:
+                writer.add(image, boxes, labels, name=name)
+        return shardReader(folder)
+
+    def check(self, reader):
+        self.assertEqual(len(reader), 3)
+        self.assertEqual(len(reader.shards), 2)
+        self.assertEqual(reader.classes, ['tree', 'shrub'])
+        # by index, out of order, and streamed
+        by_index = {i: reader[i] for i in (2, 0, 1)}
+        for records in ([by_index[i] for i in range(3)], list(reader)):
+            for record, (image, boxes, labels, name) in zip(records, self.records):
+                self.assertEqual(record['image'], image)
+                self.assertEqual(record['name'], name)
+                np.testing.assert_allclose(record['boxes'], np.reshape(boxes, (-1, 4)), atol=1e-4)
+                np.testing.assert_array_equal(record['labels'], labels)
+
+    def test_npz(self):
+        self.check(self.write('npz'))
+
+    def test_tfrecord(self):
+        import tensorflow as tf
+        reader = self.write('tfrecord')
+        self.check(reader)
+
+        # every indexed record is length, crc, data, crc
+        for i in range(len(reader)):
+            with open(reader._shard_file(reader.shard[i]), 'rb') as f:
+                f.seek(reader.offset[i])
+                data = f.read(reader.length[i])
+            length, length_crc = struct.unpack('<QI', data[:12])
+            self.assertEqual(length, len(data) - 16)
+            self.assertEqual(length_crc, masked_crc(data[:8]))
+            self.assertEqual(struct.unpack('<I', data[-4:])[0], masked_crc(data[12:-4]))
+
+        # the schema the TF2 Object Detection API decodes
+        spec = {'image/height': tf.io.FixedLenFeature([], tf.int64),
+                'image/width': tf.io.FixedLenFeature([], tf.int64),
+                'image/format': tf.io.FixedLenFeature([], tf.string),
+                'image/encoded': tf.io.FixedLenFeature([], tf.string),
+                'image/object/bbox/xmin': tf.io.VarLenFeature(tf.float32),
+                'image/object/bbox/xmax': tf.io.VarLenFeature(tf.float32),
+                'image/object/bbox/ymin': tf.io.VarLenFeature(tf.float32),
+                'image/object/bbox/ymax': tf.io.VarLenFeature(tf.float32),
+                'image/object/class/text': tf.io.VarLenFeature(tf.string),
+                'image/object/class/label': tf.io.VarLenFeature(tf.int64)}
+        first = tf.io.parse_single_example(next(iter(reader.tf_dataset())), spec)
+        self.assertEqual((int(first['image/height']), int(first['image/width'])), (32, 64))
+        self.assertEqual(first['image/format'].numpy(), b'png')
+        np.testing.assert_allclose(tf.sparse.to_dense(first['image/object/bbox/xmax']).numpy(),
+                                   [30 / 64, 1.0])
+        self.assertEqual(tf.sparse.to_dense(first['image/object/class/text']).numpy().tolist(),
+                         [b'tree', b'shrub'])
+        self.assertEqual(tf.sparse.to_dense(first['image/object/class/label']).numpy().tolist(),
+                         [1, 2])
+
+    def test_add_voc(self):
+        # tiles in one folder and their labels in another
+        tiles = os.path.join(self.temp_dir.name, 'tiles')
+        labels = os.path.join(self.temp_dir.name, 'labels')
+        os.makedirs(tiles)
+        os.makedirs(labels)
+        images = [os.path.join(tiles, f'{name}.png') for name in 'abc']
+        for image_file, (image, *_) in zip(images, self.records):
+            with open(image_file, 'wb') as f:
+                f.write(image)
+        store = boxStore([[1, 2, 30, 20], [40, 0, 64, 32], [4, 4, 8, 8]],
+                         class_ids=[0, 1, 1], classes=['vine', 'shrub'], image_ids=[0, 0, 1],
+                         images=images, sizes=[(64, 32, 3), (16, 16, 3), (8, 8, 3)])
+        xml_files = store.write_voc(labels)
+
+        folder = os.path.join(self.temp_dir.name, 'voc')
+        with shardWriter(folder, shard_size=2, classes=('tree', 'shrub')) as writer:
+            for xml_file in xml_files:
+                writer.add_voc(xml_file)
+        reader = shardReader(folder)
+        # only the new class name in use is added
+        self.assertEqual(reader.classes, ['tree', 'shrub', 'vine'])
+        records = list(reader)
+        self.assertEqual([r['name'] for r in records], ['a.png', 'b.png', 'c.png'])
+        self.assertEqual(records[0]['image'], self.records[0][0])
+        np.testing.assert_array_equal(records[0]['boxes'], [[1, 2, 30, 20], [40, 0, 64, 32]])
+        np.testing.assert_array_equal(records[0]['labels'], [2, 1])
+        np.testing.assert_array_equal(records[1]['labels'], [1])
+        self.assertEqual(len(records[2]['labels']), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# resolves the EPSG code of an ESRI .prj file locally, replacing the
+# spatialreference.org lookup so shapes can be processed offline
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+def _utm_table():
+    '''Build the bundled lookup of ESRI UTM projection names to EPSG codes.
+    The CMS LiDAR shapes are almost all in one of these zones.'''
+    table = dict()
+    for zone in range(1, 61):
+        table[f'WGS_1984_UTM_Zone_{zone}N'] = 32600 + zone
+        table[f'WGS_1984_UTM_Zone_{zone}S'] = 32700 + zone
+    for zone in range(1, 24):
+        table[f'NAD_1983_UTM_Zone_{zone}N'] = 26900 + zone
+    for zone in range(1, 23):
+        table[f'NAD_1927_UTM_Zone_{zone}N'] = 26700 + zone
+    return table
+
+
+UTM_EPSG = _utm_table()
+
+
+class epsgResolver():
+    def __init__(self, cache_file=None):
+        '''Resolve ESRI WKT projections to EPSG codes with an on-disk memo.
+
+        Parameters
+        ----------
+        cache_file : str
+            a json file memoizing resolved codes keyed by a hash of the
+            .prj contents, nothing is persisted when None
+        '''
+        self.cache_file = cache_file
+        self.memo = dict()
+        if self.cache_file and os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.memo = json.load(f)
+
+    @staticmethod
+    def prj_key(prj):
+        return hashlib.sha1(prj.strip().encode()).hexdigest()
+
+    def resolve(self, prj):
+        '''Get the EPSG code of an ESRI WKT projection string.
+
+        Parameters
+        ----------
+        prj : str
+            the contents of an ESRI .prj file
+
+        Returns
+        ----------
+        str
+            the EPSG code in the format 'EPSG:26910'
+
+        Raises
+        ----------
+        ValueError
+            if the projection does not match any EPSG code
+        '''
+        key = self.prj_key(prj)
+        if key in self.memo:
+            return self.memo[key]
+
+        epsg = None
+        # try the bundled table on the PROJCS name before parsing the wkt
+        name = re.match(r'\s*PROJCS\["([^"]+)"', prj)
+        if name and name.group(1) in UTM_EPSG:
+            epsg = UTM_EPSG[name.group(1)]
+        else:
+            # pyproj is only loaded for projections missing from the table
+            from pyproj import CRS
+            epsg = CRS.from_wkt(prj).to_epsg()
+        if epsg is None:
+            raise ValueError(f'No EPSG code matches projection:\n {prj}')
+
+        epsg = f'EPSG:{epsg}'
+        logging.info(f'\nResolved {epsg}')
+        self.memo[key] = epsg
+        self.save()
+        return epsg
+
+    def save(self):
+        if not self.cache_file:
+            return
+        # merge in codes other workers resolved since we loaded the cache
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.memo = {**json.load(f), **self.memo}
+        # write to a per-process temp file first so that concurrent workers
+        # sharing the cache never leave a torn json file behind
+        tmp_file = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.memo, f, indent=1)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,51 @@
+from epsg_resolver import epsgResolver
+import unittest
+import tempfile
+import os
+
+UTM_10N = 'PROJCS["NAD_1983_UTM_Zone_10N",GEOGCS["GCS_North_American_1983",'\
+          'DATUM["D_North_American_1983",SPHEROID["GRS_1980",6378137.0,'\
+          '298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",'\
+          '0.0174532925199433]],PROJECTION["Transverse_Mercator"],'\
+          'PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],'\
+          'PARAMETER["Central_Meridian",-123.0],PARAMETER["Scale_Factor",0.9996],'\
+          'PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
+
+
+class TestEpsgResolver(unittest.TestCase):
+    """
+    Testing epsgResolver class methods
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp_dir.name, 'epsg_cache.json')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resolve_utm(self):
+        """
+        Testing a UTM zone is resolved from the bundled table.
+        """
+        resolver = epsgResolver(self.cache_file)
+        self.assertEqual(resolver.resolve(UTM_10N), 'EPSG:26910')
+
+    def test_resolve_wkt(self):
+        """
+        Testing a projection outside the bundled table is parsed from wkt.
+        """
+        prj = UTM_10N.replace('NAD_1983_UTM_Zone_10N', 'custom_zone')
+        resolver = epsgResolver(self.cache_file)
+        self.assertEqual(resolver.resolve(prj), 'EPSG:26910')
+
+    def test_memo_persists(self):
+        """
+        Testing resolved codes are reloaded from the cache file.
+        """
+        epsgResolver(self.cache_file).resolve(UTM_10N)
+        resolver = epsgResolver(self.cache_file)
+        self.assertIn(resolver.prj_key(UTM_10N), resolver.memo)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,18 +1,12 @@
-import os
-from map_retrieve import mapRetrieve
-from glob import glob
+import sys
 
-# create the mapRetrieve object
-mr = mapRetrieve()
+from shademyrun import main
 
-zip_files = glob('/media/zac/Seagate Portable Drive/orders/f06d9ed2c630d7ad6ecfd53ecda4d412/CMS_LiDAR_AGB_California/data/*.zip')
-# for each zip file run the save_map method
-count = 10000
-for zf in zip_files:
-    count = count -1
-    if count > 0:
-        print(zf)
-        print(count)
-        mr.save_map(zf)
-    else:
-        continue
+# kept for old workflows, the same as
+#   python shademyrun.py fetch '<orders>/data/*.zip' --workers 8 --limit 9999
+# finished zips are recorded in maps/ledger.jsonl so re-running resumes where
+# the last run stopped, and only rebuilds the maps and labels of zips whose
+# inputs changed (new or updated zips, another imagery source or other label
+# thresholds)
+zip_pattern = '/media/zac/Seagate Portable Drive/orders/f06d9ed2c630d7ad6ecfd53ecda4d412/CMS_LiDAR_AGB_California/data/*.zip'
+main(['fetch', zip_pattern, '--workers', '8', '--limit', '9999', *sys.argv[1:]])
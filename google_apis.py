@@ -1,36 +1,146 @@
-import requests
 import re
 import webbrowser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # Directions API / Static Maps API Documentation
 # https://developers.google.com/maps/documentation/directions/overview
 # https://developers.google.com/maps/documentation/maps-static/overview
 
+DIRECTIONS_URL = "https://maps.googleapis.com/maps/api/directions/json?"
+
+
+def make_session(pool_size=8, retries=3, backoff=0.5):
+    '''Returns a requests session that keeps up to pool_size connections
+    open per host and retries failed or rate limited calls with
+    exponential backoff'''
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=['GET'])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def fetch_routes(pairs, key="API Key", max_workers=8, retries=3, backoff=0.5,
+                 directions=DIRECTIONS_URL, mode='walking', cache=None):
+    '''Fetches the routes of many origin/destination pairs concurrently
+    over one pooled session, at most max_workers requests at a time.
+    Routes found in the routeCache given as cache skip the API call.
+    Returns a Coordinates object per pair, in order, with gps_coord_pairs
+    filled in'''
+    session = make_session(pool_size=max_workers, retries=retries, backoff=backoff)
+    routes = [Coordinates(origin, destination, key=key, directions=directions,
+                          mode=mode, cache=cache)
+              for origin, destination in pairs]
+    with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # list() so any request error is raised here
+        list(pool.map(lambda route: route.return_coordinates(session), routes))
+    return routes
+
+
+# corridor of every route segment, metric arrays are in the crs projection
+routeCorridor = namedtuple('routeCorridor', ['crs', 'segments', 'polygons',
+                                             'polygons_lnglat', 'lengths'])
+
+
+def utm_crs(lat, lng):
+    '''Returns the WGS 84 UTM zone EPSG code containing a point'''
+    zone = int((lng + 180) // 6) % 60 + 1
+    return f'EPSG:{32600 + zone if lat >= 0 else 32700 + zone}'
+
+
+def route_corridors(points, width=13.4):
+    '''Buffers every segment of a route into a rectangle width meters wide
+    (13.4m is 6.7m both sides of the road), all segments at once.
+    points is an (n, 2) array of Lat/Lng. Returns a routeCorridor with
+        crs - the UTM zone the metric arrays are in
+        segments - (m, 2, 2) segment end points in meters
+        polygons - (m, 4, 2) corridor corners in meters
+        polygons_lnglat - (m, 4, 2) corridor corners as Lng/Lat
+        lengths - (m,) segment lengths in meters
+    Zero length segments are dropped'''
+    import numpy as np
+    from pyproj import Transformer
+
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    # an empty route has nothing to project
+    crs = utm_crs(*points.mean(axis=0)) if len(points) else 'EPSG:4326'
+    to_metric = Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+    x, y = to_metric.transform(points[:, 1], points[:, 0])
+    metric = np.stack([x, y], axis=1)
+
+    start, end = metric[:-1], metric[1:]
+    delta = end - start
+    lengths = np.hypot(delta[:, 0], delta[:, 1])
+    keep = lengths > 0
+    start, end, delta, lengths = start[keep], end[keep], delta[keep], lengths[keep]
+
+    # unit normal of every segment scaled to half the corridor width
+    normal = np.stack([-delta[:, 1], delta[:, 0]], axis=1) / lengths[:, None] * (width / 2)
+    polygons = np.stack([start + normal, end + normal, end - normal, start - normal], axis=1)
+
+    to_lnglat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+    lng, lat = to_lnglat.transform(polygons[..., 0], polygons[..., 1])
+    polygons_lnglat = np.stack([lng, lat], axis=-1)
+    return routeCorridor(crs, np.stack([start, end], axis=1), polygons,
+                         polygons_lnglat, lengths)
+
+
 class Coordinates:
-    def __init__(self, origin, destination):
-        '''Setup attributes, including API urls'''
-        
+    def __init__(self, origin, destination, key="API Key", directions=DIRECTIONS_URL,
+                 mode='walking', cache=None):
+        '''Setup attributes, including API urls
+        cache is an optional routeCache shared between Coordinates objects'''
+        import numpy as np
+
         self.origin = origin.replace(' ' ,'+')
         self.destination = destination.replace(' ','+')
-        self.key = "API Key"
-        self.directions = "https://maps.googleapis.com/maps/api/directions/json?"
+        self.key = key
+        self.directions = directions
+        self.mode = mode
+        self.cache = cache
         self.maps_static  = "https://maps.googleapis.com/maps/api/staticmap?"
         self.gps_coord_pairs = []
+        self.route_points = np.zeros((0, 2))
     
 
-    def return_coordinates(self):
+    def return_coordinates(self, session=None):
         '''Returns coordinates for a given route based on 'steps' on google maps
-        Ex: 'Turn left at this intersection' = gps coordinate'''
-        
+        Ex: 'Turn left at this intersection' = gps coordinate
+        A pooled session (see make_session) can be passed to reuse connections'''
+        import requests
+        from polyline import decode_polyline
+
+        # Serve repeat routes from the cache without calling the API
+        if self.cache is not None:
+            cached = self.cache.get(self.origin, self.destination, self.mode)
+            if cached is not None:
+                points, self.route_points = cached
+                self.gps_coord_pairs = points.tolist()
+                self.gps_coord = [{'lat': lat, 'lng': lng} for lat, lng in self.gps_coord_pairs]
+                return self.gps_coord_pairs
+
         # Combine parameters with Directions API URL
-        coordinates = ('origin={}&destination={}&mode=walking&key={}'.
-                       format(self.origin, self.destination, self.key)
+        coordinates = ('origin={}&destination={}&mode={}&key={}'.
+                       format(self.origin, self.destination, self.mode, self.key)
                        )
         
         request_1 = self.directions + coordinates
-        response_1 = requests.get(request_1)
+        response_1 = (session or requests).get(request_1)
+        response_1.raise_for_status()
         directions = response_1.json()
         
+        # Full route geometry as an (n, 2) array of Lat/Lng
+        self.route_points = decode_polyline(directions['routes'][0]['overview_polyline']['points'])
+
         # Get coordinates list (of dictionaries)
         self.gps_coord = []
         for i in directions['routes'][0]['legs'][0]['steps']:
@@ -41,6 +151,10 @@ class Coordinates:
         for dictionary in self.gps_coord:
             pair = list(dictionary.values())
             self.gps_coord_pairs.append(pair)
+
+        if self.cache is not None:
+            self.cache.put(self.origin, self.destination, self.gps_coord_pairs,
+                           self.route_points, self.mode)
             
         return self.gps_coord_pairs
             
@@ -53,32 +167,11 @@ class Coordinates:
            
         print(lat_list, lng_list, sep='\n')    
 
-    '''
-        This method is for future purposes.
-        The goal here is to create a bounding box for a given route by
-        calculating gps location in relation to other pairs in the route (N vs S vs W vs E)
-        
-    def box_seg_1(self):
-        #Determine if x or y axis segment (N/S or E/W running bounding box) 
-        lat_dif_1 = [lat_list[0] - lat_list[1]]
-        lng_dif_1 = [lng_list[0] - lng_list[1]] 
-        OFFSET = 0.00006 # OFFSET allows for 13.4 meter wide box along axis (6.7m both sides of road)
-        if lat_dif_1 > lng_dif_1: # greater differnece in latitude indicate x-axis (north-south) 
-            bb_pt1 = lat_list[0], lng_list[0] + OFFSET
-            bb_pt2 = lat_list[0], lng_list[0] - OFFSET
-            bb_pt3 = lat_list[1], lng_list[1] + OFFSET
-            bb_pt4 = lat_list[1], lng_list[1] - OFFSET
-        else: # greater difference in longitude indicates y-axis (east-west)
-            bb_pt1 = lat_list[0] + OFFSET, lng_list[0]
-            bb_pt2 = lat_list[0] - OFFSET, lng_list[0]
-            bb_pt3 = lat_list[1] + OFFSET, lng_list[1]
-            bb_pt4 = lat_list[1] - OFFSET, lng_list[1]
-        # Create bb_seg1 to set as static map poly-line parameters 
-             bb_seg1 = bb_pt1, bb_pt2, bb_pt3, bb_pt4
-            print(bb_seg1)
-            #Need to build in loop function to perform on multiple legs of route
-    '''
-    
+    def corridors(self, width=13.4):
+        '''Returns the shade-scoring corridor of every segment of the full
+        route geometry, see route_corridors'''
+        return route_corridors(self.route_points, width=width)
+
     def return_image(self):
         '''Returns an image of the route produced from given origin/destination'''
         # Clean gps_coord to use as parameter
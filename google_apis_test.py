@@ -0,0 +1,142 @@
+from google_apis import fetch_routes, route_corridors
+from polyline import encode_polyline
+from route_cache import routeCache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import threading
+import unittest
+import json
+
+
+class MockDirections(BaseHTTPRequestHandler):
+    """
+    Stand-in for the Directions API, the route has one step per character
+    of the origin and the first request for every origin fails with a 503
+    """
+    seen = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        origin = parse_qs(urlparse(self.path).query)['origin'][0]
+        with MockDirections.lock:
+            first = origin not in MockDirections.seen
+            MockDirections.seen.add(origin)
+        if first:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        steps = [{'start_location': {'lat': 33.0 + i, 'lng': -97.0}}
+                 for i in range(len(origin))]
+        overview = encode_polyline([[33.0 + i, -97.0] for i in range(len(origin))])
+        body = json.dumps({'routes': [{'legs': [{'steps': steps}],
+                                       'overview_polyline': {'points': overview}}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchRoutes(unittest.TestCase):
+    """
+    Testing concurrent route fetching against a mock Directions server
+    """
+    @classmethod
+    def setUpClass(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MockDirections)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/directions/json?'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+
+    def test_fetch_routes(self):
+        """
+        Testing every pair is fetched, in order, through the retries.
+        """
+        pairs = [('a' * n, 'Denton TX') for n in range(1, 21)]
+        routes = fetch_routes(pairs, max_workers=4, backoff=0,
+                              directions=self.url)
+        self.assertEqual([len(r.gps_coord_pairs) for r in routes],
+                         list(range(1, 21)))
+        self.assertEqual(routes[0].gps_coord_pairs, [[33.0, -97.0]])
+
+    def test_route_cache(self):
+        """
+        Testing repeat routes are served from the cache.
+        """
+        cache = routeCache(':memory:')
+        pairs = [('b' * n, 'Denton TX') for n in range(1, 6)]
+        fetch_routes(pairs, backoff=0, directions=self.url, cache=cache)
+        # an unreachable server proves the second pass never leaves the cache
+        routes = fetch_routes([('B' * 3, 'denton  tx')], cache=cache,
+                              directions='http://127.0.0.1:9/')
+        self.assertEqual(routes[0].gps_coord_pairs,
+                         [[33.0, -97.0], [34.0, -97.0], [35.0, -97.0]])
+
+
+class TestRouteCache(unittest.TestCase):
+    """
+    Testing routeCache batches its writes
+    """
+    def setUp(self):
+        self.cache = routeCache(':memory:', max_entries=2, batch=3)
+        self.points = np.array([[33.0, -97.0], [34.0, -97.0]])
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_hits_do_not_write(self):
+        self.cache.put('a', 'b', self.points, self.points)
+        changes = self.cache.db.total_changes
+        for _ in range(2):
+            np.testing.assert_array_equal(self.cache.get('a', 'b')[0], self.points)
+        self.assertEqual(self.cache.db.total_changes, changes)
+        # the batch fills on the third hit and is written at once
+        self.cache.get('a', 'b')
+        self.assertEqual(self.cache.db.total_changes, changes + 1)
+        self.assertIsNone(self.cache.get('a', 'missing'))
+
+    def test_prune_batched(self):
+        self.cache.put('a', 'b', self.points, self.points)
+        self.cache.put('c', 'd', self.points, self.points)
+        self.cache.get('a', 'b')
+        # the cap is only enforced every third put, a was read after c
+        self.cache.put('e', 'f', self.points, self.points)
+        self.assertIsNotNone(self.cache.get('a', 'b'))
+        self.assertIsNone(self.cache.get('c', 'd'))
+        self.assertIsNotNone(self.cache.get('e', 'f'))
+
+        self.cache.ttl = -1
+        self.assertIsNone(self.cache.get('a', 'b'))
+        self.cache.prune()
+        self.assertEqual(self.cache.db.execute('SELECT COUNT(*) FROM routes').fetchone()[0], 0)
+
+
+class TestRouteCorridors(unittest.TestCase):
+    """
+    Testing route_corridors
+    """
+    def test_corridor_width(self):
+        """
+        Testing every corridor is a rectangle of the given width.
+        """
+        points = [[33.2100, -97.1500], [33.2110, -97.1500],
+                  [33.2110, -97.1500], [33.2110, -97.1480]]
+        corridor = route_corridors(points, width=10)
+        # the repeated point makes a zero length segment that is dropped
+        self.assertEqual(corridor.polygons.shape, (2, 4, 2))
+        sides = corridor.polygons[:, 0] - corridor.polygons[:, 3]
+        widths = (sides ** 2).sum(axis=1) ** 0.5
+        self.assertTrue(((widths - 10) ** 2 < 1e-12).all())
+        self.assertAlmostEqual(corridor.lengths[0], 111, delta=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,74 +1,223 @@
-from map_retrieve import mapRetrieve
+from MapRetrieve import mapRetrieve
+from benchmark import make_sample, SAMPLE_NAME
+from PIL import Image
+import numpy as np
 import unittest
+import rasterio
+import tempfile
 import logging
+import shutil
 import os
 
 class TestRetrieveMap(unittest.TestCase):
     """
-    Testing mapRetrieval class methods
+    Testing mapRetrieval class methods against the benchmark sample zip
+    and a local source map
     """
     @classmethod
     def setUpClass(self):
-        self.mr = mapRetrieve(in_folder='data/', out_folder='maps/')
-        self.f_name = 'data/Taliaferro2013_3992854N_12308761W.zip'
-        self.in_folder='data/'
-        self.out_folder='maps/'
-        self.dst_file = 'data/test_clip.tif'
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.in_folder = os.path.join(self.temp_dir.name, 'data')
+        self.out_folder = os.path.join(self.temp_dir.name, 'maps')
+        self.label_folder = os.path.join(self.temp_dir.name, 'labels')
+        self.f_name, src_file = make_sample(self.in_folder, n_shapes=300, src_pixels=1024)
+        self.mr = mapRetrieve(in_folder=self.in_folder, out_folder=self.out_folder,
+                              label_folder=self.label_folder, src_file=src_file)
+        self.dst_file = os.path.join(self.in_folder, 'test_clip.tif')
 
+    @classmethod
+    def tearDownClass(self):
+        self.temp_dir.cleanup()
 
     def test_load_shape(self):
         """
         Testing load_shape method.
         """
-        _, proj4 = self.mr.load_shape(self.f_name)
-        proj4_expect = '+proj=utm +datum=NAD83 +ellps=GRS80'\
-                        ' +a=6378137.0 +rf=298.257222101'\
-                        ' +pm=0 +lat_0=0.0 +lon_0=-123.0'\
-                        ' +x_0=500000.0 +y_0=0.0 +units=m'\
-                        ' +axis=enu +no_defs'
-        self.assertEqual(proj4, proj4_expect)
-    
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        self.assertEqual(epsg, 'EPSG:26910')
+        self.assertIn('+proj=utm', proj4)
+        self.assertIn('+lon_0=-123.0', proj4)
+        self.assertEqual(len(shape), 300)
+
     def test_get_extents(self):
         """
         Testing get_extents method.
         """
-        shape, proj4 = self.mr.load_shape(self.f_name)
-        extents = self.mr.get_bounds(shape, proj4)
-        self.assertEqual(extents,
-                         [-123.08760652043246, 
-                         39.9285503651239, 
-                         -123.07501000231119, 
-                         39.924924051103275])
-        
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, utm_extents = self.mr.get_bounds(shape, proj4, epsg)
+        ulx, uly, lrx, lry = extents
+        # the sample plot is a 1km square near 39.93N 123.08W
+        self.assertLess(ulx, lrx)
+        self.assertGreater(uly, lry)
+        self.assertAlmostEqual(ulx, -123.0824, places=2)
+        self.assertAlmostEqual(lry, 39.9275, places=2)
+
+    @unittest.skipUnless(shutil.which('gdal_translate'), 'needs the GDAL command line tools')
     def test_get_map(self):
         """
         Testing get_map method.
         """
-        shape, proj4 = self.mr.load_shape(self.f_name)
-        extents = self.mr.get_bounds(shape, proj4)
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, _ = self.mr.get_bounds(shape, proj4, epsg)
         self.mr.get_map(extents, self.dst_file)
         self.assertTrue(os.path.exists(self.dst_file))
         os.remove(self.dst_file)
 
     def test_save_map(self):
         """
-        Testing save_map method (not completed)
+        Testing save_map method.
+        """
+        self.mr.save_map(self.f_name)
+        png_file = os.path.join(self.out_folder, SAMPLE_NAME + '.png')
+        label_file = os.path.join(self.label_folder, SAMPLE_NAME + '.xml')
+        self.assertTrue(os.path.exists(png_file))
+        self.assertTrue(os.path.exists(png_file + '.aux.xml'))
+        with open(label_file) as f:
+            self.assertIn('<name>tree</name>', f.read())
+
+    def test_render_map(self):
+        """
+        Testing render_map and write_png give a map of the shape extents
+        with the georeference of its pixels.
+        """
+        from pyproj import Transformer
+        from raster_meta import read_meta
+        from rasterio.transform import array_bounds
+
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, utm_extents = self.mr.get_bounds(shape, proj4, epsg)
+        array, transform = self.mr.render_map(extents, epsg)
+        _, (grid_transform, height, width) = self.mr.map_grid(extents, epsg)
+        self.assertEqual(array.shape, (3, height, width))
+        self.assertEqual(transform, grid_transform)
+
+        # the map covers the plot to within a couple of pixels
+        bounds = array_bounds(height, width, transform)
+        np.testing.assert_allclose(bounds, utm_extents, atol=2 * transform.a)
+
+        # every pixel shows the source pixel at the same place
+        rows, cols = np.mgrid[0:height:7, 0:width:7].reshape(2, -1)
+        x, y = transform * (cols + 0.5, rows + 0.5)
+        lng, lat = Transformer.from_crs(epsg, 'EPSG:4326', always_xy=True).transform(x, y)
+        with rasterio.open(self.mr.src_file) as src:
+            source = src.read()
+            src_rows, src_cols = rasterio.transform.rowcol(src.transform, lng, lat)
+        same = (array[:, rows, cols] == source[:, src_rows, src_cols]).all(axis=0)
+        # source pixels are 16x the noise cells, so only their edges may differ
+        self.assertGreater(same.mean(), 0.95)
+
+        png_file = os.path.join(self.out_folder, 'rendered.png')
+        self.mr.write_png(array, transform, epsg, png_file)
+        with rasterio.open(png_file) as png:
+            self.assertEqual(png.crs.to_epsg(), 26910)
+            self.assertEqual(png.transform, transform)
+            np.testing.assert_array_equal(png.read(), array)
+        meta = read_meta(png_file)
+        self.assertEqual(meta.shape, (height, width, 3))
+        self.assertTrue(meta.transform.almost_equals(transform))
+        self.assertIn('26910', meta.crs)
+        os.remove(png_file)
+        os.remove(png_file + '.aux.xml')
+
+    def test_shape_boxes(self):
+        """
+        Testing shape_boxes gives the boxes of the per record loop it
+        replaced, from the shape stream and from a full shp.Reader.
+        """
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, _ = self.mr.get_bounds(shape, proj4, epsg)
+        array, t = self.mr.render_map(extents, epsg)
+        bands, img_height, img_width = array.shape
+
+        # the loop shape_to_voc used to run over every record
+        expected, short = [], 0
+        for record in shape.reader().shapeRecords():
+            minx, maxy, maxx, miny = record.shape.bbox
+            height = record.record.max_h
+            if height and height > 10:
+                x_min = int((minx - t.c) / t.a)
+                x_max = int((maxx - t.c) / t.a)
+                y_min = int((miny - t.f) / t.e)
+                y_max = int((maxy - t.f) / t.e)
+                if x_min > 50 and y_min > 50 and x_max < (img_width - 50) and y_max < (img_height - 50):
+                    expected.append([x_min, y_min, x_max, y_max, height])
+            else:
+                short += 1
+        self.assertTrue(expected)
+
+        for shapes in (shape, shape.reader()):
+            boxes, counts = self.mr.shape_boxes(shapes, t, (img_height, img_width, bands))
+            np.testing.assert_array_equal(boxes.boxes, [box[:4] for box in expected])
+            np.testing.assert_allclose(boxes.heights, [box[4] for box in expected])
+            self.assertEqual(counts, {'shapes': 300, 'short': short,
+                                      'border': 300 - short - len(expected)})
+
+        # the label filters are parameters
+        boxes, _ = self.mr.shape_boxes(shape, t, (img_height, img_width, bands),
+                                       min_height=30, border=0)
+        self.assertTrue((boxes.heights > 30).all())
+        self.assertGreater(len(boxes), sum(box[4] > 30 for box in expected))
+
+    def test_render_map_chunked(self):
+        """
+        Testing the chunked warp gives the same map as the in memory one.
+        """
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, _ = self.mr.get_bounds(shape, proj4, epsg)
+        array, transform = self.mr.render_map(extents, epsg)
+        tif_file = os.path.join(self.out_folder, 'chunked.tif')
+        chunk_transform, img_size = self.mr.render_map_chunked(extents, epsg, tif_file,
+                                                               chunk=200)
+        self.assertEqual(chunk_transform, transform)
+        self.assertEqual(img_size, (array.shape[1], array.shape[2], array.shape[0]))
+        with rasterio.open(tif_file) as src:
+            chunked = src.read()
+            self.assertTrue(src.profile['tiled'])
+        # the warper approximates the transform per chunk to 1/8 of a
+        # pixel, so a few pixels on source pixel edges may differ
+        self.assertLess((chunked != array).any(axis=0).mean(), 0.01)
+
+    def test_save_tiles(self):
+        """
+        Testing save_tiles cuts the map into tiles and labels, in memory
+        and warped tile by tile for maps over max_pixels.
         """
-        # TODO: Write test to get multiple map images 
-        # mr.save_map(f_name)
-        pass 
+        shape, proj4, epsg = self.mr.load_shape(self.f_name)
+        extents, _ = self.mr.get_bounds(shape, proj4, epsg)
+        array, _ = self.mr.render_map(extents, epsg)
+
+        results = []
+        for name, max_pixels in (('memory', self.mr.max_pixels), ('chunked', 1000)):
+            folder = os.path.join(self.temp_dir.name, name)
+            mr = mapRetrieve(in_folder=self.in_folder, out_folder=folder, label_folder=folder,
+                             src_file=self.mr.src_file, max_pixels=max_pixels, chunk=200)
+            crop_boxes = mr.save_tiles(self.f_name, height=128, width=128, pad=True, workers=2)
+            self.assertEqual(sorted(f for f in os.listdir(folder) if f.endswith('.tif')), [])
+            tiles = {os.path.basename(f): np.asarray(Image.open(f)) for f in crop_boxes}
+            labels = sorted(f for f in os.listdir(folder) if f.endswith('.xml'))
+            results.append((crop_boxes, tiles, labels))
+        # oversize maps are warped a tile at a time, each map pixel once
+        counters = mr.metrics.snapshot()['counters']
+        self.assertEqual(counters['pixels_warped'], array.shape[1] * array.shape[2])
+        self.assertNotIn('warp_chunked', mr.metrics.snapshot()['stages'])
+
+        (crop_boxes, tiles, labels), (_, chunked_tiles, chunked_labels) = results
+        self.assertEqual(len(tiles), -(-array.shape[1] // 128) * -(-array.shape[2] // 128))
+        self.assertTrue(labels)
+        self.assertEqual(labels, chunked_labels)
+        for png_file, (x0, y0, x1, y1) in crop_boxes.items():
+            tile = tiles[os.path.basename(png_file)]
+            piece = np.moveaxis(array[:, y0:y1, x0:x1], 0, -1)
+            np.testing.assert_array_equal(tile[:piece.shape[0], :piece.shape[1]], piece)
+            # the padding of edge tiles is black
+            self.assertFalse(tile[piece.shape[0]:].any() or tile[:, piece.shape[1]:].any())
+            # see test_render_map_chunked
+            chunked = chunked_tiles[os.path.basename(png_file)]
+            self.assertLess((chunked != tile).any(axis=2).mean(), 0.02)
 
-    def test_save_json(self):
-        shape, _ = self.mr.load_shape(self.f_name)
-        json_file = self.mr.shape_to_json(shape)
-        dst_file = 'test.ds'
-        self.mr.save_json(json_file, dst_file)
-        self.assertTrue(os.path.exists(dst_file))
-        os.remove(dst_file)
-        
 
 if __name__ == "__main__":
     # test
     logging.basicConfig(level=logging.INFO)
     unittest.main()
-    logging.basicConfig(level=logging.WARNING)
\ No newline at end of file
+    logging.basicConfig(level=logging.WARNING)
@@ -0,0 +1,154 @@
+# span timings and counters for the pipeline stages, exported as json
+# lines or a prometheus textfile so a batch run shows which stage caps
+# its throughput
+
+import functools
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+PREFIX = 'shademyrun'
+
+
+class pipelineMetrics():
+    def __init__(self, span_file=None):
+        '''Collects stage timings and counters, safe to share between the
+        threads of one process. Processes merge their snapshots.
+
+        Every stage records its call count, total (inclusive) seconds,
+        self seconds (excluding nested stages) and slowest call.
+
+        Parameters
+        ----------
+        span_file : str
+            when given, every finished span is also appended to this json
+            lines file with its start time, duration and attributes
+        '''
+        self.span_file = span_file
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stages = defaultdict(lambda: {'calls': 0, 'seconds': 0.0,
+                                               'self_seconds': 0.0, 'max_seconds': 0.0})
+            self.counters = Counter()
+
+    def _stack(self):
+        # nested spans are tracked per thread
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def span(self, stage, **attrs):
+        '''Time a block as stage, use as a context manager.'''
+        return _span(self, stage, attrs)
+
+    def _finish(self, stage, start, elapsed, inner, attrs):
+        with self.lock:
+            record = self.stages[stage]
+            record['calls'] += 1
+            record['seconds'] += elapsed
+            record['self_seconds'] += elapsed - inner
+            record['max_seconds'] = max(record['max_seconds'], elapsed)
+            if self.span_file:
+                with open(self.span_file, 'a') as f:
+                    f.write(json.dumps({'stage': stage, 'start': start,
+                                        'seconds': elapsed, **attrs}) + '\n')
+
+    def count(self, name, value=1):
+        '''Add value to the counter name (ex. 'bytes_fetched').'''
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        '''The stages and counters as plain dicts, picklable and json-able.'''
+        with self.lock:
+            return {'stages': {k: dict(v) for k, v in self.stages.items()},
+                    'counters': dict(self.counters)}
+
+    def merge(self, snapshot):
+        '''Add a snapshot from another process (ex. a batch worker).'''
+        with self.lock:
+            for stage, other in snapshot['stages'].items():
+                record = self.stages[stage]
+                for k in ('calls', 'seconds', 'self_seconds'):
+                    record[k] += other[k]
+                record['max_seconds'] = max(record['max_seconds'], other['max_seconds'])
+            self.counters.update(snapshot['counters'])
+
+    def to_json_lines(self, f_name, **labels):
+        '''Append the current totals as one json line.'''
+        with open(f_name, 'a') as f:
+            f.write(json.dumps({'time': time.time(), **labels, **self.snapshot()}) + '\n')
+
+    def to_prometheus(self, f_name, **labels):
+        '''Write the totals in the Prometheus text format, for the
+        node_exporter textfile collector. The file is replaced atomically
+        so a scrape never sees half of it.'''
+        snapshot = self.snapshot()
+        extra = ''.join(f',{k}="{v}"' for k, v in labels.items())
+        lines = []
+        for metric, key, help_text in (
+                ('stage_calls_total', 'calls', 'Calls of each pipeline stage'),
+                ('stage_seconds_total', 'seconds', 'Seconds spent in each stage'),
+                ('stage_self_seconds_total', 'self_seconds',
+                 'Seconds spent in each stage excluding nested stages'),
+                ('stage_max_seconds', 'max_seconds', 'Slowest call of each stage')):
+            kind = 'gauge' if metric.endswith('max_seconds') else 'counter'
+            lines.append(f'# HELP {PREFIX}_{metric} {help_text}')
+            lines.append(f'# TYPE {PREFIX}_{metric} {kind}')
+            for stage, record in sorted(snapshot['stages'].items()):
+                lines.append(f'{PREFIX}_{metric}{{stage="{stage}"{extra}}} {record[key]}')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f'# TYPE {PREFIX}_{name}_total counter')
+            counter_labels = f'{{{extra[1:]}}}' if extra else ''
+            lines.append(f'{PREFIX}_{name}_total{counter_labels} {value}')
+        tmp_file = f'{f_name}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_file, f_name)
+
+    def export(self, f_name, **labels):
+        '''Write a .prom file as a Prometheus textfile, anything else as
+        json lines.'''
+        if f_name.endswith('.prom'):
+            self.to_prometheus(f_name, **labels)
+        else:
+            self.to_json_lines(f_name, **labels)
+
+
+class _span():
+    def __init__(self, metrics, stage, attrs):
+        self.metrics = metrics
+        self.stage = stage
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.stack = self.metrics._stack()
+        self.stack.append(0.0)
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        inner = self.stack.pop()
+        if self.stack:
+            self.stack[-1] += elapsed
+        attrs = dict(self.attrs, error=exc[0].__name__) if exc[0] else self.attrs
+        self.metrics._finish(self.stage, self.wall, elapsed, inner, attrs)
+
+
+def stage(name):
+    '''Decorate a method to time its calls as a span of self.metrics.'''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.span(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,65 @@
+from metrics import pipelineMetrics, stage
+import unittest
+import tempfile
+import json
+import time
+import os
+
+
+class Worker():
+    def __init__(self):
+        self.metrics = pipelineMetrics()
+
+    @stage('outer')
+    def outer(self):
+        time.sleep(0.02)
+        self.inner()
+
+    @stage('inner')
+    def inner(self):
+        time.sleep(0.02)
+        self.metrics.count('labels_emitted', 3)
+
+
+class TestMetrics(unittest.TestCase):
+    """
+    Testing pipelineMetrics spans, counters and exports
+    """
+    def test_spans(self):
+        worker = Worker()
+        worker.outer()
+        stages = worker.metrics.snapshot()['stages']
+        self.assertEqual(stages['outer']['calls'], 1)
+        self.assertGreaterEqual(stages['outer']['seconds'], 0.04)
+        # the nested stage is not counted in the self time of the outer one
+        self.assertLess(stages['outer']['self_seconds'], stages['outer']['seconds'] - 0.015)
+        self.assertAlmostEqual(stages['inner']['seconds'], stages['inner']['self_seconds'])
+
+    def test_merge_and_export(self):
+        first, second = Worker(), Worker()
+        first.outer()
+        second.inner()
+        first.metrics.merge(second.metrics.snapshot())
+        snapshot = first.metrics.snapshot()
+        self.assertEqual(snapshot['stages']['inner']['calls'], 2)
+        self.assertEqual(snapshot['counters']['labels_emitted'], 6)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            prom_file = os.path.join(temp_dir, 'shademyrun.prom')
+            first.metrics.export(prom_file, host='worker1')
+            with open(prom_file) as f:
+                prom = f.read()
+            self.assertIn('shademyrun_stage_calls_total{stage="inner",host="worker1"} 2', prom)
+            self.assertIn('shademyrun_labels_emitted_total{host="worker1"} 6', prom)
+
+            json_file = os.path.join(temp_dir, 'metrics.jsonl')
+            first.metrics.export(json_file)
+            first.metrics.export(json_file)
+            with open(json_file) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0]['counters']['labels_emitted'], 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+# encodes and decodes lat/lng paths in Google's encoded polyline format
+# https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+
+import numpy as np
+
+
+def encode_polyline(points, precision=5):
+    '''Encode a list of [lat, lng] pairs as a polyline string.'''
+    points = np.round(np.asarray(points, dtype=float).reshape(-1, 2) * 10**precision).astype(np.int64)
+    # points are stored as deltas from the previous point
+    deltas = np.diff(points, axis=0, prepend=[[0, 0]]).ravel()
+    # zig-zag so the sign ends up in the lowest bit
+    deltas = np.where(deltas < 0, ~(deltas << 1), deltas << 1)
+    chars = []
+    for value in deltas.tolist():
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+    return ''.join(chars)
+
+
+def decode_polyline(polyline, precision=5):
+    '''Decode a polyline string into an (n, 2) float array of [lat, lng].'''
+    values = []
+    value = shift = 0
+    for char in polyline:
+        byte = ord(char) - 63
+        value |= (byte & 0x1f) << shift
+        shift += 5
+        if byte < 0x20:
+            values.append(~(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    deltas = np.array(values, dtype=np.int64).reshape(-1, 2)
+    return np.cumsum(deltas, axis=0) / 10**precision
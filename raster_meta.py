@@ -0,0 +1,92 @@
+# reads the size and georeference of a map image from its file header and
+# .aux.xml sidecar, or from the tags of a GeoTIFF, without decoding any pixels
+
+import struct
+import warnings
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+from affine import Affine
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# number of bands for each png color type
+PNG_BANDS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# little and big endian, classic and BigTIFF
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+
+class rasterMeta(namedtuple('rasterMeta',
+                            ['width', 'height', 'bands', 'transform', 'crs'])):
+    '''Size and georeference of a map image. transform and crs are None
+    when the image has no .aux.xml sidecar and is not a GeoTIFF.'''
+
+    @property
+    def shape(self):
+        # same order as the shape of the decoded image array
+        return (self.height, self.width, self.bands)
+
+
+def _png_header(f_name):
+    with open(f_name, 'rb') as f:
+        header = f.read(26)
+    if header[:8] != PNG_SIGNATURE or header[12:16] != b'IHDR':
+        return None
+    width, height, _, color_type = struct.unpack('>IIBB', header[16:26])
+    return width, height, PNG_BANDS[color_type]
+
+
+def _aux_georef(f_name):
+    try:
+        root = ET.parse(f_name + '.aux.xml').getroot()
+    except (FileNotFoundError, ET.ParseError):
+        return None, None
+    transform = root.findtext('GeoTransform')
+    if transform:
+        transform = Affine.from_gdal(*map(float, transform.split(',')))
+    return transform, root.findtext('SRS')
+
+
+def _tiff_meta(f_name):
+    with open(f_name, 'rb') as f:
+        if f.read(4) not in TIFF_SIGNATURES:
+            return None
+    import rasterio
+    from rasterio.errors import NotGeoreferencedWarning
+
+    # rasterio reads the GeoTIFF tags and any .aux.xml sidecar
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(f_name) as src:
+            size = src.width, src.height, src.count
+            transform, crs = src.transform, src.crs
+    if crs is None and transform.is_identity:
+        return size, None, None
+    return size, transform, crs.to_wkt() if crs else None
+
+
+def read_meta(f_name):
+    '''Get the size and georeference of an image from its headers.
+
+    Parameters
+    ----------
+    f_name : str
+        the file location of a png, a GeoTIFF (or any PIL readable image)
+
+    Returns
+    ----------
+    rasterMeta
+        the width, height, band count, transform and crs of the image
+    '''
+    size = _png_header(f_name)
+    if size is None:
+        # maps over max_pixels are saved as a tiled GeoTIFF
+        tiff = _tiff_meta(f_name)
+        if tiff is not None:
+            size, transform, crs = tiff
+            return rasterMeta(*size, transform, crs)
+        # PIL only reads the header until pixels are accessed
+        from PIL import Image
+        with Image.open(f_name) as img:
+            size = img.width, img.height, len(img.getbands())
+    transform, crs = _aux_georef(f_name)
+    return rasterMeta(*size, transform, crs)
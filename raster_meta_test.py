@@ -0,0 +1,80 @@
+from raster_meta import read_meta
+from affine import Affine
+from PIL import Image
+import numpy as np
+import unittest
+import rasterio
+import tempfile
+import os
+
+
+class TestRasterMeta(unittest.TestCase):
+    """
+    Testing image sizes and georeferences read from headers
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_png_header(self):
+        """
+        Testing the size and bands of every png color type.
+        """
+        for mode, bands in (('L', 1), ('LA', 2), ('RGB', 3), ('RGBA', 4), ('P', 1)):
+            png_file = os.path.join(self.temp_dir.name, f'{mode}.png')
+            Image.new(mode, (30, 20)).save(png_file)
+            meta = read_meta(png_file)
+            self.assertEqual(meta.shape, (20, 30, bands))
+            self.assertEqual(meta.shape, np.asarray(Image.open(png_file)).reshape(20, 30, -1).shape)
+            self.assertEqual((meta.transform, meta.crs), (None, None))
+
+    def test_aux_georef(self):
+        """
+        Testing the transform and crs come from the .aux.xml sidecar.
+        """
+        png_file = os.path.join(self.temp_dir.name, 'map.png')
+        transform = Affine(0.6, 0, 493000.5, 0, -0.6, 4421000.25)
+        with rasterio.open(png_file, 'w', driver='PNG', width=40, height=30, count=3,
+                           dtype='uint8', crs='EPSG:26910', transform=transform) as dst:
+            dst.write(np.zeros((3, 30, 40), dtype=np.uint8))
+        meta = read_meta(png_file)
+        self.assertEqual(meta.shape, (30, 40, 3))
+        self.assertTrue(meta.transform.almost_equals(transform))
+        self.assertEqual(rasterio.crs.CRS.from_wkt(meta.crs).to_epsg(), 26910)
+
+        # a broken sidecar is the same as none
+        with open(png_file + '.aux.xml', 'w') as f:
+            f.write('<PAMDataset><GeoTransform>')
+        self.assertEqual(read_meta(png_file)[3:], (None, None))
+
+    def test_geotiff(self):
+        """
+        Testing a GeoTIFF is georeferenced from its own tags.
+        """
+        tif_file = os.path.join(self.temp_dir.name, 'map.tif')
+        transform = Affine(0.6, 0, 493000.5, 0, -0.6, 4421000.25)
+        with rasterio.open(tif_file, 'w', driver='GTiff', width=40, height=30, count=3,
+                           dtype='uint8', crs='EPSG:26910', transform=transform,
+                           tiled=True, blockxsize=16, blockysize=16) as dst:
+            dst.write(np.zeros((3, 30, 40), dtype=np.uint8))
+        self.assertFalse(os.path.exists(tif_file + '.aux.xml'))
+        meta = read_meta(tif_file)
+        self.assertEqual(meta.shape, (30, 40, 3))
+        self.assertEqual(meta.transform, transform)
+        self.assertEqual(rasterio.crs.CRS.from_wkt(meta.crs).to_epsg(), 26910)
+
+    def test_pil_fallback(self):
+        """
+        Testing other formats fall back to the PIL header.
+        """
+        for f_name, mode, bands in (('map.jpg', 'RGB', 3), ('map.tif', 'RGBA', 4),
+                                    ('map.bmp', 'L', 1)):
+            f_name = os.path.join(self.temp_dir.name, f_name)
+            Image.new(mode, (17, 9)).save(f_name)
+            self.assertEqual(read_meta(f_name), (17, 9, bands, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
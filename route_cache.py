@@ -0,0 +1,123 @@
+# a persistent cache of route geometry so popular routes cost no
+# Directions API call, points are kept as encoded polylines
+
+import re
+import sqlite3
+import threading
+import time
+
+from polyline import decode_polyline, encode_polyline
+
+
+class routeCache():
+    def __init__(self, db_file='route_cache.sqlite', ttl=7*24*3600,
+                 max_entries=100000, batch=100):
+        '''Cache route points keyed by origin, destination and mode.
+
+        Reads never write. Access times of hits are kept in memory and
+        written in one transaction every batch hits (or with the next put
+        or close), and expired and least recently used routes are pruned
+        every batch puts, so workers sharing the db rarely contend.
+
+        Parameters
+        ----------
+        db_file : str
+            the sqlite file backing the cache, ':memory:' keeps it in memory
+        ttl : float
+            seconds before a cached route expires
+        max_entries : int
+            the least recently used routes are dropped past this many, the
+            cache can run up to batch routes over it between prunes
+        batch : int
+            the hits per access time write and the puts per prune
+        '''
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.batch = batch
+        self._accessed = dict()
+        self._hits = 0
+        self._puts = 0
+        # one connection shared by the fetch threads, guarded by a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        columns = [c[1] for c in self.db.execute('PRAGMA table_info(routes)')]
+        if columns and 'overview' not in columns:
+            # caches written before the full geometry was stored are dropped
+            self.db.execute('DROP TABLE routes')
+        self.db.execute('CREATE TABLE IF NOT EXISTS routes ('
+                        'key TEXT PRIMARY KEY, polyline TEXT, overview TEXT, '
+                        'created REAL, accessed REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS routes_accessed '
+                        'ON routes (accessed)')
+        self.db.commit()
+
+    @staticmethod
+    def key(origin, destination, mode):
+        '''Normalize the route so '123  Main St' and '123+main+st' match.'''
+        def normal(place):
+            return re.sub(r'[\s+]+', ' ', place).strip().lower()
+        return f'{normal(origin)}|{normal(destination)}|{mode.lower()}'
+
+    def get(self, origin, destination, mode='walking'):
+        '''Return the cached step points and full route geometry as two
+        (n, 2) [lat, lng] arrays, or None on a miss.'''
+        key = self.key(origin, destination, mode)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT polyline, overview, created '
+                                  'FROM routes WHERE key = ?',
+                                  (key,)).fetchone()
+            # expired routes are left for the next prune
+            if row is None or now - row[2] > self.ttl:
+                return None
+            self._accessed[key] = now
+            self._hits += 1
+            if self._hits >= self.batch:
+                self._flush()
+                self.db.commit()
+        return decode_polyline(row[0]), decode_polyline(row[1])
+
+    def _flush(self):
+        # write the pending access times, the caller holds the lock and commits
+        if self._accessed:
+            self.db.executemany('UPDATE routes SET accessed = ? WHERE key = ?',
+                                [(t, k) for k, t in self._accessed.items()])
+            self._accessed = dict()
+        self._hits = 0
+
+    def prune(self):
+        '''Drop expired routes, then the least recently used past the cap.'''
+        with self.lock:
+            self._prune()
+            self.db.commit()
+
+    def _prune(self):
+        self._flush()
+        self.db.execute('DELETE FROM routes WHERE created < ?',
+                        (time.time() - self.ttl,))
+        self.db.execute('DELETE FROM routes WHERE key IN ('
+                        'SELECT key FROM routes ORDER BY accessed DESC '
+                        'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def put(self, origin, destination, points, overview, mode='walking'):
+        '''Store the [lat, lng] step points and full geometry of a route.'''
+        key = self.key(origin, destination, mode)
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO routes '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (key, encode_polyline(points),
+                             encode_polyline(overview), now, now))
+            self._accessed.pop(key, None)
+            self._puts += 1
+            if self._puts % self.batch == 0:
+                self._prune()
+            else:
+                self._flush()
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.db.commit()
+        self.db.close()
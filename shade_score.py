@@ -0,0 +1,169 @@
+# scores how much of a running route is shaded by trees, trees come from
+# shape_to_voc labels or detector output and routes from google_apis
+
+import numpy as np
+import shapely
+from pyproj import Transformer
+
+from box_store import boxStore
+from raster_meta import read_meta
+
+
+def load_voc_boxes(xml_file, image_file=None):
+    '''Get the boxes of a VOC label file in map coordinates, georeferenced
+    through the .aux.xml sidecar of its map png or the tags of its GeoTIFF.
+
+    Parameters
+    ----------
+    xml_file : str
+        a VOC xml file
+    image_file : str
+        the map the labels belong to, defaults to the path in the VOC when
+        that file exists and to its file name next to the xml file otherwise
+
+    Returns
+    ----------
+    np.ndarray
+        (n, 4) boxes as [xmin, ymin, xmax, ymax] in map coordinates
+    str
+        the projection of the map
+    '''
+    store = boxStore.read_voc(xml_file)
+    if image_file is None:
+        # read_voc already falls back to the folder of the xml file
+        image_file = store.images[0]
+    meta = read_meta(image_file)
+    if meta.transform is None:
+        raise ValueError(f'{image_file} has no georeference')
+    boxes = store.transform(meta.transform).boxes
+    return boxes, meta.crs
+
+
+class treeIndex():
+    def __init__(self, cell=0.0005):
+        '''An STRtree over the dissolved tree canopy used to score route
+        corridors. Add boxes with add_boxes or add_voc, then call build.
+
+        Overlapping crowns are merged per grid cell at build time, so the
+        canopy patches never overlap and scoring only needs one
+        intersection per (segment, patch) pair, with no unions.
+
+        Parameters
+        ----------
+        cell : float
+            the size in degrees of the grid cells the canopy is split
+            into, the default is about 50m
+        '''
+        self.cell = cell
+        self._corners = []
+        self.corners = np.zeros((0, 4, 2))
+        self.patches = np.array([], dtype=object)
+        self.tree = None
+
+    def __len__(self):
+        return len(self.corners)
+
+    def add_boxes(self, boxes, crs):
+        '''Add tree boxes given in any projection.
+
+        Parameters
+        ----------
+        boxes : np.ndarray
+            (n, 4) boxes as [xmin, ymin, xmax, ymax] in crs coordinates
+        crs : str
+            the projection of the boxes (ex. 'EPSG:26910')
+        '''
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        # all four corners so the boxes stay true after re-projection
+        x = boxes[:, [0, 2, 2, 0]]
+        y = boxes[:, [1, 1, 3, 3]]
+        lng, lat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(x, y)
+        self._corners.append(np.stack([lng, lat], axis=-1))
+        self.tree = None
+
+    def add_voc(self, xml_file, image_file=None):
+        '''Add the boxes of a VOC label file, see load_voc_boxes.'''
+        self.add_boxes(*load_voc_boxes(xml_file, image_file))
+
+    def build(self):
+        '''Dissolve every box added so far into per cell canopy patches
+        and build the STRtree over them.'''
+        if self._corners:
+            self.corners = np.concatenate([self.corners, *self._corners])
+            self._corners = []
+        if not len(self.corners):
+            self.patches = np.array([], dtype=object)
+            self.tree = shapely.STRtree(self.patches)
+            return self
+        trees = shapely.polygons(self.corners)
+        # every cell a tree touches, the same interval math as voc_tiler
+        lo = np.floor(self.corners.min(axis=1) / self.cell).astype(np.int64)
+        hi = np.floor(self.corners.max(axis=1) / self.cell).astype(np.int64)
+        n_cols = hi[:, 0] - lo[:, 0] + 1
+        n_rows = hi[:, 1] - lo[:, 1] + 1
+        counts = n_cols * n_rows
+        tree_index = np.repeat(np.arange(len(trees)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        col = lo[tree_index, 0] + offset % n_cols[tree_index]
+        row = lo[tree_index, 1] + offset // n_cols[tree_index]
+        cells, cell_index = np.unique(np.stack([col, row], axis=1), axis=0, return_inverse=True)
+        cell_index = cell_index.ravel()
+
+        order = np.argsort(cell_index, kind='stable')
+        bounds = np.searchsorted(cell_index[order], np.arange(1, len(cells)))
+        canopy = np.array([shapely.union_all(group) for group in
+                           np.split(trees[tree_index[order]], bounds)], dtype=object)
+        cell_boxes = shapely.box(cells[:, 0] * self.cell, cells[:, 1] * self.cell,
+                                 (cells[:, 0] + 1) * self.cell, (cells[:, 1] + 1) * self.cell)
+        self.patches = shapely.intersection(canopy, cell_boxes)
+        self.tree = shapely.STRtree(self.patches)
+        return self
+
+    def score(self, corridor):
+        '''Score one route, see score_routes.'''
+        return self.score_routes([corridor])[0]
+
+    def score_routes(self, corridors):
+        '''Get the shaded fraction of every segment and of the whole route
+        for many routes at once.
+
+        Parameters
+        ----------
+        corridors : list
+            routeCorridor tuples from google_apis.route_corridors
+
+        Returns
+        ----------
+        list
+            per route, an array of the shaded fraction of each segment
+            and the shaded fraction of the route weighted by area
+        '''
+        if self.tree is None:
+            self.build()
+        counts = [len(c.polygons) for c in corridors]
+        if not sum(counts):
+            return [(np.zeros(0), 0.0) for _ in corridors]
+        segments = shapely.polygons(np.concatenate(
+            [c.polygons_lnglat for c in corridors]).reshape(-1, 4, 2))
+        # one index query finds the canopy patches of every segment
+        seg_index, patch_index = self.tree.query(segments, predicate='intersects')
+        shaded = shapely.area(shapely.intersection(segments[seg_index],
+                                                   self.patches[patch_index]))
+        # fractions of a segment are the same in degrees as in meters
+        # at this scale, so there is no need to re-project the patches
+        area = shapely.area(segments)
+        # bincount gives ints when no segment has any canopy
+        shaded = np.bincount(seg_index, weights=shaded, minlength=len(segments)).astype(float)
+        fractions = np.divide(shaded, area, out=np.zeros(len(segments)), where=area > 0)
+
+        scores = []
+        start = 0
+        for corridor, count in zip(corridors, counts):
+            # corridors share one width, so their areas weigh by length
+            weights = corridor.lengths
+            total = weights.sum()
+            route_fractions = fractions[start:start + count]
+            scores.append((route_fractions,
+                           float((route_fractions * weights).sum() / total) if total else 0.0))
+            start += count
+        return scores
@@ -0,0 +1,102 @@
+from shade_score import treeIndex, load_voc_boxes
+from google_apis import route_corridors
+from box_store import boxStore
+from affine import Affine
+import numpy as np
+import unittest
+import rasterio
+import tempfile
+import shutil
+import os
+
+
+class TestTreeIndex(unittest.TestCase):
+    """
+    Testing route scoring against the dissolved tree canopy
+    """
+    def setUp(self):
+        # one park about 100m on a side, as two overlapping boxes
+        self.index = treeIndex()
+        self.index.add_boxes([[-97.1510, 33.2090, -97.1503, 33.2100],
+                              [-97.1505, 33.2090, -97.1500, 33.2100]], 'EPSG:4326')
+        self.shaded = route_corridors([[33.2093, -97.1508], [33.2097, -97.1502]])
+        self.open_route = route_corridors([[33.2150, -97.1550], [33.2150, -97.1520]])
+
+    def test_score_routes(self):
+        scores = self.index.score_routes([self.shaded, self.open_route])
+        self.assertAlmostEqual(scores[0][1], 1.0)
+        self.assertEqual(len(scores[0][0]), 1)
+        self.assertEqual(scores[1][1], 0.0)
+        self.assertEqual(self.index.score(self.shaded)[1], scores[0][1])
+
+    def test_unshaded(self):
+        # no segment touches a patch
+        fractions, shade = self.index.score(self.open_route)
+        np.testing.assert_array_equal(fractions, [0.0])
+        self.assertEqual(shade, 0.0)
+
+    def test_degenerate(self):
+        single_point = route_corridors([[33.2095, -97.1505]])
+        self.assertEqual(self.index.score_routes([]), [])
+        fractions, shade = self.index.score(single_point)
+        self.assertEqual(len(fractions), 0)
+        self.assertEqual(shade, 0.0)
+        scores = self.index.score_routes([single_point, self.shaded])
+        self.assertAlmostEqual(scores[1][1], 1.0)
+
+        empty = treeIndex()
+        self.assertEqual(len(empty), 0)
+        fractions, shade = empty.score(self.shaded)
+        np.testing.assert_array_equal(fractions, [0.0])
+        self.assertEqual(shade, 0.0)
+
+
+class TestLoadVocBoxes(unittest.TestCase):
+    """
+    Testing label boxes are georeferenced through their map
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = lambda name: os.path.join(self.temp_dir.name, name)
+        os.makedirs(self.folder('maps'))
+        os.makedirs(self.folder('labels'))
+        self.transform = Affine(0.5, 0, 493000, 0, -0.5, 4421000)
+        self.map_file = self.folder('maps/plot.png')
+        with rasterio.open(self.map_file, 'w', driver='PNG', width=200, height=100, count=3,
+                           dtype='uint8', crs='EPSG:26910', transform=self.transform) as dst:
+            dst.write(np.zeros((3, 100, 200), dtype=np.uint8))
+        # labels in their own folder, as save_map writes them
+        store = boxStore([[10, 20, 30, 40]], images=[self.map_file], sizes=[(200, 100, 3)])
+        self.xml_file, = store.write_voc(self.folder('labels'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_map_folder(self):
+        boxes, crs = load_voc_boxes(self.xml_file)
+        np.testing.assert_allclose(boxes, [[493005, 4420980, 493015, 4420990]])
+        self.assertEqual(rasterio.crs.CRS.from_wkt(crs).to_epsg(), 26910)
+
+    def test_geotiff(self):
+        # maps over max_pixels are saved as a GeoTIFF without a sidecar
+        tif_file = self.folder('maps/plot.tif')
+        with rasterio.open(self.map_file) as src:
+            profile = dict(src.profile, driver='GTiff')
+        with rasterio.open(tif_file, 'w', **profile) as dst:
+            dst.write(np.zeros((3, 100, 200), dtype=np.uint8))
+        boxes, crs = load_voc_boxes(self.xml_file, image_file=tif_file)
+        np.testing.assert_allclose(boxes, [[493005, 4420980, 493015, 4420990]])
+        self.assertEqual(rasterio.crs.CRS.from_wkt(crs).to_epsg(), 26910)
+
+    def test_moved(self):
+        # labels copied along with their map to another machine
+        os.makedirs(self.folder('copy'))
+        for f_name in (self.xml_file, self.map_file, self.map_file + '.aux.xml'):
+            shutil.copy(f_name, self.folder('copy'))
+        shutil.rmtree(self.folder('maps'))
+        boxes, _ = load_voc_boxes(self.folder('copy/plot.xml'))
+        np.testing.assert_allclose(boxes, [[493005, 4420980, 493015, 4420990]])
+
+
+if __name__ == '__main__':
+    unittest.main()
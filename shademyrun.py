@@ -0,0 +1,175 @@
+# command line entry point for the dataset pipeline and route scoring,
+#   python shademyrun.py {fetch,label,tile,convert,score} --help
+# every subcommand imports what it needs when it runs, so the cli and the
+# batch workers start without loading rasterio, pyproj or matplotlib
+
+import argparse
+import json
+import logging
+import os
+import sys
+from glob import glob
+
+
+def expand(patterns, limit=None):
+    '''Expand file patterns (quoted so the shell leaves them alone, ex.
+    'data/*.zip'), keeping names that match nothing so they fail loudly.'''
+    files = []
+    for pattern in patterns:
+        files.extend(sorted(glob(pattern)) or [pattern])
+    return files[:limit] if limit else files
+
+
+def fetch(args):
+    '''Fetch the map and write the labels of every zip on a process pool,
+    only rebuilding what changed since the last run.'''
+    from batch_retrieve import batchRetrieve
+
+    br = batchRetrieve(in_folder=args.in_folder, out_folder=args.out_folder,
+                       label_folder=args.label_folder, workers=args.workers,
+                       ledger_file=args.ledger, log=args.verbose,
+                       metrics_file=args.metrics, src_file=args.src,
+                       min_height=args.min_height, border=args.border,
+                       fetch_workers=args.fetch_workers, fetch_rate=args.fetch_rate)
+    return br.run(expand(args.zips, args.limit), retry_failed=not args.no_retry)
+
+
+def label(args):
+    '''Write the labels of every zip again against its saved map.'''
+    from MapRetrieve import mapRetrieve
+
+    mr = mapRetrieve(in_folder=args.in_folder, out_folder=args.out_folder,
+                     label_folder=args.label_folder, log=args.verbose,
+                     cache_bytes=0)
+    counts = {'zips': 0, 'labels': 0}
+    for zf in expand(args.zips, args.limit):
+        boxes = mr.save_labels(zf, min_height=args.min_height, border=args.border)
+        counts['zips'] += 1
+        counts['labels'] += len(boxes)
+    return counts
+
+
+def tile(args):
+    '''Cut labeled maps into training tiles with a VOC file per tile.'''
+    from ImageTiles import voc_tiler
+
+    os.makedirs(args.out, exist_ok=True)
+    vt = voc_tiler()
+    counts = {'maps': 0, 'tiles': 0}
+    for xml_file in expand(args.labels, args.limit):
+        vt.split_voc_and_images(xml_file, args.out, args.size, args.size, 0,
+                                overlap=args.overlap, pad=args.pad)
+        counts['maps'] += 1
+        counts['tiles'] += len(vt.write_new_vocs())
+    return counts
+
+
+def convert(args):
+    '''Convert labels between json, VOC xml and RetinaNet csv.'''
+    from JsonToVOC import convert_tree
+
+    return convert_tree(args.src, args.dst, image_dir=args.image_dir,
+                        label=args.label, workers=args.workers,
+                        classes_file=args.classes)
+
+
+def score(args):
+    '''Score the shade along routes from the canopy index.'''
+    from canopy_index import build_canopy_index, canopyIndex
+    from google_apis import fetch_routes
+    from route_cache import routeCache
+
+    if args.labels:
+        build_canopy_index(expand(args.labels), args.index)
+    cache = routeCache(args.cache) if args.cache else None
+    try:
+        routes = fetch_routes(args.route, key=args.key, mode=args.mode, cache=cache)
+    finally:
+        # access times are batched in memory until the cache is closed
+        if cache is not None:
+            cache.close()
+    corridors = [route.corridors(width=args.width) for route in routes]
+    with canopyIndex(args.index) as index:
+        scores = index.score_routes(corridors)
+    for (origin, destination), (segments, shade) in zip(args.route, scores):
+        print(json.dumps({'origin': origin, 'destination': destination,
+                          'shade': shade, 'segments': segments.tolist()}))
+    return {'routes': len(scores)}
+
+
+def parser():
+    main_parser = argparse.ArgumentParser(
+        prog='shademyrun', description='Build the tree dataset and score routes for shade')
+    main_parser.add_argument('-v', '--verbose', action='store_true')
+    subparsers = main_parser.add_subparsers(dest='command', required=True)
+
+    def folders(sub):
+        sub.add_argument('--in-folder', default='data')
+        sub.add_argument('--out-folder', default='maps')
+        sub.add_argument('--label-folder', default='labels')
+        sub.add_argument('--min-height', type=float, default=10)
+        sub.add_argument('--border', type=int, default=50)
+        sub.add_argument('--limit', type=int, default=None)
+
+    sub = subparsers.add_parser('fetch', help=fetch.__doc__)
+    sub.add_argument('zips', nargs='+', help='zipped shapes or patterns')
+    folders(sub)
+    sub.add_argument('--src', default=None, help='the imagery source')
+    sub.add_argument('--workers', type=int, default=None)
+    sub.add_argument('--ledger', default=None)
+    sub.add_argument('--metrics', default=None, help='a .prom or json lines file')
+    sub.add_argument('--no-retry', action='store_true', help='skip zips that failed before')
+    sub.add_argument('--fetch-workers', type=int, default=8,
+                     help='tiles each worker downloads at a time from a MapServer')
+    sub.add_argument('--fetch-rate', type=float, default=20,
+                     help='requests a second to a MapServer, split across the workers')
+    sub.set_defaults(run=fetch)
+
+    sub = subparsers.add_parser('label', help=label.__doc__)
+    sub.add_argument('zips', nargs='+', help='zipped shapes or patterns')
+    folders(sub)
+    sub.set_defaults(run=label)
+
+    sub = subparsers.add_parser('tile', help=tile.__doc__)
+    sub.add_argument('labels', nargs='+', help='VOC xml files or patterns')
+    sub.add_argument('--out', default='tiles')
+    sub.add_argument('--size', type=int, default=512)
+    sub.add_argument('--overlap', type=int, default=0)
+    sub.add_argument('--pad', action='store_true')
+    sub.add_argument('--limit', type=int, default=None)
+    sub.set_defaults(run=tile)
+
+    sub = subparsers.add_parser('convert', help=convert.__doc__)
+    sub.add_argument('src', help='a label file or a folder of label files')
+    sub.add_argument('dst', help='a .csv, a .json or a folder for VOC xml files')
+    sub.add_argument('--image-dir', default=None)
+    sub.add_argument('--label', default='tree')
+    sub.add_argument('--workers', type=int, default=8)
+    sub.add_argument('--classes', default=None)
+    sub.set_defaults(run=convert)
+
+    sub = subparsers.add_parser('score', help=score.__doc__)
+    sub.add_argument('--index', required=True, help='the canopy index .tif')
+    sub.add_argument('--labels', nargs='+', default=None,
+                     help='build the index from these VOC files first')
+    sub.add_argument('--route', nargs=2, action='append', required=True,
+                     metavar=('ORIGIN', 'DESTINATION'))
+    sub.add_argument('--key', default=os.environ.get('GOOGLE_API_KEY', 'API Key'))
+    sub.add_argument('--mode', default='walking')
+    sub.add_argument('--width', type=float, default=13.4, help='corridor width in meters')
+    sub.add_argument('--cache', default='route_cache.sqlite')
+    sub.set_defaults(run=score)
+    return main_parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    summary = args.run(args)
+    # score prints a json line per route, keep its stdout to just those
+    print(summary, file=sys.stderr if args.command == 'score' else sys.stdout)
+    return summary
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+from shademyrun import main
+from benchmark import make_sample, SAMPLE_NAME
+from contextlib import redirect_stdout
+from unittest import mock
+from io import StringIO
+import subprocess
+import unittest
+import tempfile
+import sqlite3
+import json
+import sys
+import os
+
+HEAVY = ('numpy', 'rasterio', 'pyproj', 'pycrs', 'matplotlib', 'PIL', 'requests')
+
+
+class TestCli(unittest.TestCase):
+    """
+    Testing the shademyrun subcommands on the benchmark sample
+    """
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.folder = lambda name: os.path.join(self.temp_dir.name, name)
+        self.zip_file, self.src_file = make_sample(self.folder('data'), n_shapes=200,
+                                                   src_pixels=512)
+        self.folders = ['--in-folder', self.folder('data'), '--out-folder', self.folder('maps'),
+                        '--label-folder', self.folder('labels')]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_lazy_imports(self):
+        code = ('import sys, shademyrun, MapRetrieve, batch_retrieve, google_apis; '
+                f'print(",".join(m for m in {HEAVY!r} if m in sys.modules))')
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        self.assertEqual(out.stdout.strip(), '')
+
+    def test_pipeline(self):
+        summary = main(['fetch', os.path.join(self.folder('data'), '*.zip'), '--src',
+                        self.src_file, '--workers', '1', *self.folders])
+        self.assertEqual(summary['done'], 1)
+        label_file = os.path.join(self.folder('labels'), SAMPLE_NAME + '.xml')
+        with open(label_file) as f:
+            n_labels = f.read().count('<object>')
+
+        summary = main(['label', self.zip_file, '--min-height', '25', *self.folders])
+        self.assertEqual(summary['zips'], 1)
+        with open(label_file) as f:
+            self.assertEqual(f.read().count('<object>'), summary['labels'])
+        self.assertLess(summary['labels'], n_labels)
+
+        summary = main(['tile', label_file, '--out', self.folder('tiles'), '--size', '256'])
+        self.assertEqual(summary['maps'], 1)
+        self.assertGreater(summary['tiles'], 0)
+
+        csv_file = self.folder('annotations.csv')
+        summary = main(['convert', self.folder('tiles'), csv_file])
+        self.assertEqual(summary['images'], summary['files'])
+        self.assertEqual(summary['files'], len([f for f in os.listdir(self.folder('tiles'))
+                                                if f.endswith('.xml')]))
+        self.assertTrue(os.path.exists(self.folder('classes.csv')))
+
+    def test_score(self):
+        from google_apis import Coordinates
+        from shade_score import load_voc_boxes
+        from pyproj import Transformer
+        import numpy as np
+
+        main(['fetch', self.zip_file, '--src', self.src_file, '--workers', '1', *self.folders])
+        label_file = os.path.join(self.folder('labels'), SAMPLE_NAME + '.xml')
+        boxes, crs = load_voc_boxes(label_file)
+        # a short narrow route across the middle of the first tree, and one far off
+        x, y = (boxes[0, 0] + boxes[0, 2]) / 2, (boxes[0, 1] + boxes[0, 3]) / 2
+        lng, lat = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True).transform(
+            [x - 0.5, x + 0.5], [y, y])
+        paths = {'tree': np.stack([lat, lng], axis=1), 'field': [[40.5, -123.5], [40.5, -123.49]]}
+
+        def fetch_routes(pairs, **kwargs):
+            self.assertEqual(kwargs['mode'], 'walking')
+            routes = [Coordinates(origin, destination) for origin, destination in pairs]
+            for route in routes:
+                route.route_points = np.asarray(paths[route.origin], dtype=float)
+                # a cached route read back, its access time is held in memory
+                kwargs['cache'].put(route.origin, route.destination, route.route_points,
+                                    route.route_points)
+                kwargs['cache'].get(route.origin, route.destination)
+            return routes
+
+        index_file = self.folder('canopy.tif')
+        out = StringIO()
+        with mock.patch('google_apis.fetch_routes', fetch_routes), redirect_stdout(out):
+            summary = main(['score', '--index', index_file, '--labels', label_file,
+                            '--route', 'tree', 'home', '--route', 'field', 'home',
+                            '--width', '1', '--cache', self.folder('routes.sqlite')])
+        self.assertEqual(summary, {'routes': 2})
+        self.assertTrue(os.path.exists(index_file))
+        tree, field = map(json.loads, out.getvalue().splitlines())
+        self.assertEqual((tree['origin'], tree['destination']), ('tree', 'home'))
+        self.assertEqual(len(tree['segments']), 1)
+        self.assertGreater(tree['shade'], 0.9)
+        self.assertEqual(field['shade'], 0.0)
+
+        # the cache is closed, so the access times reached the db
+        with sqlite3.connect(self.folder('routes.sqlite')) as db:
+            rows = db.execute('SELECT created, accessed FROM routes').fetchall()
+        self.assertEqual(len(rows), 2)
+        self.assertTrue(all(accessed > created for created, accessed in rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# reads just the bboxes and fields needed for labels out of a zipped
+# shapefile, straight from the .dbf, .shx and .shp bytes with numpy,
+# instead of building a python object for every shape and record
+
+import re
+import struct
+from zipfile import ZipFile
+
+import numpy as np
+import shapefile as shp
+
+# shape types whose records are a single point, the rest start with a bbox
+POINT_TYPES = {1, 11, 21}
+
+
+class shapeStream():
+    def __init__(self, f_name, chunk_bytes=16*1024**2):
+        '''A lazy view of the shapefile inside a zip. Nothing but the file
+        headers and the .shx index is read up front, fields and bboxes are
+        streamed from the zip in chunks when asked for.
+
+        Parameters
+        ----------
+        f_name : str
+            the file name of a zip file containing an ESRI shape
+        chunk_bytes : int
+            how much of a member is decompressed at a time
+        '''
+        self.f_name = f_name
+        self.chunk_bytes = chunk_bytes
+        self.zipshape = ZipFile(f_name)
+        shape_name = re.split(r'/|\\+', f_name)[-1]
+        self.shape_name = shape_name.split('.')[0]
+
+        with self._open('.shp') as f:
+            header = f.read(100)
+        # the file bbox is [minx, miny, maxx, maxy] like shp.Reader.bbox
+        self.shapeType = struct.unpack('<i', header[32:36])[0]
+        self.bbox = list(struct.unpack('<4d', header[36:68]))
+
+        # the index holds the offset and length in 16 bit words of every
+        # record, big endian
+        index = np.frombuffer(self.zipshape.read(self.shape_name + '.shx')[100:],
+                              dtype='>i4').reshape(-1, 2)
+        self.offsets = index[:, 0].astype(np.int64) * 2
+
+        with self._open('.dbf') as f:
+            header = f.read(32)
+            n_records, header_length, self.record_length = struct.unpack('<IHH', header[4:12])
+            descriptors = f.read(header_length - 32)
+        self.dbf_header_length = header_length
+        self.fields = dict()
+        # field descriptors are 32 bytes each up to a 0x0D terminator,
+        # records start with a one byte deletion flag
+        position = 1
+        for k in range(0, len(descriptors) - 1, 32):
+            descriptor = descriptors[k:k + 32]
+            if descriptor[0] == 0x0D:
+                break
+            name = descriptor[:11].split(b'\x00')[0].decode('latin-1')
+            kind = chr(descriptor[11])
+            length = descriptor[16]
+            self.fields[name] = (kind, position, length)
+            position += length
+        if n_records != len(self.offsets):
+            raise ValueError(f'{f_name}: {n_records} records for {len(self.offsets)} shapes')
+
+    def _open(self, ext):
+        return self.zipshape.open(self.shape_name + ext)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def reader(self):
+        '''A full shp.Reader over the same zip, for when the geometry
+        itself is needed.'''
+        return shp.Reader(shp=self._open('.shp'), shx=self._open('.shx'),
+                          dbf=self._open('.dbf'))
+
+    def field(self, name):
+        '''Read one field of every record, streamed from the .dbf.
+
+        Parameters
+        ----------
+        name : str
+            the field name (ex. 'max_h')
+
+        Returns
+        ----------
+        np.ndarray
+            floats for numeric fields, with nan for blank values and
+            deleted records, strings otherwise
+        '''
+        kind, position, length = self.fields[name]
+        numeric = kind in ('N', 'F')
+        records_per_chunk = max(self.chunk_bytes // self.record_length, 1)
+        columns = []
+        with self._open('.dbf') as f:
+            f.read(self.dbf_header_length)
+            for start in range(0, len(self), records_per_chunk):
+                count = min(records_per_chunk, len(self) - start)
+                rows = np.frombuffer(f.read(count * self.record_length),
+                                     dtype=np.uint8).reshape(count, self.record_length)
+                column = np.ascontiguousarray(rows[:, position:position + length])
+                column = np.char.strip(column.view(f'S{length}').ravel())
+                if numeric:
+                    # blanks and overflow stars are missing values
+                    column[(column == b'') | (rows[:, 0] == ord('*')) |
+                           np.char.startswith(column, b'*')] = b'nan'
+                    columns.append(column.astype(float))
+                else:
+                    columns.append(np.char.decode(column, 'latin-1'))
+        if not columns:
+            return np.zeros(0, dtype=float if numeric else str)
+        return np.concatenate(columns)
+
+    def bboxes(self, index=None):
+        '''Read the bbox of the selected records without touching the rest
+        of their geometry.
+
+        Parameters
+        ----------
+        index : np.ndarray
+            the records to read, all of them by default
+
+        Returns
+        ----------
+        np.ndarray
+            (n, 4) bboxes as [minx, miny, maxx, maxy], nan for null shapes
+        '''
+        offsets = self.offsets if index is None else self.offsets[np.asarray(index)]
+        order = np.argsort(offsets, kind='stable')
+        sorted_offsets = offsets[order]
+        out = np.full((len(offsets), 4), np.nan)
+        # every record is an 8 byte header, a 4 byte shape type and then
+        # its bbox (or the point), read forwards a chunk at a time
+        with self._open('.shp') as f:
+            start, buffer, done, eof = 0, b'', 0, False
+            while done < len(sorted_offsets) and not eof:
+                data = f.read(self.chunk_bytes)
+                if not data:
+                    # a point record at the very end is shorter than a bbox
+                    eof = True
+                    data = bytes(44)
+                buffer += data
+                end = start + len(buffer)
+                ready = np.searchsorted(sorted_offsets + 44, end, side='right')
+                if ready > done:
+                    local = sorted_offsets[done:ready] - start
+                    chunk = np.frombuffer(buffer, dtype=np.uint8)
+                    types = chunk[local[:, None] + 8 + np.arange(4)].copy().view('<i4').ravel()
+                    values = chunk[local[:, None] + 12 + np.arange(32)].copy().view('<f8')
+                    point = np.isin(types, list(POINT_TYPES))
+                    values[point] = values[point][:, [0, 1, 0, 1]]
+                    values[types == 0] = np.nan
+                    out[order[done:ready]] = values
+                    done = ready
+                # keep only what the next records can still need, the
+                # next record may not have been reached yet
+                keep_from = len(buffer)
+                if done < len(sorted_offsets):
+                    keep_from = min(sorted_offsets[done] - start, keep_from)
+                buffer = buffer[keep_from:]
+                start += keep_from
+        return out
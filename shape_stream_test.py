@@ -0,0 +1,62 @@
+from shape_stream import shapeStream
+from benchmark import make_sample
+from zipfile import ZipFile
+import shapefile as shp
+import numpy as np
+import unittest
+import tempfile
+import os
+
+
+class TestShapeStream(unittest.TestCase):
+    """
+    Testing shapeStream against the full shapefile reader
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.TemporaryDirectory()
+        cls.f_name, _ = make_sample(cls.temp_dir.name, n_shapes=500, src_pixels=64)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def test_matches_reader(self):
+        # small chunks so records straddle the chunk edges
+        stream = shapeStream(self.f_name, chunk_bytes=1000)
+        reader = stream.reader()
+        heights = np.array([r[0] for r in reader.iterRecords(fields=['max_h'])], dtype=float)
+        bboxes = np.array([s.bbox for s in reader.iterShapes()], dtype=float)
+        self.assertEqual(len(stream), len(reader))
+        np.testing.assert_array_equal(stream.field('max_h'), heights)
+        np.testing.assert_array_equal(stream.bboxes(), bboxes)
+        np.testing.assert_array_equal(stream.bbox, list(reader.bbox))
+
+        index = np.flatnonzero(heights > 30)[::-1]
+        np.testing.assert_array_equal(stream.bboxes(index), bboxes[index])
+
+    def test_points_and_nulls(self):
+        base = os.path.join(self.temp_dir.name, 'points')
+        writer = shp.Writer(base, shapeType=shp.POINT)
+        writer.field('max_h', 'N', decimal=2)
+        writer.field('name', 'C')
+        for i in range(3):
+            writer.point(i, 2 * i)
+            writer.record(None if i == 1 else 10 * i, f'tree{i}')
+        writer.null()
+        writer.record(5, 'gone')
+        writer.close()
+        zip_file = base + '.zip'
+        with ZipFile(zip_file, 'w') as zf:
+            for ext in ('shp', 'shx', 'dbf'):
+                zf.write(f'{base}.{ext}', f'points.{ext}')
+
+        stream = shapeStream(zip_file)
+        np.testing.assert_array_equal(stream.field('max_h'), [0, np.nan, 20, 5])
+        self.assertEqual(list(stream.field('name')), ['tree0', 'tree1', 'tree2', 'gone'])
+        np.testing.assert_array_equal(stream.bboxes(), [[0, 0, 0, 0], [1, 2, 1, 2],
+                                                        [2, 4, 2, 4], [np.nan] * 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# a persistent on-disk cache for map imagery so that repeated or
+# overlapping requests to the map server are served locally
+
+import hashlib
+import logging
+import os
+import threading
+
+
+class tileCache():
+    def __init__(self, cache_dir='tile_cache', max_bytes=2*1024**3, low_water=0.9):
+        '''Blobs are stored under the sha1 of the parts identifying them
+        (ex. source, zoom, x, y or source and extents). Reads refresh the
+        file modification time and the least recently used blobs are
+        evicted once the cache grows past max_bytes.
+
+        Parameters
+        ----------
+        cache_dir : str
+            the folder to keep cached blobs in
+        max_bytes : int
+            the size cap of the cache in bytes
+        low_water : float
+            eviction frees the cache down to this fraction of max_bytes, so
+            the walk over every blob only runs once in a while rather than
+            on every put at the cap
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.size = sum(os.path.getsize(f) for f, _ in self._entries())
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1('|'.join(map(str, parts)).encode()).hexdigest()
+
+    def path(self, key):
+        # shard into sub folders so no single folder gets huge
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                if not f.endswith('.tmp'):
+                    f = os.path.join(root, f)
+                    yield f, os.path.getmtime(f)
+
+    def get(self, *parts):
+        '''Return the cached bytes for parts or None on a miss.'''
+        path = self.path(self.key(*parts))
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # bump the modification time so eviction is least recently used,
+        # another worker may have evicted it since the read
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, data, *parts):
+        '''Store data under parts and evict old blobs if over the size cap.'''
+        path = self.path(self.key(*parts))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a per-process and thread temp file so that concurrent
+        # workers sharing the cache never see a partial blob
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+        return path
+
+    def evict(self):
+        '''Delete least recently used blobs until the cache is down to its
+        low water mark.'''
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(os.path.getsize(f) for f, _ in entries)
+        self.evictions += 1
+        target = self.max_bytes * self.low_water
+        for f, _ in entries:
+            if self.size <= target:
+                break
+            try:
+                f_size = os.path.getsize(f)
+                os.remove(f)
+            except FileNotFoundError:
+                # another worker already evicted it
+                continue
+            self.size -= f_size
+            logging.info(f'\nEvicted {f} from tile cache')
+
+    def fetch(self, url, session=None):
+        '''Get the body of url from the cache or download and cache it.
+
+        Parameters
+        ----------
+        url : str
+            the url of a tile or image on the map server
+        session : requests.Session
+            an optional session to reuse connections across fetches
+
+        Returns
+        ----------
+        bytes
+            the response body
+        '''
+        data = self.get('url', url)
+        if data is None:
+            import requests
+            response = (session or requests).get(url)
+            response.raise_for_status()
+            data = response.content
+            self.put(data, 'url', url)
+        return data
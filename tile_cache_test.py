@@ -0,0 +1,138 @@
+from tile_cache import tileCache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
+import threading
+import unittest
+import tempfile
+import os
+
+
+class FakeTileServer(BaseHTTPRequestHandler):
+    """
+    Stand-in for the map server, answers every tile with its own path
+    """
+    requests_served = 0
+
+    def do_GET(self):
+        FakeTileServer.requests_served += 1
+        body = self.path.encode() * 100
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTileCache(unittest.TestCase):
+    """
+    Testing tileCache class methods
+    """
+    @classmethod
+    def setUpClass(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FakeTileServer)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.shutdown()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        FakeTileServer.requests_served = 0
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_fetch_cached(self):
+        """
+        Testing a repeated fetch is served from disk.
+        """
+        cache = tileCache(self.tmp_dir.name)
+        url = self.url + '/tile/3/2/1'
+        first = cache.fetch(url)
+        second = tileCache(self.tmp_dir.name).fetch(url)
+        self.assertEqual(first, second)
+        self.assertEqual(FakeTileServer.requests_served, 1)
+
+    def test_evict_lru(self):
+        """
+        Testing least recently used tiles are evicted past the size cap.
+        """
+        # each tile body is 1100 bytes, so three fit under the cap
+        cache = tileCache(self.tmp_dir.name, max_bytes=4000)
+        for x in range(3):
+            cache.fetch(f'{self.url}/tile/3/2/{x}')
+        # touch the first tile so the second is the oldest
+        cache.fetch(f'{self.url}/tile/3/2/0')
+        cache.fetch(f'{self.url}/tile/3/2/3')
+        self.assertLessEqual(cache.size, 4000)
+        self.assertIsNotNone(cache.get('url', f'{self.url}/tile/3/2/0'))
+        self.assertIsNone(cache.get('url', f'{self.url}/tile/3/2/1'))
+
+    def test_evict_low_water(self):
+        """
+        Testing eviction frees room for several puts, so the cache is not
+        walked on every put at the cap.
+        """
+        cache = tileCache(self.tmp_dir.name, max_bytes=11000, low_water=0.7)
+        for x in range(40):
+            cache.fetch(f'{self.url}/tile/3/2/{x}')
+            self.assertLessEqual(cache.size, 11000)
+        # each eviction leaves room for 4 more tiles of 1100 bytes
+        self.assertLessEqual(cache.evictions, 8)
+        self.assertIsNotNone(cache.get('url', f'{self.url}/tile/3/2/39'))
+
+    def test_evicted_after_read(self):
+        """
+        Testing a blob evicted by another worker between the read and the
+        access time update is still a hit.
+        """
+        cache = tileCache(self.tmp_dir.name)
+        path = cache.put(b'tile', 'url', 'a')
+        utime = os.utime
+
+        def evicted(f_name, *args, **kwargs):
+            if f_name == path:
+                os.remove(f_name)
+            return utime(f_name, *args, **kwargs)
+
+        with mock.patch('os.utime', evicted):
+            self.assertEqual(cache.get('url', 'a'), b'tile')
+        self.assertEqual(cache.hits, 1)
+        self.assertIsNone(cache.get('url', 'a'))
+
+    def test_read_source(self):
+        """
+        Testing mapRetrieve.read_source serves repeated clips from the cache.
+        """
+        from MapRetrieve import mapRetrieve
+        from benchmark import make_sample
+        import numpy as np
+
+        _, src_file = make_sample(self.tmp_dir.name, n_shapes=10, src_pixels=256)
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        mr = mapRetrieve(out_folder=self.tmp_dir.name, label_folder=self.tmp_dir.name,
+                         src_file=src_file, cache_dir=cache_dir)
+        extents = [-123.085, 39.94, -123.075, 39.93]
+        array, transform, crs = mr.read_source(extents)
+        self.assertEqual((mr.tile_cache.hits, mr.tile_cache.misses), (0, 1))
+        cached, cached_transform, cached_crs = mr.read_source(extents)
+        self.assertEqual((mr.tile_cache.hits, mr.tile_cache.misses), (1, 1))
+        np.testing.assert_array_equal(cached, array)
+        self.assertEqual((cached_transform, cached_crs), (transform, crs))
+        self.assertEqual(mr.metrics.snapshot()['counters']['cache_hits'], 1)
+
+        # other extents miss, and a new object reads the same cache
+        mr.read_source([-123.084, 39.94, -123.075, 39.93])
+        self.assertEqual(mr.tile_cache.misses, 2)
+        other = mapRetrieve(out_folder=self.tmp_dir.name, label_folder=self.tmp_dir.name,
+                            src_file=src_file, cache_dir=cache_dir)
+        other.read_source(extents)
+        self.assertEqual(other.tile_cache.hits, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
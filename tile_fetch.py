@@ -0,0 +1,245 @@
+# fetches map imagery straight from the tile grid of an arcgis MapServer,
+# many tiles at a time over one pooled session with a rate limit per host,
+# and mosaics them in memory
+
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+from affine import Affine
+from PIL import Image
+from rasterio import windows
+from rasterio.crs import CRS
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# esri codes for web mercator
+WEB_MERCATOR_WKIDS = {102100, 102113}
+
+
+def service_url(src_file):
+    '''The base url of a MapServer (ex. from '.../MapServer?f=json&pretty=true'),
+    or None when src_file is not an arcgis MapServer url.'''
+    if not src_file.lower().startswith(('http://', 'https://')):
+        return None
+    base = src_file.split('?')[0].rstrip('/')
+    return base if base.endswith('/MapServer') else None
+
+
+class rateLimiter():
+    '''Spaces out requests to one host to at most rate per second, shared
+    by every thread and fetcher talking to that host at that rate. The
+    limit only holds within one process, every process has its own.'''
+    _hosts = dict()
+    _hosts_lock = threading.Lock()
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    @classmethod
+    def for_host(cls, host, rate):
+        # keyed on the rate too, so a fetcher never inherits the rate of
+        # whichever fetcher reached the host first
+        key = (host, rate or None)
+        with cls._hosts_lock:
+            if key not in cls._hosts:
+                cls._hosts[key] = cls(rate)
+            return cls._hosts[key]
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        time.sleep(start - now)
+
+
+class tileFetcher():
+    def __init__(self, url, workers=8, rate=20, retries=3, timeout=30,
+                 tile_cache=None, level=None, session=None):
+        '''Reads imagery from the tile cache of an arcgis MapServer. It
+        looks like an open rasterio dataset of one zoom level of the tile
+        grid to mapRetrieve, only the tiles under a read window are fetched.
+
+        Parameters
+        ----------
+        url : str
+            the MapServer url (ex. '.../ESRI_Imagery_World_2D/MapServer?f=json')
+        workers : int
+            the number of tiles downloaded at a time
+        rate : float
+            the most requests per second this process sends to the host,
+            None for no limit
+        retries : int
+            retries of a tile on connection errors, 429 and 5xx responses,
+            with exponential backoff (Retry-After is respected)
+        timeout : float
+            seconds to wait on the server for each request
+        tile_cache : tileCache
+            tiles are cached by level, row and column when given
+        level : int
+            the zoom level to read, the finest one by default
+        session : requests.Session
+            a session to share, one is made with a connection pool of
+            workers connections otherwise
+        '''
+        self.url = service_url(url) or url.split('?')[0].rstrip('/')
+        self.workers = workers
+        self.timeout = timeout
+        self.tile_cache = tile_cache
+        self.limiter = rateLimiter.for_host(urlsplit(self.url).netloc, rate)
+        if session is None:
+            session = requests.Session()
+            retry = Retry(total=retries, backoff_factor=0.5,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=('GET',))
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers,
+                                  max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self.lock = threading.Lock()
+        self.tiles_fetched = 0
+        self.bytes_downloaded = 0
+
+        response = self._get(self.url, params={'f': 'json'})
+        self.info = json.loads(response.content)
+        tile_info = self.info.get('tileInfo')
+        if not tile_info:
+            raise ValueError(f'{self.url} has no tile cache')
+        self.tile_height, self.tile_width = tile_info['rows'], tile_info['cols']
+        self.origin = (tile_info['origin']['x'], tile_info['origin']['y'])
+        self.lods = {lod['level']: lod['resolution'] for lod in tile_info['lods']}
+        self.level = max(self.lods) if level is None else level
+
+        reference = tile_info.get('spatialReference') or self.info.get('spatialReference', {})
+        wkid = reference.get('latestWkid') or reference.get('wkid', 4326)
+        self.crs = CRS.from_epsg(3857 if wkid in WEB_MERCATOR_WKIDS else wkid)
+        self.count = 3
+
+        # the grid covers the full extent of the service from the origin
+        extent = self.info.get('fullExtent') or {'xmax': -self.origin[0], 'ymin': -self.origin[1]}
+        resolution = self.lods[self.level]
+        self.transform = Affine(resolution, 0, self.origin[0], 0, -resolution, self.origin[1])
+        self.width = max(math.ceil((extent['xmax'] - self.origin[0]) / resolution), 1)
+        self.height = max(math.ceil((self.origin[1] - extent['ymin']) / resolution), 1)
+
+    # used in place of rasterio.open, the fetcher stays open between reads
+    # so the service description and the connections are reused
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        self.session.close()
+
+    def _get(self, url, **kwargs):
+        self.limiter.wait()
+        response = self.session.get(url, timeout=self.timeout, **kwargs)
+        with self.lock:
+            self.bytes_downloaded += len(response.content)
+        return response
+
+    def tile(self, row, col):
+        '''Get the bytes of one tile of the grid, None where the server has
+        no tile.'''
+        key = ('tile', self.url, self.level, row, col)
+        data = self.tile_cache.get(*key) if self.tile_cache else None
+        if data is not None:
+            return data
+        response = self._get(f'{self.url}/tile/{self.level}/{row}/{col}')
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        with self.lock:
+            self.tiles_fetched += 1
+        if self.tile_cache:
+            self.tile_cache.put(response.content, *key)
+        return response.content
+
+    def read(self, window=None, out_dtype='uint8'):
+        '''Mosaic the tiles under a window of the grid, like
+        rasterio's DatasetReader.read.
+
+        Parameters
+        ----------
+        window : rasterio.windows.Window
+            the pixels of the zoom level to read, the whole grid by default
+
+        Returns
+        ----------
+        np.ndarray
+            a (bands, rows, cols) array, zero where there are no tiles
+        '''
+        if window is None:
+            window = windows.Window(0, 0, self.width, self.height)
+        col0, row0 = int(window.col_off), int(window.row_off)
+        height, width = int(window.height), int(window.width)
+        out = np.zeros((self.count, height, width), dtype=out_dtype)
+        tiles = [(row, col)
+                 for row in range(row0 // self.tile_height,
+                                  (row0 + height - 1) // self.tile_height + 1)
+                 for col in range(col0 // self.tile_width,
+                                  (col0 + width - 1) // self.tile_width + 1)]
+
+        def paste(tile):
+            row, col = tile
+            data = self.tile(row, col)
+            if data is None:
+                return
+            with Image.open(BytesIO(data)) as img:
+                pixels = np.asarray(img.convert('RGB')).transpose(2, 0, 1)
+            # the part of the tile inside the window
+            top, left = row * self.tile_height - row0, col * self.tile_width - col0
+            r0, c0 = max(-top, 0), max(-left, 0)
+            r1 = min(pixels.shape[1], height - top)
+            c1 = min(pixels.shape[2], width - left)
+            if r1 > r0 and c1 > c0:
+                out[:, top + r0:top + r1, left + c0:left + c1] = pixels[:, r0:r1, c0:c1]
+
+        if height > 0 and width > 0:
+            with ThreadPoolExecutor(self.workers) as pool:
+                # tiles land in disjoint parts of out, so threads can paste
+                list(pool.map(paste, tiles))
+        logger.info(f'\nmosaicked {len(tiles)} tiles of level {self.level}')
+        return out
+
+    def window_transform(self, window):
+        return windows.transform(window, self.transform)
+
+    def mosaic(self, extents):
+        '''Mosaic the tiles covering the extents.
+
+        Parameters
+        ----------
+        extents : list
+            a list with the bounding box coordinates in the format,
+                [upper left x, upper left y, lower right x, lower right y]
+            in the projection of the service
+
+        Returns
+        ----------
+        np.ndarray
+            the mosaic as a (bands, rows, cols) array of bytes
+        affine.Affine
+            the transform from pixel to service coordinates of the mosaic
+        '''
+        ulx, uly, lrx, lry = extents
+        window = windows.from_bounds(ulx, lry, lrx, uly, transform=self.transform)
+        window = window.round_offsets().round_lengths()
+        return self.read(window), self.window_transform(window)
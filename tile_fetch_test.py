@@ -0,0 +1,186 @@
+from tile_fetch import tileFetcher, rateLimiter, service_url
+from tile_cache import tileCache
+from MapRetrieve import mapRetrieve
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import threading
+import unittest
+import tempfile
+import json
+import time
+
+TILE = 256
+# a 4326 tile grid with a coarse level and a level of about 2m pixels
+LODS = [{'level': 0, 'resolution': 0.01}, {'level': 1, 'resolution': 2e-5}]
+
+
+def expected_pixels(level, rows, cols):
+    # every pixel holds its own grid row and column so a mosaic can be
+    # checked against the grid directly
+    rows, cols = np.meshgrid(rows, cols, indexing='ij')
+    return np.stack([rows % 251, cols % 251, np.full(rows.shape, level)]).astype(np.uint8)
+
+
+class FakeMapServer(BaseHTTPRequestHandler):
+    """
+    Stand-in for an arcgis MapServer with a tile cache. Tiles west of
+    -123.1 are missing and every fifth tile fails once with a 503.
+    """
+    requests_served = 0
+    failed = set()
+    lock = threading.Lock()
+
+    def do_GET(self):
+        with FakeMapServer.lock:
+            FakeMapServer.requests_served += 1
+        self.respond()
+
+    def respond(self):
+        path = self.path.split('?')[0]
+        if path.endswith('/MapServer'):
+            body = json.dumps({'tileInfo': {'rows': TILE, 'cols': TILE,
+                                            'origin': {'x': -180, 'y': 90},
+                                            'spatialReference': {'wkid': 4326},
+                                            'lods': LODS},
+                               'fullExtent': {'xmin': -180, 'ymin': -90,
+                                              'xmax': 180, 'ymax': 90}}).encode()
+            return self.send(200, body)
+        level, row, col = map(int, path.split('/tile/')[1].split('/'))
+        resolution = LODS[level]['resolution']
+        if -180 + (col + 1) * TILE * resolution < -123.1:
+            return self.send(404, b'')
+        with FakeMapServer.lock:
+            first = (row, col) not in FakeMapServer.failed
+            FakeMapServer.failed.add((row, col))
+        if first and (row + col) % 5 == 0:
+            return self.send(503, b'')
+        time.sleep(0.01)
+        pixels = expected_pixels(level, np.arange(row * TILE, (row + 1) * TILE),
+                                 np.arange(col * TILE, (col + 1) * TILE))
+        buffer = BytesIO()
+        Image.fromarray(pixels.transpose(1, 2, 0)).save(buffer, format='PNG')
+        self.send(200, buffer.getvalue())
+
+    def send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTileFetch(unittest.TestCase):
+    """
+    Testing tileFetcher against a fake tile server
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeMapServer)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/arcgis/rest/services/Fake/MapServer'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_service_url(self):
+        self.assertEqual(service_url(self.url + '?f=json&pretty=true'), self.url)
+        self.assertIsNone(service_url('/vsicurl/http://host/source.tif'))
+
+    def test_mosaic(self):
+        fetcher = tileFetcher(self.url + '?f=json', workers=4, rate=None)
+        self.assertEqual(fetcher.level, 1)
+        self.assertEqual(fetcher.crs.to_epsg(), 4326)
+        # a corner of the extents has no tiles
+        extents = [-123.1051, 39.9351, -123.0849, 39.9249]
+        # count the tiles in flight on the client, the server can see the
+        # next request before it has finished answering the last one
+        fetch_tile, lock, in_flight = fetcher.tile, threading.Lock(), [0, 0]
+
+        def counting_tile(row, col):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            try:
+                return fetch_tile(row, col)
+            finally:
+                with lock:
+                    in_flight[0] -= 1
+        fetcher.tile = counting_tile
+        array, transform = fetcher.mosaic(extents)
+
+        row0 = round((90 - extents[1]) / 2e-5)
+        col0 = round((extents[0] + 180) / 2e-5)
+        self.assertAlmostEqual(transform.c, -180 + col0 * 2e-5)
+        self.assertAlmostEqual(transform.f, 90 - row0 * 2e-5)
+        rows = np.arange(row0, row0 + array.shape[1])
+        cols = np.arange(col0, col0 + array.shape[2])
+        expected = expected_pixels(1, rows, cols)
+        expected[:, :, -180 + (cols // TILE + 1) * TILE * 2e-5 < -123.1] = 0
+        np.testing.assert_array_equal(array, expected)
+        self.assertGreater(array.shape[2], TILE * 2)
+        self.assertLessEqual(in_flight[1], 4)
+        self.assertGreater(in_flight[1], 1)
+
+    def test_cache_and_rate(self):
+        cache = tileCache(self.temp_dir.name)
+        extents = [-123.08, 39.93, -123.07, 39.92]
+        fetcher = tileFetcher(self.url, tile_cache=cache, rate=None)
+        array, _ = fetcher.mosaic(extents)
+        self.assertGreater(fetcher.tiles_fetched, 4)
+
+        # every tile comes from the cache, only the description is fetched
+        served = FakeMapServer.requests_served
+        cached = tileFetcher(self.url, tile_cache=cache, rate=None)
+        np.testing.assert_array_equal(cached.mosaic(extents)[0], array)
+        self.assertEqual(cached.tiles_fetched, 0)
+        self.assertEqual(FakeMapServer.requests_served, served + 1)
+
+        # the rate limit spaces out the requests to the host, even after
+        # unlimited fetchers have used it
+        limited = tileFetcher(self.url, rate=20)
+        start = time.perf_counter()
+        limited.mosaic(extents)
+        n_requests = limited.tiles_fetched + 1
+        self.assertGreaterEqual(time.perf_counter() - start, (n_requests - 2) / 20)
+
+    def test_rate_per_fetcher(self):
+        unlimited = rateLimiter.for_host('rates.example', None)
+        limited = rateLimiter.for_host('rates.example', 2)
+        self.assertEqual(unlimited.interval, 0.0)
+        self.assertEqual(limited.interval, 0.5)
+        self.assertIs(rateLimiter.for_host('rates.example', 2), limited)
+        self.assertIs(rateLimiter.for_host('rates.example', 0), unlimited)
+
+    def test_map_retrieve(self):
+        mr = mapRetrieve(out_folder=self.temp_dir.name, label_folder=self.temp_dir.name,
+                         src_file=self.url + '?f=json&pretty=true', cache_bytes=0)
+        extents = [-123.08, 39.93, -123.07, 39.92]
+        # the service description is read when the fetcher opens
+        service_bytes = mr.open_source().bytes_downloaded
+        array, transform, crs = mr.read_source(extents)
+        # the bytes of the tiles downloaded, not of the decoded clip
+        counters = mr.metrics.snapshot()['counters']
+        self.assertEqual(counters['bytes_fetched'], mr.fetcher.bytes_downloaded - service_bytes)
+        self.assertEqual(counters['bytes_decoded'], array.nbytes)
+        self.assertNotEqual(counters['bytes_fetched'], array.nbytes)
+        np.testing.assert_array_equal(array, mr.fetcher.mosaic(extents)[0])
+        self.assertEqual(crs.to_epsg(), 4326)
+        warped, _ = mr.render_map(extents, 'EPSG:26910')
+        self.assertEqual(warped.shape[0], 3)
+        self.assertTrue(warped.any())
+
+
+if __name__ == '__main__':
+    unittest.main()
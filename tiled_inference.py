@@ -0,0 +1,228 @@
+# runs a tree detector over whole save_map mosaics by streaming
+# overlapping windows through the model in batches, detections come back
+# in map coordinates with the duplicates along tile seams merged
+
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import rasterio
+import shapely
+from rasterio.windows import Window
+
+from ImageTiles import image_cropper
+
+
+class detections(namedtuple('detections',
+                            ['pixel_boxes', 'boxes', 'scores', 'labels', 'crs'])):
+    '''Detections over a mosaic. pixel_boxes and boxes are (n, 4) arrays
+    of [xmin, ymin, xmax, ymax] in mosaic pixels and in map coordinates,
+    boxes and crs are None when the mosaic has no georeference.'''
+
+    def __len__(self):
+        return len(self.scores)
+
+
+def cpu_only():
+    '''Hide every GPU from tensorflow, for workers without one. Call before
+    the model is loaded.'''
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+    import sys
+    if 'tensorflow' in sys.modules:
+        # the variable is only read when tensorflow is first imported
+        sys.modules['tensorflow'].config.set_visible_devices([], 'GPU')
+
+
+def nms(boxes, scores, labels=None, iou_threshold=0.5):
+    '''Greedy non maximum suppression without a python loop over boxes.
+
+    Overlapping pairs come from one STRtree query and their IoU is
+    computed at once. A box is dropped when a kept, higher scoring box of
+    its class overlaps it past the threshold, which is iterated to a fixed
+    point so the result is the same as the usual greedy pass.
+
+    Parameters
+    ----------
+    boxes : np.ndarray
+        (n, 4) boxes as [xmin, ymin, xmax, ymax]
+    scores : np.ndarray
+        (n,) box scores
+    labels : np.ndarray
+        (n,) box classes, boxes only suppress their own class
+    iou_threshold : float
+        the overlap past which the lower scoring box is dropped
+
+    Returns
+    ----------
+    np.ndarray
+        the indices of the kept boxes, highest score first
+    '''
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    scores = np.asarray(scores, dtype=float).ravel()
+    order = np.argsort(-scores, kind='stable')
+    if len(boxes) < 2:
+        return order
+    # rank 0 is the best box, ties keep their input order
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    tree = shapely.STRtree(shapely.box(*boxes.T))
+    first, second = tree.query(shapely.box(*boxes.T), predicate='intersects')
+    pairs = rank[first] < rank[second]
+    if labels is not None:
+        labels = np.asarray(labels).ravel()
+        pairs &= labels[first] == labels[second]
+    first, second = first[pairs], second[pairs]
+
+    a, b = boxes[first], boxes[second]
+    inter = (np.clip(np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0]), 0, None) *
+             np.clip(np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1]), 0, None))
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    union = area[first] + area[second] - inter
+    iou = np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+    overlapping = iou > iou_threshold
+    first, second = first[overlapping], second[overlapping]
+
+    keep = np.ones(len(boxes), dtype=bool)
+    # each pass settles at least one more box of every suppression chain,
+    # chains are short so this runs a handful of times
+    for _ in range(len(boxes)):
+        suppressed = np.zeros(len(boxes), dtype=bool)
+        suppressed[second[keep[first]]] = True
+        if np.array_equal(~suppressed, keep):
+            break
+        keep = ~suppressed
+    return order[keep[order]]
+
+
+def saved_model_detector(model_dir):
+    '''Wrap a TF2 object detection saved model (as exported in
+    SMR_Roboflow_TensorFlow2_Object_Detection.ipynb) as a mosaicDetector
+    model, converting its normalized [ymin, xmin, ymax, xmax] boxes to
+    tile pixels.'''
+    import tensorflow as tf
+    detect_fn = tf.saved_model.load(model_dir)
+
+    def model(batch):
+        out = detect_fn(tf.convert_to_tensor(batch, dtype=tf.uint8))
+        height, width = batch.shape[1:3]
+        boxes = out['detection_boxes'].numpy()[..., [1, 0, 3, 2]] * [width, height, width, height]
+        return (boxes, out['detection_scores'].numpy(),
+                out['detection_classes'].numpy().astype(np.int64) - 1)
+    return model
+
+
+class mosaicDetector():
+    def __init__(self, model, height=512, width=512, overlap=64, batch_size=8,
+                 score_threshold=0.5, iou_threshold=0.5, drop_seam=True, fill=0):
+        '''Detect trees over mosaics of any size.
+
+        Parameters
+        ----------
+        model : callable
+            takes a (batch, height, width, 3) uint8 array and returns
+            (boxes, scores, labels) shaped (batch, n, 4), (batch, n) and
+            (batch, n), with boxes as [xmin, ymin, xmax, ymax] tile pixels,
+            like keras-retinanet predict_on_batch (padding labels are -1)
+        height, width : int
+            the window size the model runs on
+        overlap : int
+            pixels neighbouring windows share, at least the largest crown
+            so every tree is whole in some window
+        batch_size : int
+            windows per model call
+        score_threshold : float
+            detections scoring lower are dropped
+        iou_threshold : float
+            see nms
+        drop_seam : bool
+            drop detections touching an inner window edge, the neighbouring
+            window sees those trees whole inside its overlap
+        fill : int
+            the value windows past the mosaic edge are padded with
+        '''
+        self.model = model
+        self.height = height
+        self.width = width
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.drop_seam = drop_seam and overlap > 0
+        self.fill = fill
+
+    def _read_batch(self, src, boxes):
+        batch = np.full((len(boxes), self.height, self.width, 3), self.fill, dtype=np.uint8)
+        # grey mosaics go in as rgb, alpha and other extra bands are left out
+        indexes = [1, 2, 3] if src.count >= 3 else [1, 1, 1]
+        for k, box in enumerate(boxes):
+            window = Window(box[0], box[1], self.width, self.height)
+            edge = box[2] > src.width or box[3] > src.height
+            tile = src.read(indexes, window=window, boundless=edge, fill_value=self.fill)
+            batch[k] = np.moveaxis(tile, 0, -1)
+        return batch
+
+    def _tile_detections(self, tile_boxes, boxes, scores, labels, imgwidth, imgheight):
+        boxes = np.asarray(boxes, dtype=float).reshape(len(tile_boxes), -1, 4)
+        scores = np.asarray(scores, dtype=float).reshape(len(tile_boxes), -1)
+        labels = np.asarray(labels).reshape(len(tile_boxes), -1)
+        origin = np.asarray(tile_boxes, dtype=float)[:, None, :2]
+        keep = (scores >= self.score_threshold) & (labels >= 0)
+        if self.drop_seam:
+            # inner edges are window edges that are not the mosaic edge
+            left = origin[..., 0] > 0
+            top = origin[..., 1] > 0
+            right = origin[..., 0] + self.width < imgwidth
+            bottom = origin[..., 1] + self.height < imgheight
+            keep &= ~((left & (boxes[..., 0] <= 0)) | (top & (boxes[..., 1] <= 0)) |
+                      (right & (boxes[..., 2] >= self.width)) |
+                      (bottom & (boxes[..., 3] >= self.height)))
+        shifted = boxes + np.concatenate([origin, origin], axis=-1)
+        return shifted[keep], scores[keep], labels[keep]
+
+    def detect(self, mosaic):
+        '''Run the model over a whole mosaic.
+
+        Windows are read on a thread while the model runs on the previous
+        batch, so only two batches are ever in memory.
+
+        Parameters
+        ----------
+        mosaic : str
+            a GeoTIFF, or a png georeferenced by its .aux.xml sidecar
+
+        Returns
+        ----------
+        detections
+            the merged detections, highest score first
+        '''
+        found = []
+        with rasterio.open(mosaic) as src, ThreadPoolExecutor(max_workers=1) as reader:
+            tiles = image_cropper.tile_boxes(src.width, src.height, self.height, self.width,
+                                             overlap=self.overlap, pad=True)
+            batches = [tiles[i:i + self.batch_size]
+                       for i in range(0, len(tiles), self.batch_size)]
+            pending = reader.submit(self._read_batch, src, batches[0]) if batches else None
+            for k, tile_boxes in enumerate(batches):
+                batch = pending.result()
+                if k + 1 < len(batches):
+                    pending = reader.submit(self._read_batch, src, batches[k + 1])
+                found.append(self._tile_detections(tile_boxes, *self.model(batch),
+                                                   src.width, src.height))
+            transform, crs = src.transform, src.crs
+
+        if found:
+            boxes, scores, labels = (np.concatenate(parts) for parts in zip(*found))
+        else:
+            boxes, scores, labels = np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+        keep = nms(boxes, scores, labels, self.iou_threshold)
+        boxes, scores, labels = boxes[keep], scores[keep], labels[keep]
+
+        if crs is None:
+            return detections(boxes, None, scores, labels, None)
+        # map coordinates of the box corners, y flips for north up rasters
+        x = transform.c + transform.a * boxes[:, [0, 2]]
+        y = transform.f + transform.e * boxes[:, [1, 3]]
+        map_boxes = np.stack([x.min(axis=1), y.min(axis=1), x.max(axis=1), y.max(axis=1)], axis=1)
+        return detections(boxes, map_boxes, scores, labels, crs.to_string())
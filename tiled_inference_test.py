@@ -0,0 +1,90 @@
+from tiled_inference import mosaicDetector, nms
+import numpy as np
+import rasterio
+import unittest
+import tempfile
+import os
+
+
+def greedy_nms(boxes, scores, iou_threshold):
+    """
+    The usual one box at a time nms to check against
+    """
+    keep = []
+    for i in np.argsort(-scores, kind='stable'):
+        ok = True
+        for j in keep:
+            w = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+            h = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+            inter = max(w, 0) * max(h, 0)
+            union = ((boxes[i, 2] - boxes[i, 0]) * (boxes[i, 3] - boxes[i, 1]) +
+                     (boxes[j, 2] - boxes[j, 0]) * (boxes[j, 3] - boxes[j, 1]) - inter)
+            if inter / union > iou_threshold:
+                ok = False
+                break
+        if ok:
+            keep.append(i)
+    return np.array(keep)
+
+
+def value_model(batch):
+    """
+    Stand-in detector, every tree is painted with its own value so its
+    box is the extent of that value in the tile
+    """
+    boxes, scores, labels = [], [], []
+    for tile in batch:
+        values = np.unique(tile[..., 0])
+        values = values[values > 0]
+        found = []
+        for v in values:
+            rows, cols = np.nonzero(tile[..., 0] == v)
+            found.append([cols.min(), rows.min(), cols.max() + 1, rows.max() + 1])
+        found = np.array(found, dtype=float).reshape(-1, 4)
+        # pad every tile to the same count like retinanet does
+        pad = 20 - len(found)
+        boxes.append(np.concatenate([found, np.full((pad, 4), -1.0)]))
+        scores.append(np.concatenate([np.full(len(found), 0.9), np.full(pad, -1.0)]))
+        labels.append(np.concatenate([np.zeros(len(found)), np.full(pad, -1)]))
+    return np.array(boxes), np.array(scores), np.array(labels)
+
+
+class TestTiledInference(unittest.TestCase):
+    """
+    Testing nms and the mosaic detector
+    """
+    def test_nms(self):
+        rng = np.random.default_rng(0)
+        xy = rng.uniform(0, 200, (500, 2))
+        boxes = np.concatenate([xy, xy + rng.uniform(5, 30, (500, 2))], axis=1)
+        scores = rng.uniform(size=500)
+        for iou in (0.1, 0.3, 0.5):
+            np.testing.assert_array_equal(nms(boxes, scores, iou_threshold=iou),
+                                          greedy_nms(boxes, scores, iou))
+
+    def test_detect(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mosaic = os.path.join(temp_dir, 'mosaic.tif')
+            image = np.zeros((3, 300, 340), dtype=np.uint8)
+            trees = np.array([[10, 10, 30, 30], [90, 50, 110, 70], [120, 120, 150, 140],
+                              [200, 95, 230, 125], [300, 260, 330, 290]])
+            for v, (x0, y0, x1, y1) in enumerate(trees, start=1):
+                image[:, y0:y1, x0:x1] = v
+            transform = rasterio.transform.from_origin(500000, 4000000, 0.5, 0.5)
+            with rasterio.open(mosaic, 'w', driver='GTiff', width=340, height=300, count=3,
+                               dtype='uint8', crs='EPSG:26910', transform=transform) as dst:
+                dst.write(image)
+
+            detector = mosaicDetector(value_model, height=128, width=128, overlap=48,
+                                      batch_size=3)
+            found = detector.detect(mosaic)
+
+        self.assertEqual(len(found), len(trees))
+        order = np.lexsort((found.pixel_boxes[:, 1], found.pixel_boxes[:, 0]))
+        np.testing.assert_array_equal(found.pixel_boxes[order], trees)
+        self.assertEqual(found.crs, 'EPSG:26910')
+        np.testing.assert_allclose(found.boxes[order][0], [500005, 3999985, 500015, 3999995])
+
+
+if __name__ == '__main__':
+    unittest.main()